@@ -0,0 +1,318 @@
+"""
+Admission control and fair scheduling of LLM generations
+
+At most max_active generations run at once; later requests wait for a
+slot. A request that finds the queue full is refused at once (Overloaded,
+status 429) and one that waits longer than queue_timeout is dropped
+(status 503), both with the queue position and a Retry-After estimate based
+on how long generations have recently taken, so a spike is shed quickly
+instead of every request slowing down until it times out.
+
+Waiting requests belong to a priority class (e.g. "user" for logged-in
+users, "guest") and a client (user id, guest address). A freed slot goes
+to a class by smooth weighted round-robin over the classes with waiters
+(weight 0: only when no other class is waiting), and within the class to
+the clients in turn, oldest request first, so one client sending many
+messages can't hold back everyone else. Each client may have at most
+max_queued_per_client requests waiting.
+
+A generation shared by several callers (coalesced identical questions)
+waits through a SlotGroup: in the queue of its heaviest caller, moved
+whenever a caller joins or leaves, so it is not served at the weight of
+whoever happened to ask first.
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_CLASS = "default"
+
+
+class Overloaded(Exception):
+    def __init__(self, status: int, message: str, position: int, retry_after: int):
+        super().__init__(message)
+        self.status = status
+        self.position = position
+        self.retry_after = retry_after
+
+    def detail(self) -> Dict[str, Any]:
+        return {"detail": str(self), "queue_position": self.position, "retry_after": self.retry_after}
+
+
+class _Class:
+    """Waiters of one priority class: a FIFO per client, clients in round-robin order"""
+
+    def __init__(self, weight: int, window: int):
+        self.weight = weight
+        self.current = 0  # smooth weighted round-robin state
+        self.clients: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.waits: Deque[float] = deque(maxlen=window)
+
+    def pop(self) -> Optional[asyncio.Future]:
+        """Oldest waiter of the next client in turn (None if nobody is waiting)"""
+        while self.clients:
+            client, futs = next(iter(self.clients.items()))
+            fut = futs.popleft()
+            if futs:
+                self.clients.move_to_end(client)
+            else:
+                del self.clients[client]
+            self.waiting -= 1
+            if not fut.done():
+                return fut
+        return None
+
+    def remove(self, client: str, fut: asyncio.Future) -> None:
+        futs = self.clients.get(client)
+        if futs is None or fut not in futs:
+            return
+        futs.remove(fut)
+        self.waiting -= 1
+        if not futs:
+            del self.clients[client]
+
+
+class SlotGroup:
+    """
+    The callers of one shared generation, as (priority, client) pairs, kept up to
+    date by whoever shares it (list-like: append / remove). While the generation
+    waits for a slot it queues as the caller with the heaviest class whose client
+    may still queue.
+    """
+
+    def __init__(self, limiter: "GenerationLimiter"):
+        self.limiter = limiter
+        self.callers: List[Tuple[Optional[str], str]] = []
+        self.waiter: Optional[list] = None  # [class, client, future] while queued
+
+    def append(self, caller: Tuple[Optional[str], str]) -> None:
+        self.callers.append(caller)
+        self.limiter._requeue(self)
+
+    def remove(self, caller: Tuple[Optional[str], str]) -> None:
+        self.callers.remove(caller)
+        self.limiter._requeue(self)
+
+
+class GenerationLimiter:
+    def __init__(self, max_active: int, max_queue: int = 64, queue_timeout: float = 60.0,
+                 weights: Optional[Dict[str, int]] = None, max_queued_per_client: int = 0,
+                 window: int = 1000):
+        """
+        Args:
+            max_active: Generations allowed to run concurrently
+            max_queue: Requests allowed to wait for a slot, over all classes (0 = refuse when busy)
+            queue_timeout: Seconds a request may wait before it is refused
+            weights: Priority classes and their share of freed slots, e.g.
+                     {"user": 4, "guest": 1} (default: one class)
+            max_queued_per_client: Waiting requests allowed per client (0 = no limit)
+            window: Recent waits kept for the wait-time percentiles
+        """
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_queued_per_client = max_queued_per_client
+        self.classes = {name: _Class(w, window) for name, w in (weights or {DEFAULT_CLASS: 1}).items()}
+        self.active = 0
+        self._waits: Deque[float] = deque(maxlen=window)
+        self.avg_seconds = 0.0  # moving average of how long a slot is held
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.max_depth = 0
+
+    @property
+    def waiting(self) -> int:
+        return sum(c.waiting for c in self.classes.values())
+
+    def retry_after(self, position: int) -> int:
+        """Seconds until a request at this queue position would likely get a slot"""
+        per_slot = self.avg_seconds or 1.0
+        return max(1, math.ceil(per_slot * position / max(1, self.max_active)))
+
+    def _class(self, priority: Optional[str]) -> _Class:
+        if priority is None and len(self.classes) == 1:
+            return next(iter(self.classes.values()))
+        if priority not in self.classes:
+            raise ValueError(f"Unknown priority class: {priority!r} (have {sorted(self.classes)})")
+        return self.classes[priority]
+
+    def _refuse(self, cls: _Class, status: int, message: str, position: int) -> Overloaded:
+        if status == 429:
+            self.rejected += 1
+            cls.rejected += 1
+        else:
+            self.timed_out += 1
+        return Overloaded(status, message, position, self.retry_after(position))
+
+    def _client_full(self, cls: _Class, client: str) -> bool:
+        futs = cls.clients.get(client)
+        return bool(self.max_queued_per_client and futs is not None and len(futs) >= self.max_queued_per_client)
+
+    def _pick(self, group: SlotGroup) -> Optional[Tuple[_Class, str]]:
+        """Class and client a shared generation waits as (None: every caller's client is full)"""
+        best = None
+        where = tuple(group.waiter[:2]) if group.waiter is not None else None
+        for priority, client in group.callers:
+            cls = self._class(priority)
+            if best is not None and cls.weight <= best[0].weight:
+                continue
+            if (cls, client) != where and self._client_full(cls, client):
+                continue
+            best = (cls, client)
+        return best
+
+    def _requeue(self, group: SlotGroup) -> None:
+        """Move a shared generation that is still waiting to the queue _pick() chooses now"""
+        if group.waiter is None or not group.callers:
+            return
+        cls, client, fut = group.waiter
+        picked = self._pick(group)
+        if fut.done() or picked is None or picked == (cls, client):
+            return
+        cls.remove(client, fut)
+        new_cls, new_client = picked
+        new_cls.clients.setdefault(new_client, deque()).append(fut)
+        new_cls.waiting += 1
+        group.waiter[:2] = picked
+
+    async def acquire(self, priority: Optional[str] = None, client: str = "",
+                      group: Optional[SlotGroup] = None) -> None:
+        """
+        Wait for a slot as client (any hashable id; "" = anonymous) in the given
+        priority class; raises Overloaded when refused. With a group, the slot is
+        requested for its callers instead (see SlotGroup), falling back to
+        priority / client only if every caller's client is full.
+        """
+        cls = self._class(priority)
+        picked = self._pick(group) if group is not None else None
+        if picked is not None:
+            cls, client = picked
+        if self.active < self.max_active and not self.waiting:
+            self.active += 1
+            self._admit(cls, 0.0)
+            return
+
+        position = self.waiting + 1
+        if position > self.max_queue:
+            raise self._refuse(cls, 429, "Too many requests are waiting for the language model", position)
+        if self._client_full(cls, client):
+            raise self._refuse(cls, 429, "Too many of your questions are already waiting", position)
+
+        start = time.monotonic()
+        fut = asyncio.get_running_loop().create_future()
+        cls.clients.setdefault(client, deque()).append(fut)
+        cls.waiting += 1
+        self.queued += 1
+        self.max_depth = max(self.max_depth, self.waiting)
+        waiter = [cls, client, fut]  # a SlotGroup may move it to another class / client
+        if group is not None:
+            group.waiter = waiter
+        try:
+            await asyncio.wait_for(fut, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            cls, client = waiter[0], waiter[1]
+            if fut.done() and not fut.cancelled():
+                # the slot was handed over just as we gave up: pass it on
+                self.release()
+            else:
+                cls.remove(client, fut)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise self._refuse(cls, 503, "Timed out waiting for the language model", position)
+        finally:
+            if group is not None:
+                group.waiter = None
+        self._admit(waiter[0], time.monotonic() - start)
+
+    def _admit(self, cls: _Class, waited: float) -> None:
+        self.admitted += 1
+        cls.admitted += 1
+        self._waits.append(waited)
+        cls.waits.append(waited)
+
+    def _next_class(self) -> Optional[_Class]:
+        ready = [c for c in self.classes.values() if c.waiting]
+        for c in self.classes.values():
+            if not c.waiting:
+                c.current = 0
+        if not ready:
+            return None
+        # smooth weighted round-robin: over time each class gets weight / total of the slots
+        total = sum(c.weight for c in ready)
+        for c in ready:
+            c.current += c.weight
+        best = max(ready, key=lambda c: c.current)
+        best.current -= total
+        return best
+
+    def release(self, seconds: Optional[float] = None) -> None:
+        """Free a slot (seconds: how long it was held, for the Retry-After estimate)"""
+        if seconds is not None:
+            self.avg_seconds = seconds if not self.avg_seconds else 0.9 * self.avg_seconds + 0.1 * seconds
+        # hand the slot straight to the next waiter, so it can't be taken out of turn
+        while True:
+            cls = self._next_class()
+            if cls is None:
+                break
+            fut = cls.pop()
+            if fut is not None:
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: Optional[str] = None, client: str = "", group: Optional[SlotGroup] = None):
+        await self.acquire(priority, client, group)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+    @staticmethod
+    def _wait_stats(waits: Deque[float]) -> Dict[str, float]:
+        w = np.array(waits) * 1000.0 if waits else np.zeros(1)
+        return {
+            "wait_ms_mean": float(w.mean()),
+            "wait_ms_p50": float(np.percentile(w, 50)),
+            "wait_ms_p95": float(np.percentile(w, 95)),
+            "wait_ms_max": float(w.max()),
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "max_active": self.max_active,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "max_queue_depth": self.max_depth,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            **self._wait_stats(self._waits),
+            "avg_generation_seconds": round(self.avg_seconds, 3),
+        }
+        if len(self.classes) > 1:
+            out["classes"] = {
+                name: {
+                    "weight": c.weight,
+                    "queue_depth": c.waiting,
+                    "waiting_clients": len(c.clients),
+                    "admitted": c.admitted,
+                    "rejected": c.rejected,
+                    **self._wait_stats(c.waits),
+                }
+                for name, c in self.classes.items()
+            }
+        return out
@@ -0,0 +1,94 @@
+# python ./chatbot/bench_bm25.py --sizes 10000 100000 1000000 --queries 50
+"""
+Benchmark the inverted-index BM25 scorer against rank_bm25.BM25Okapi
+on synthetic Zipf-distributed corpora
+"""
+import argparse
+import time
+
+import numpy as np
+from rank_bm25 import BM25Okapi
+
+from bm25_index import BM25Index
+
+
+def synthetic_corpus(n_docs: int, vocab_size: int, avg_len: int, rng: np.random.Generator,
+                     block: int = 50_000):
+    """Returns (doc_len, term_ids, doc_ids, tfs) with Zipf term frequencies"""
+    doc_len = rng.poisson(avg_len, size=n_docs).astype(np.int32)
+    parts = []
+    # generate in blocks of docs to keep peak memory bounded at 1M docs
+    for lo in range(0, n_docs, block):
+        hi = min(n_docs, lo + block)
+        doc_of_token = np.repeat(np.arange(lo, hi, dtype=np.int64), doc_len[lo:hi])
+        term_of_token = (rng.zipf(1.2, size=doc_of_token.shape[0]) - 1) % vocab_size
+        # (doc, term) pairs -> tf
+        keys, tfs = np.unique(doc_of_token * vocab_size + term_of_token, return_counts=True)
+        parts.append(((keys % vocab_size).astype(np.int32), (keys // vocab_size).astype(np.int32),
+                      tfs.astype(np.float32)))
+
+    term_ids, doc_ids, tfs = (np.concatenate(cols) for cols in zip(*parts))
+    return doc_len, term_ids, doc_ids, tfs
+
+
+def iter_token_lists(n_docs: int, term_ids: np.ndarray, doc_ids: np.ndarray, tfs: np.ndarray, terms):
+    """
+    Token list of each document in turn (the postings are sorted by doc). BM25Okapi
+    only iterates its corpus, so the 1M lists never have to exist at once.
+    """
+    bounds = np.searchsorted(doc_ids, np.arange(n_docs + 1))
+    for d in range(n_docs):
+        doc = []
+        for t, tf in zip(term_ids[bounds[d]:bounds[d + 1]].tolist(), tfs[bounds[d]:bounds[d + 1]].tolist()):
+            doc.extend([terms[t]] * int(tf))
+        yield doc
+
+
+def time_queries(fn, queries) -> float:
+    start = time.perf_counter()
+    for q in queries:
+        fn(q)
+    return (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    ap.add_argument("--vocab", type=int, default=50_000)
+    ap.add_argument("--avg_len", type=int, default=120)
+    ap.add_argument("--queries", type=int, default=50)
+    ap.add_argument("--okapi_max", type=int, default=1_000_000,
+                    help="skip BM25Okapi above this many docs (at 1M: ~1.6 GB of dicts, a few minutes)")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    terms = [f"t{i}" for i in range(args.vocab)]
+    vocab = {t: i for i, t in enumerate(terms)}
+
+    # 2-5 term queries mixing frequent and rare terms
+    queries = [
+        [terms[int(t)] for t in (rng.zipf(1.2, size=rng.integers(2, 6)) - 1) % args.vocab]
+        for _ in range(args.queries)
+    ]
+
+    print(f"{'docs':>9} {'postings':>11} {'index ms/q':>11} {'okapi ms/q':>11} {'speedup':>8} {'max|diff|':>10}")
+    for n in args.sizes:
+        doc_len, term_ids, doc_ids, tfs = synthetic_corpus(n, args.vocab, args.avg_len, rng)
+        index = BM25Index.from_postings(vocab, doc_len, term_ids, doc_ids, tfs)
+        t_index = time_queries(index.get_scores, queries)
+
+        t_okapi, max_diff = float("nan"), float("nan")
+        if n <= args.okapi_max:
+            okapi = BM25Okapi(iter_token_lists(n, term_ids, doc_ids, tfs, terms))
+            t_okapi = time_queries(okapi.get_scores, queries)
+            max_diff = max(
+                float(np.abs(okapi.get_scores(q) - index.get_scores(q)).max()) for q in queries
+            )
+
+        print(f"{n:>9} {len(doc_ids):>11} {t_index:>11.2f} {t_okapi:>11.2f} "
+              f"{t_okapi / t_index:>8.1f} {max_diff:>10.2e}")
+
+
+if __name__ == "__main__":
+    main()
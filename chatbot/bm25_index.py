@@ -0,0 +1,249 @@
+"""
+Persisted BM25 term index (vocabulary, document lengths, IDF, postings)
+
+Built once by extract_data/build_index.py and loaded with mmap by
+HybridRetriever, so workers don't re-tokenize the whole corpus on startup.
+Scores match rank_bm25.BM25Okapi for the same tokenizer and parameters.
+"""
+import hashlib
+import json
+import math
+import os
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+_PUNCT_RE = re.compile(r'[^\w\s]')
+
+
+def tokenize(text: str) -> List[str]:
+    """Simple Hebrew-aware tokenization"""
+    # Remove punctuation, split on whitespace
+    text = _PUNCT_RE.sub(' ', (text or "").lower())
+    tokens = text.split()
+    # Keep tokens with at least 2 chars
+    return [t for t in tokens if len(t) >= 2]
+
+
+def corpus_fingerprint(texts: Iterable[str]) -> str:
+    """Cheap content hash used to detect a stale index on disk"""
+    h = hashlib.sha1()
+    n = 0
+    for t in texts:
+        h.update((t or "").encode("utf-8"))
+        h.update(b"\x00")
+        n += 1
+    return f"v{FORMAT_VERSION}-{n}-{h.hexdigest()}"
+
+
+class BM25Index:
+    """
+    Okapi BM25 over a term-major postings layout (CSR):
+    postings of term t are doc_ids[indptr[t]:indptr[t+1]] / tfs[...]
+    """
+
+    def __init__(self, vocab: Dict[str, int], doc_len: np.ndarray, idf: np.ndarray,
+                 indptr: np.ndarray, doc_ids: np.ndarray, tfs: np.ndarray,
+                 k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25,
+                 fingerprint: str = ""):
+        self.vocab = vocab
+        self.doc_len = doc_len
+        self.idf = idf
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.fingerprint = fingerprint
+
+        self.corpus_size = int(doc_len.shape[0])
+        self.avgdl = float(doc_len.sum()) / max(1, self.corpus_size)
+        # Per-document length normalization, k1 * (1 - b + b * dl / avgdl)
+        self.doc_norm = k1 * (1 - b + b * doc_len.astype(np.float64) / max(self.avgdl, 1e-9))
+
+    @classmethod
+    def build(cls, tokenized_docs: List[List[str]], k1: float = 1.5, b: float = 0.75,
+              epsilon: float = 0.25, fingerprint: str = "") -> "BM25Index":
+        vocab: Dict[str, int] = {}
+        term_ids: List[int] = []
+        doc_ids: List[int] = []
+        tfs: List[int] = []
+        doc_len = np.zeros(len(tokenized_docs), dtype=np.int32)
+
+        for d, tokens in enumerate(tokenized_docs):
+            doc_len[d] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                tid = vocab.setdefault(term, len(vocab))
+                term_ids.append(tid)
+                doc_ids.append(d)
+                tfs.append(tf)
+
+        return cls.from_postings(
+            vocab, doc_len,
+            np.asarray(term_ids, dtype=np.int32),
+            np.asarray(doc_ids, dtype=np.int32),
+            np.asarray(tfs, dtype=np.float32),
+            k1=k1, b=b, epsilon=epsilon, fingerprint=fingerprint,
+        )
+
+    @classmethod
+    def from_postings(cls, vocab: Dict[str, int], doc_len: np.ndarray,
+                      term_ids: np.ndarray, doc_ids: np.ndarray, tfs: np.ndarray,
+                      k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25,
+                      fingerprint: str = "") -> "BM25Index":
+        """Build from unordered (term_id, doc_id, tf) triples, one per distinct term in a doc"""
+        # Group postings by term (doc order inside a term is preserved)
+        order = np.argsort(term_ids, kind="stable")
+        df = np.bincount(term_ids, minlength=len(vocab))
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(df, out=indptr[1:])
+
+        # Same IDF (with epsilon floor for very common terms) as BM25Okapi
+        n = int(doc_len.shape[0])
+        idf = np.array([math.log(n - f + 0.5) - math.log(f + 0.5) for f in df.tolist()],
+                       dtype=np.float64)
+        present = df > 0
+        if present.any():
+            average_idf = float(idf[present].sum()) / int(present.sum())
+            idf[idf < 0] = epsilon * average_idf
+
+        return cls(vocab, doc_len, idf, indptr,
+                   doc_ids[order].astype(np.int32), tfs[order].astype(np.float32),
+                   k1=k1, b=b, epsilon=epsilon, fingerprint=fingerprint)
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        # meta.json is written last: a half-written index is treated as missing
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        np.save(os.path.join(path, "doc_len.npy"), self.doc_len)
+        np.save(os.path.join(path, "idf.npy"), self.idf)
+        np.save(os.path.join(path, "indptr.npy"), self.indptr)
+        np.save(os.path.join(path, "doc_ids.npy"), self.doc_ids)
+        np.save(os.path.join(path, "tfs.npy"), self.tfs)
+
+        terms = [None] * len(self.vocab)
+        for term, tid in self.vocab.items():
+            terms[tid] = term
+        with open(os.path.join(path, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(terms, f, ensure_ascii=False)
+
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "format_version": FORMAT_VERSION,
+                "fingerprint": self.fingerprint,
+                "corpus_size": self.corpus_size,
+                "vocab_size": len(self.vocab),
+                "k1": self.k1,
+                "b": self.b,
+                "epsilon": self.epsilon,
+            }, f)
+
+    @classmethod
+    def load(cls, path: str, fingerprint: Optional[str] = None,
+             mmap: bool = True) -> Optional["BM25Index"]:
+        """
+        Load a persisted index. Returns None if it is missing, was written
+        by another format version, or doesn't match the given fingerprint.
+        """
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format_version") != FORMAT_VERSION:
+            return None
+        if fingerprint is not None and meta.get("fingerprint") != fingerprint:
+            return None
+
+        mode = "r" if mmap else None
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mode)
+            for name in ("doc_len", "idf", "indptr", "doc_ids", "tfs")
+        }
+        with open(os.path.join(path, "vocab.json"), "r", encoding="utf-8") as f:
+            vocab = {t: i for i, t in enumerate(json.load(f))}
+
+        return cls(vocab, arrays["doc_len"], arrays["idf"], arrays["indptr"],
+                   arrays["doc_ids"], arrays["tfs"],
+                   k1=meta["k1"], b=meta["b"], epsilon=meta["epsilon"],
+                   fingerprint=meta.get("fingerprint", ""))
+
+    def term_ids(self, query_tokens: List[str]) -> np.ndarray:
+        """Integer term ids of the query tokens found in the vocabulary (duplicates kept)"""
+        ids = [self.vocab.get(t) for t in query_tokens]
+        return np.array([i for i in ids if i is not None], dtype=np.int64)
+
+    def _postings(self, tids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Concatenated postings of the given terms as (doc_ids, bm25 contributions)"""
+        starts = self.indptr[tids]
+        lens = self.indptr[tids + 1] - starts
+        total = int(lens.sum())
+        # Positions of all postings ranges without a Python loop
+        pos = np.arange(total, dtype=np.int64) + np.repeat(starts - (np.cumsum(lens) - lens), lens)
+
+        docs = self.doc_ids[pos]
+        tf = self.tfs[pos].astype(np.float64)
+        idf = np.repeat(self.idf[tids], lens)
+        return docs, idf * (tf * (self.k1 + 1) / (tf + self.doc_norm[docs]))
+
+    def get_scores(self, query_tokens: List[str]) -> np.ndarray:
+        """
+        BM25 score of every document (same semantics as BM25Okapi.get_scores).
+        Only postings of the query terms are touched: cost is O(sum of their df).
+        """
+        tids = self.term_ids(query_tokens)
+        if tids.size == 0:
+            return np.zeros(self.corpus_size, dtype=np.float64)
+        docs, contrib = self._postings(tids)
+        # scatter-add into the score vector
+        return np.bincount(docs, weights=contrib, minlength=self.corpus_size)
+
+    def get_top(self, query_tokens: List[str], k: int,
+                mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Best k (doc_ids, scores) by descending score, accumulated only over
+        the documents that contain a query term (no N-length array).
+        mask optionally restricts the result to the allowed documents.
+        """
+        empty = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        tids = self.term_ids(query_tokens)
+        if tids.size == 0:
+            return empty
+        docs, contrib = self._postings(tids)
+        uniq, inv = np.unique(docs, return_inverse=True)
+        scores = np.bincount(inv, weights=contrib)
+        if mask is not None:
+            keep = mask[uniq]
+            uniq, scores = uniq[keep], scores[keep]
+            if uniq.shape[0] == 0:
+                return empty
+
+        n = min(k, uniq.shape[0])
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return uniq[top].astype(np.int64), scores[top]
+
+    def get_scores_many(self, queries_tokens: List[List[str]]) -> np.ndarray:
+        """BM25 scores of several queries at once, shape (len(queries_tokens), N)"""
+        n_q = len(queries_tokens)
+        per_query = [self.term_ids(toks) for toks in queries_tokens]
+        tids = np.concatenate(per_query) if per_query else np.zeros(0, dtype=np.int64)
+        if tids.size == 0:
+            return np.zeros((n_q, self.corpus_size), dtype=np.float64)
+
+        docs, contrib = self._postings(tids)
+        # offset each query's postings into its own row of a flat (Q * N) vector
+        lens = self.indptr[tids + 1] - self.indptr[tids]
+        q_of_term = np.repeat(np.arange(n_q, dtype=np.int64), [t.size for t in per_query])
+        rows = np.repeat(q_of_term, lens)
+        flat = np.bincount(rows * self.corpus_size + docs, weights=contrib,
+                           minlength=n_q * self.corpus_size)
+        return flat.reshape(n_q, self.corpus_size)
@@ -0,0 +1,529 @@
+"""
+Approximate dense search backends for HybridRetriever
+
+Each backend is built by extract_data/build_index.py, persisted next to
+cis_emb.npy and exposes search(q_embs, k) -> (scores, ids), both (Q x k),
+with candidates rescored exactly against the float32 embedding rows.
+Missing candidates are padded with id -1 / score -inf. An optional boolean
+mask over the N chunks restricts the search to the allowed rows.
+"""
+import json
+import mmap
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+
+def _gather_ranges(indptr: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """Positions of the CSR ranges indptr[r]:indptr[r+1] for all rows, concatenated"""
+    starts = indptr[rows]
+    lens = indptr[rows + 1] - starts
+    total = int(lens.sum())
+    return np.arange(total, dtype=np.int64) + np.repeat(starts - (np.cumsum(lens) - lens), lens)
+
+
+def advise_random(E: np.ndarray) -> None:
+    """
+    Tell the kernel a memory-mapped E is read at random rows. Rescoring reads
+    a few hundred scattered rows per query; with the default readahead each
+    of them pulls in neighbouring pages, until all of E is resident in every
+    worker.
+    """
+    m = getattr(E, "_mmap", None)
+    if m is not None and hasattr(m, "madvise") and hasattr(mmap, "MADV_RANDOM"):
+        m.madvise(mmap.MADV_RANDOM)
+
+
+def _topk_rows(scores: np.ndarray, ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Best k (score, id) of one query, padded to length k"""
+    out_s = np.full(k, -np.inf, dtype=np.float32)
+    out_i = np.full(k, -1, dtype=np.int64)
+    n = min(k, scores.shape[0])
+    if n == 0:
+        return out_s, out_i
+    top = np.argpartition(-scores, n - 1)[:n]
+    top = top[np.argsort(-scores[top])]
+    out_s[:n] = scores[top]
+    out_i[:n] = ids[top]
+    return out_s, out_i
+
+
+def _assign(X: np.ndarray, C: np.ndarray, block: int = 65536) -> np.ndarray:
+    """Nearest centroid (max inner product) of every row, in blocks to bound memory"""
+    out = np.empty(X.shape[0], dtype=np.int32)
+    for lo in range(0, X.shape[0], block):
+        out[lo:lo + block] = np.argmax(np.asarray(X[lo:lo + block], dtype=np.float32) @ C.T, axis=1)
+    return out
+
+
+def spherical_kmeans(X: np.ndarray, n_clusters: int, n_iter: int = 20, seed: int = 0,
+                     max_train: int = 200_000) -> np.ndarray:
+    """k-means on the unit sphere (cosine), trained on a sample of at most max_train rows"""
+    rng = np.random.default_rng(seed)
+    n = X.shape[0]
+    train_idx = rng.choice(n, size=min(n, max_train), replace=False)
+    train = np.asarray(X[np.sort(train_idx)], dtype=np.float32)
+
+    C = train[rng.choice(train.shape[0], size=n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = _assign(train, C)
+        sums = np.zeros_like(C)
+        np.add.at(sums, assign, train)
+        counts = np.bincount(assign, minlength=n_clusters)
+
+        # re-seed empty clusters from random training points
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = train[rng.choice(train.shape[0], size=int(empty.sum()), replace=False)]
+
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        C = sums / np.maximum(norms, 1e-12)
+    return C.astype(np.float32)
+
+
+class IVFIndex:
+    """
+    Inverted-file index: a k-means coarse quantizer plus one list of
+    chunk ids per centroid. A query probes its nprobe closest lists and
+    rescores their members exactly with E.
+    """
+
+    def __init__(self, E: np.ndarray, centroids: np.ndarray, list_ptr: np.ndarray,
+                 list_ids: np.ndarray, nprobe: int = 8, fingerprint: str = ""):
+        self.E = E
+        advise_random(E)
+        self.centroids = centroids
+        self.list_ptr = list_ptr
+        self.list_ids = list_ids
+        self.nprobe = nprobe
+        self.fingerprint = fingerprint
+
+    @property
+    def n_lists(self) -> int:
+        return int(self.centroids.shape[0])
+
+    @classmethod
+    def build(cls, E: np.ndarray, n_lists: Optional[int] = None, n_iter: int = 20,
+              nprobe: int = 8, seed: int = 0, fingerprint: str = "") -> "IVFIndex":
+        n = E.shape[0]
+        if not n_lists:
+            n_lists = int(4 * np.sqrt(n))
+        n_lists = max(1, min(n_lists, n))
+
+        centroids = spherical_kmeans(E, n_lists, n_iter=n_iter, seed=seed)
+        assign = _assign(E, centroids)
+
+        order = np.argsort(assign, kind="stable")
+        list_ptr = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=n_lists), out=list_ptr[1:])
+        return cls(E, centroids, list_ptr, order.astype(np.int32),
+                   nprobe=nprobe, fingerprint=fingerprint)
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        np.save(os.path.join(path, "centroids.npy"), self.centroids)
+        np.save(os.path.join(path, "list_ptr.npy"), self.list_ptr)
+        np.save(os.path.join(path, "list_ids.npy"), self.list_ids)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "format_version": FORMAT_VERSION,
+                "kind": "ivf",
+                "fingerprint": self.fingerprint,
+                "rows": int(self.list_ids.shape[0]),
+                "n_lists": self.n_lists,
+            }, f)
+
+    @classmethod
+    def load(cls, path: str, E: np.ndarray, nprobe: int = 8,
+             fingerprint: Optional[str] = None) -> Optional["IVFIndex"]:
+        """Returns None if the index is missing or stale"""
+        meta = _read_meta(path, "ivf", fingerprint)
+        if meta is None or meta["rows"] != E.shape[0]:
+            return None
+        return cls(
+            E,
+            np.load(os.path.join(path, "centroids.npy")),
+            np.load(os.path.join(path, "list_ptr.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "list_ids.npy"), mmap_mode="r"),
+            nprobe=nprobe,
+            fingerprint=meta.get("fingerprint", ""),
+        )
+
+    def search(self, q_embs: np.ndarray, k: int, nprobe: Optional[int] = None,
+               mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        nprobe = max(1, min(nprobe or self.nprobe, self.n_lists))
+        coarse = q_embs @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+
+        out_s = np.empty((q_embs.shape[0], k), dtype=np.float32)
+        out_i = np.empty((q_embs.shape[0], k), dtype=np.int64)
+        for qi in range(q_embs.shape[0]):
+            cand = np.sort(np.asarray(self.list_ids[_gather_ranges(self.list_ptr, probes[qi])]))
+            if mask is not None:
+                cand = cand[mask[cand]]
+            # exact rescoring of the probed lists
+            scores = np.asarray(self.E[cand], dtype=np.float32) @ q_embs[qi]
+            out_s[qi], out_i[qi] = _topk_rows(scores, cand, k)
+        return out_s, out_i
+
+
+class QuantizedIndex:
+    """
+    Scalar-quantized copy of E (int8 with a per-dimension scale, or float16).
+    The compact matrix is scanned in blocks, keeping only each query's best
+    k * rescore rows so far (no Q x N score array); those are rescored
+    exactly with the float32 E rows, read from the memory-mapped file.
+    """
+
+    KINDS = ("int8", "float16")
+
+    def __init__(self, E: np.ndarray, codes: np.ndarray, scale: Optional[np.ndarray],
+                 kind: str, rescore: int = 4, fingerprint: str = "", block: int = 8192):
+        self.E = E
+        advise_random(E)
+        self.codes = codes
+        self.scale = scale
+        self.kind = kind
+        self.rescore = rescore
+        self.fingerprint = fingerprint
+        self.block = block
+
+    @classmethod
+    def build(cls, E: np.ndarray, kind: str = "int8", rescore: int = 4,
+              fingerprint: str = "") -> "QuantizedIndex":
+        if kind not in cls.KINDS:
+            raise ValueError(f"Unknown quantization: {kind}")
+        if kind == "float16":
+            return cls(E, np.asarray(E, dtype=np.float16), None, kind,
+                       rescore=rescore, fingerprint=fingerprint)
+
+        # symmetric per-dimension scale: x[:, d] ~= codes[:, d] * scale[d]
+        max_abs = np.zeros(E.shape[1], dtype=np.float32)
+        for lo in range(0, E.shape[0], 65536):
+            max_abs = np.maximum(max_abs, np.abs(np.asarray(E[lo:lo + 65536], dtype=np.float32)).max(axis=0))
+        scale = np.maximum(max_abs, 1e-12) / 127.0
+        codes = np.empty(E.shape, dtype=np.int8)
+        for lo in range(0, E.shape[0], 65536):
+            codes[lo:lo + 65536] = np.clip(np.rint(np.asarray(E[lo:lo + 65536], dtype=np.float32) / scale),
+                                           -127, 127)
+        return cls(E, codes, scale.astype(np.float32), kind, rescore=rescore, fingerprint=fingerprint)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.codes.nbytes + (self.scale.nbytes if self.scale is not None else 0))
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        np.save(os.path.join(path, "codes.npy"), self.codes)
+        if self.scale is not None:
+            np.save(os.path.join(path, "scale.npy"), self.scale)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "format_version": FORMAT_VERSION,
+                "kind": self.kind,
+                "fingerprint": self.fingerprint,
+                "rows": int(self.codes.shape[0]),
+            }, f)
+
+    @classmethod
+    def load(cls, path: str, E: np.ndarray, kind: str, rescore: int = 4,
+             fingerprint: Optional[str] = None) -> Optional["QuantizedIndex"]:
+        """Returns None if the index is missing, stale or of another kind"""
+        meta = _read_meta(path, kind, fingerprint)
+        if meta is None or meta["rows"] != E.shape[0]:
+            return None
+        scale = None
+        if kind == "int8":
+            scale = np.load(os.path.join(path, "scale.npy"))
+        return cls(E, np.load(os.path.join(path, "codes.npy"), mmap_mode="r"), scale, kind,
+                   rescore=rescore, fingerprint=meta.get("fingerprint", ""))
+
+    def shortlist(self, q_embs: np.ndarray, n_short: int,
+                  mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Best n_short (approximate score, row) per query on the compact matrix
+        (Q x n_short, -inf for masked-out rows). Blocks are upcast and scored
+        one at a time and merged into the running top n_short, so the float32
+        temporaries stay at Q x (block + n_short).
+        """
+        q = q_embs if self.scale is None else q_embs * self.scale
+        q = q.astype(np.float32)
+        n_q = q.shape[0]
+        best_s = np.empty((n_q, 0), dtype=np.float32)
+        best_i = np.empty((n_q, 0), dtype=np.int64)
+        for lo in range(0, self.codes.shape[0], self.block):
+            s = q @ np.asarray(self.codes[lo:lo + self.block], dtype=np.float32).T
+            if mask is not None:
+                s[:, ~mask[lo:lo + s.shape[1]]] = -np.inf
+            ids = np.broadcast_to(np.arange(lo, lo + s.shape[1], dtype=np.int64), s.shape)
+            best_s = np.concatenate([best_s, s], axis=1)
+            best_i = np.concatenate([best_i, ids], axis=1)
+            if best_s.shape[1] > n_short:
+                keep = np.argpartition(-best_s, n_short - 1, axis=1)[:, :n_short]
+                best_s = np.take_along_axis(best_s, keep, axis=1)
+                best_i = np.take_along_axis(best_i, keep, axis=1)
+        return best_s, best_i
+
+    def search(self, q_embs: np.ndarray, k: int,
+               mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        n_short = min(self.codes.shape[0], max(k, k * self.rescore))
+        short_s, short_i = self.shortlist(q_embs, n_short, mask)
+
+        out_s = np.empty((q_embs.shape[0], k), dtype=np.float32)
+        out_i = np.empty((q_embs.shape[0], k), dtype=np.int64)
+        for qi in range(q_embs.shape[0]):
+            cand = np.sort(short_i[qi][np.isfinite(short_s[qi])])
+            # exact float32 rescoring of the shortlist
+            scores = np.asarray(self.E[cand], dtype=np.float32) @ q_embs[qi]
+            out_s[qi], out_i[qi] = _topk_rows(scores, cand, k)
+        return out_s, out_i
+
+
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:
+    _POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(x: np.ndarray) -> np.ndarray:
+        return _POPCOUNT8[x.view(np.uint8)].reshape(*x.shape, x.itemsize).sum(axis=-1)
+
+
+def pack_signs(X: np.ndarray) -> np.ndarray:
+    """Sign bits of each row packed into uint64 words (N x ceil(D / 64))"""
+    bits = np.packbits(np.asarray(X) > 0, axis=1)
+    pad = (-bits.shape[1]) % 8
+    if pad:
+        bits = np.pad(bits, ((0, 0), (0, pad)))
+    return np.ascontiguousarray(bits).view(np.uint64)
+
+
+class BinaryIndex:
+    """
+    Sign-bit hash of the normalized embeddings. Hamming distance (popcount
+    of XOR) over 64-bit words picks the k * rescore closest rows, which are
+    rescored exactly with the float32 E rows.
+    """
+
+    def __init__(self, E: np.ndarray, codes: np.ndarray, rescore: int = 4,
+                 fingerprint: str = "", block: int = 65536):
+        self.E = E
+        advise_random(E)
+        self.codes = codes
+        self.rescore = rescore
+        self.fingerprint = fingerprint
+        self.block = block
+
+    @classmethod
+    def build(cls, E: np.ndarray, rescore: int = 4, fingerprint: str = "") -> "BinaryIndex":
+        codes = np.concatenate([pack_signs(E[lo:lo + 65536]) for lo in range(0, E.shape[0], 65536)])
+        return cls(E, codes, rescore=rescore, fingerprint=fingerprint)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.codes.nbytes)
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        np.save(os.path.join(path, "codes.npy"), self.codes)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "format_version": FORMAT_VERSION,
+                "kind": "binary",
+                "fingerprint": self.fingerprint,
+                "rows": int(self.codes.shape[0]),
+            }, f)
+
+    @classmethod
+    def load(cls, path: str, E: np.ndarray, rescore: int = 4,
+             fingerprint: Optional[str] = None) -> Optional["BinaryIndex"]:
+        """Returns None if the index is missing or stale"""
+        meta = _read_meta(path, "binary", fingerprint)
+        if meta is None or meta["rows"] != E.shape[0]:
+            return None
+        return cls(E, np.load(os.path.join(path, "codes.npy"), mmap_mode="r"),
+                   rescore=rescore, fingerprint=meta.get("fingerprint", ""))
+
+    def hamming(self, q_code: np.ndarray) -> np.ndarray:
+        """Hamming distance of one packed query to every row"""
+        out = np.empty(self.codes.shape[0], dtype=np.uint16)
+        for lo in range(0, self.codes.shape[0], self.block):
+            out[lo:lo + self.block] = _popcount(self.codes[lo:lo + self.block] ^ q_code).sum(axis=1)
+        return out
+
+    def search(self, q_embs: np.ndarray, k: int,
+               mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        q_codes = pack_signs(q_embs)
+        n_short = min(self.codes.shape[0], max(k, k * self.rescore))
+
+        out_s = np.empty((q_embs.shape[0], k), dtype=np.float32)
+        out_i = np.empty((q_embs.shape[0], k), dtype=np.int64)
+        for qi in range(q_embs.shape[0]):
+            dist = self.hamming(q_codes[qi])
+            if mask is not None:
+                dist[~mask] = np.iinfo(dist.dtype).max
+            cand = np.sort(np.argpartition(dist, n_short - 1)[:n_short])
+            if mask is not None:
+                cand = cand[mask[cand]]
+            # exact float32 rescoring of the shortlist
+            scores = np.asarray(self.E[cand], dtype=np.float32) @ q_embs[qi]
+            out_s[qi], out_i[qi] = _topk_rows(scores, cand, k)
+        return out_s, out_i
+
+
+class PCAIndex:
+    """
+    PCA projection of E to a few dimensions (e.g. 64-128 of 384). Queries are
+    projected and scored in the reduced space; the best k * rescore rows are
+    rescored at full dimension with the float32 E rows.
+    """
+
+    def __init__(self, E: np.ndarray, mean: np.ndarray, components: np.ndarray,
+                 reduced: np.ndarray, rescore: int = 4, fingerprint: str = ""):
+        self.E = E
+        advise_random(E)
+        self.mean = mean
+        self.components = components
+        self.reduced = reduced
+        self.rescore = rescore
+        self.fingerprint = fingerprint
+
+    @property
+    def dim(self) -> int:
+        return int(self.components.shape[0])
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.reduced.nbytes + self.components.nbytes + self.mean.nbytes)
+
+    @classmethod
+    def build(cls, E: np.ndarray, dim: int = 128, rescore: int = 4, seed: int = 0,
+              max_train: int = 200_000, fingerprint: str = "") -> "PCAIndex":
+        rng = np.random.default_rng(seed)
+        n = E.shape[0]
+        dim = max(1, min(dim, E.shape[1]))
+        train = np.asarray(E[np.sort(rng.choice(n, size=min(n, max_train), replace=False))],
+                           dtype=np.float64)
+
+        mean = train.mean(axis=0)
+        centered = train - mean
+        # eigenvectors of the covariance, largest variance first
+        _, vecs = np.linalg.eigh(centered.T @ centered)
+        components = vecs[:, ::-1][:, :dim].T.astype(np.float32)
+        mean = mean.astype(np.float32)
+
+        reduced = np.empty((n, dim), dtype=np.float32)
+        for lo in range(0, n, 65536):
+            reduced[lo:lo + 65536] = (np.asarray(E[lo:lo + 65536], dtype=np.float32) - mean) @ components.T
+        return cls(E, mean, components, reduced, rescore=rescore, fingerprint=fingerprint)
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        np.save(os.path.join(path, "mean.npy"), self.mean)
+        np.save(os.path.join(path, "components.npy"), self.components)
+        np.save(os.path.join(path, "reduced.npy"), self.reduced)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "format_version": FORMAT_VERSION,
+                "kind": "pca",
+                "fingerprint": self.fingerprint,
+                "rows": int(self.reduced.shape[0]),
+                "dim": self.dim,
+            }, f)
+
+    @classmethod
+    def load(cls, path: str, E: np.ndarray, rescore: int = 4,
+             fingerprint: Optional[str] = None) -> Optional["PCAIndex"]:
+        """Returns None if the index is missing or stale"""
+        meta = _read_meta(path, "pca", fingerprint)
+        if meta is None or meta["rows"] != E.shape[0]:
+            return None
+        return cls(
+            E,
+            np.load(os.path.join(path, "mean.npy")),
+            np.load(os.path.join(path, "components.npy")),
+            np.load(os.path.join(path, "reduced.npy"), mmap_mode="r"),
+            rescore=rescore,
+            fingerprint=meta.get("fingerprint", ""),
+        )
+
+    def search(self, q_embs: np.ndarray, k: int,
+               mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        # q . e = q . mean + (P q) . P(e - mean) for e in the PCA subspace;
+        # the first term is the same for every row so only the second ranks
+        q_proj = q_embs.astype(np.float32) @ self.components.T
+        approx = q_proj @ np.asarray(self.reduced).T
+        if mask is not None:
+            approx[:, ~mask] = -np.inf
+        n_short = min(self.reduced.shape[0], max(k, k * self.rescore))
+
+        out_s = np.empty((q_embs.shape[0], k), dtype=np.float32)
+        out_i = np.empty((q_embs.shape[0], k), dtype=np.int64)
+        for qi in range(q_embs.shape[0]):
+            cand = np.sort(np.argpartition(-approx[qi], n_short - 1)[:n_short])
+            if mask is not None:
+                cand = cand[mask[cand]]
+            # exact full-dimension rescoring of the shortlist
+            scores = np.asarray(self.E[cand], dtype=np.float32) @ q_embs[qi]
+            out_s[qi], out_i[qi] = _topk_rows(scores, cand, k)
+        return out_s, out_i
+
+
+def _read_meta(path: str, kind: str, fingerprint: Optional[str]) -> Optional[dict]:
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("format_version") != FORMAT_VERSION or meta.get("kind") != kind:
+        return None
+    if fingerprint is not None and meta.get("fingerprint") != fingerprint:
+        return None
+    return meta
+
+
+# Default directory (next to cis_emb.npy) of each persisted backend
+DEFAULT_DIRS = {
+    "ivf": "cis_ivf",
+    "int8": "cis_quant",
+    "float16": "cis_quant",
+    "binary": "cis_binary",
+    "pca": "cis_pca",
+}
+
+
+def load_dense_index(backend: str, path: str, E: np.ndarray,
+                     fingerprint: Optional[str] = None, nprobe: int = 8, rescore: int = 4):
+    """
+    Load the dense backend selected by name ("exact" means brute-force E @ q,
+    returned as None). Returns None if the persisted index is missing or stale.
+    """
+    if backend == "exact":
+        return None
+    if backend == "ivf":
+        return IVFIndex.load(path, E, nprobe=nprobe, fingerprint=fingerprint)
+    if backend in QuantizedIndex.KINDS:
+        return QuantizedIndex.load(path, E, backend, rescore=rescore, fingerprint=fingerprint)
+    if backend == "binary":
+        return BinaryIndex.load(path, E, rescore=rescore, fingerprint=fingerprint)
+    if backend == "pca":
+        return PCAIndex.load(path, E, rescore=rescore, fingerprint=fingerprint)
+    raise ValueError(f"Unknown dense backend: {backend}")
@@ -0,0 +1,81 @@
+"""
+Diversified top-k selection over a ranked candidate list: per-URL caps and
+optional maximal marginal relevance (MMR) on the embedding rows, in NumPy
+"""
+from typing import Any, Dict, Optional, Sequence
+
+import numpy as np
+
+
+def url_ids(metas: Sequence[Dict[str, Any]]) -> np.ndarray:
+    """Integer URL id per chunk (-1 for chunks without a URL)"""
+    table: Dict[str, int] = {}
+    return np.fromiter(
+        ((table.setdefault(u, len(table)) if u else -1) for u in (m.get("url") or "" for m in metas)),
+        dtype=np.int32, count=len(metas),
+    )
+
+
+def cap_per_group(groups: np.ndarray, cap: int) -> np.ndarray:
+    """
+    Boolean mask keeping the first `cap` entries of every group, in list
+    order; entries of group -1 are never kept
+    """
+    n = groups.shape[0]
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+    # occurrence number of each entry within its group: stable sort by group,
+    # then subtract the start of each run
+    order = np.argsort(groups, kind="stable")
+    g = groups[order]
+    starts = np.concatenate([[0], np.flatnonzero(g[1:] != g[:-1]) + 1])
+    run = np.arange(n) - np.repeat(starts, np.diff(np.append(starts, n)))
+    occ = np.empty(n, dtype=np.int64)
+    occ[order] = run
+    return (occ < cap) & (groups >= 0)
+
+
+def select_diverse(ids: np.ndarray, scores: np.ndarray, groups: np.ndarray,
+                   topk: int, max_per_url: int, E: Optional[np.ndarray] = None,
+                   mmr_lambda: float = 1.0) -> np.ndarray:
+    """
+    Positions (into ids) of up to topk candidates, in selection order.
+
+    Args:
+        ids, scores: Candidates in descending score order
+        groups: URL id of each candidate (-1 = no URL, skipped)
+        max_per_url: At most this many candidates per URL
+        E: Embedding rows, needed for MMR
+        mmr_lambda: 1.0 keeps score order; lower values trade relevance for
+                    dissimilarity to the already selected candidates
+    """
+    if mmr_lambda >= 1.0 or E is None:
+        return np.flatnonzero(cap_per_group(groups, max_per_url))[:topk]
+
+    pos = np.flatnonzero(groups >= 0)
+    if pos.size == 0:
+        return pos
+    V = np.asarray(E[ids[pos]], dtype=np.float32)
+    sims = V @ V.T
+    rel = scores[pos].astype(np.float64)
+    rng = rel.max() - rel.min()
+    rel = (rel - rel.min()) / rng if rng > 1e-8 else np.zeros_like(rel)
+
+    _, group = np.unique(groups[pos], return_inverse=True)
+    counts = np.zeros(group.max() + 1, dtype=np.int64)
+    available = np.ones(pos.size, dtype=bool)
+    max_sim = np.zeros(pos.size, dtype=np.float64)
+    picked = []
+    for _ in range(min(topk, pos.size)):
+        mmr = mmr_lambda * rel - (1 - mmr_lambda) * max_sim
+        mmr[~available] = -np.inf
+        j = int(np.argmax(mmr))
+        if not available[j]:
+            break
+        picked.append(j)
+        available[j] = False
+        counts[group[j]] += 1
+        if counts[group[j]] >= max_per_url:
+            available &= group != group[j]
+        max_sim = sims[:, j] if len(picked) == 1 else np.maximum(max_sim, sims[:, j])
+    return pos[np.array(picked, dtype=np.int64)]
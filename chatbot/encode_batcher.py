@@ -0,0 +1,118 @@
+"""
+Request-coalescing wrapper around a query encoder
+
+Concurrent encode() calls (one per web request) are queued; a worker thread
+takes whatever arrives within max_wait_ms of the first call, up to
+max_batch texts, runs them through the encoder as one batch and hands each
+caller its own rows.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List
+
+import numpy as np
+
+
+class BatchingEncoder:
+    def __init__(self, encoder, max_batch: int = 32, max_wait_ms: float = 2.0):
+        """
+        Args:
+            encoder: SentenceTransformer / OnnxEncoder (anything with
+                     encode(texts, normalize_embeddings=...))
+            max_batch: Most texts encoded together (a single larger call is
+                       still encoded in one go)
+            max_wait_ms: How long the first queued call waits for others
+        """
+        self.encoder = encoder
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.calls = 0
+        self.batches = 0
+        self.texts = 0
+        self.max_seen = 0
+        self.batch_sizes: Dict[int, int] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        # encoder attributes (e.g. OnnxEncoder.name) pass through
+        if name == "encoder":
+            raise AttributeError(name)
+        return getattr(self.encoder, name)
+
+    def _ensure_worker(self) -> None:
+        # started lazily: threads don't survive a fork, so each prefork worker starts its own
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="encode-batcher", daemon=True)
+                self._thread.start()
+
+    def encode(self, texts: List[str], normalize_embeddings: bool = True, **kwargs) -> np.ndarray:
+        if isinstance(texts, str):
+            texts = [texts]
+        if not texts:
+            return np.asarray(self.encoder.encode([], normalize_embeddings=normalize_embeddings),
+                              dtype=np.float32)
+        self._ensure_worker()
+        fut: Future = Future()
+        self._queue.put((list(texts), bool(normalize_embeddings), fut))
+        return fut.result()
+
+    def _run(self) -> None:
+        while True:
+            pending = [self._queue.get()]
+            size = len(pending[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                pending.append(item)
+                size += len(item[0])
+
+            for normalize in (True, False):
+                group = [p for p in pending if p[1] == normalize]
+                if group:
+                    self._encode_group(group, normalize)
+
+    def _encode_group(self, group: List[tuple], normalize: bool) -> None:
+        texts = [t for p in group for t in p[0]]
+        try:
+            embs = np.asarray(self.encoder.encode(texts, normalize_embeddings=normalize), dtype=np.float32)
+        except Exception as e:
+            for _, _, fut in group:
+                fut.set_exception(e)
+            return
+
+        with self._lock:
+            self.calls += len(group)
+            self.batches += 1
+            self.texts += len(texts)
+            self.max_seen = max(self.max_seen, len(texts))
+            self.batch_sizes[len(texts)] = self.batch_sizes.get(len(texts), 0) + 1
+
+        lo = 0
+        for p in group:
+            p[2].set_result(embs[lo:lo + len(p[0])])
+            lo += len(p[0])
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_batch": self.max_batch,
+                "max_wait_ms": self.max_wait * 1000.0,
+                "calls": self.calls,
+                "batches": self.batches,
+                "texts": self.texts,
+                "mean_batch_size": self.texts / self.batches if self.batches else 0.0,
+                "max_batch_size": self.max_seen,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                "queued": self._queue.qsize(),
+            }
@@ -0,0 +1,132 @@
+# python ./chatbot/eval_dense_index.py --emb ./data/cis_emb.npy --backend ivf --index ./data/cis_ivf --nprobe 1 4 8 16 32
+# python ./chatbot/eval_dense_index.py --emb ./data/cis_emb.npy --backend int8 --index ./data/cis_quant --rescore 1 2 4 8
+# python ./chatbot/eval_dense_index.py --emb ./data/cis_emb.npy --backend pca --index ./data/cis_pca --rescore 2 4 8
+# OMP_NUM_THREADS=1 python ./chatbot/eval_dense_index.py --backend binary --index ./data/cis_binary --rescore 10 30 100
+"""
+Recall@k, latency and memory of an approximate dense backend against brute-force E @ q
+
+Queries come from the chat log (chatbot_interactions.jsonl) when available,
+otherwise noisy copies of random corpus rows are used as pseudo-queries.
+Run with OMP_NUM_THREADS=1 to compare throughput per core.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from dense_index import IVFIndex, QuantizedIndex, BinaryIndex, PCAIndex
+
+
+def read_logged_queries(path: str, limit: int):
+    queries = []
+    seen = set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            q = (json.loads(line).get("query") or "").strip()
+            if q and q not in seen:
+                seen.add(q)
+                queries.append(q)
+    return queries[-limit:]
+
+
+def pseudo_queries(E: np.ndarray, n: int, noise: float, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    Q = np.asarray(E[rng.choice(E.shape[0], size=min(n, E.shape[0]), replace=False)], dtype=np.float32)
+    Q = Q + noise * rng.standard_normal(Q.shape).astype(np.float32) / np.sqrt(Q.shape[1])
+    return (Q / np.linalg.norm(Q, axis=1, keepdims=True)).astype(np.float32)
+
+
+def exact_topk(E: np.ndarray, q: np.ndarray, k: int) -> np.ndarray:
+    sims = E @ q
+    idx = np.argpartition(-sims, k - 1)[:k]
+    return idx[np.argsort(-sims[idx])]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--emb", default="./data/cis_emb.npy")
+    ap.add_argument("--backend", default="ivf", choices=["ivf", "int8", "float16", "binary", "pca"])
+    ap.add_argument("--index", default=None, help="persisted index (built in memory if missing)")
+    ap.add_argument("--log", default="./data/chatbot_interactions.jsonl")
+    ap.add_argument("--model", default="intfloat/multilingual-e5-small")
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--noise", type=float, default=0.5, help="pseudo-query noise when no log is available")
+    ap.add_argument("--k", type=int, default=10)
+    ap.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    ap.add_argument("--n_lists", type=int, default=0)
+    ap.add_argument("--rescore", type=int, nargs="+", default=[1, 2, 4, 8],
+                    help="int8/float16/binary/pca: shortlist size as a multiple of k")
+    ap.add_argument("--pca_dim", type=int, default=128, help="pca: dimension when building in memory")
+    args = ap.parse_args()
+
+    E = np.load(args.emb, mmap_mode="r")
+    E = np.ascontiguousarray(E, dtype=np.float32)
+
+    if os.path.exists(args.log):
+        from sentence_transformers import SentenceTransformer
+        texts = read_logged_queries(args.log, args.queries)
+        model = SentenceTransformer(args.model)
+        Q = model.encode(["query: " + q for q in texts], normalize_embeddings=True).astype(np.float32)
+        print(f"{len(Q)} queries from {args.log}")
+    else:
+        Q = pseudo_queries(E, args.queries, args.noise)
+        print(f"{len(Q)} pseudo-queries (no log at {args.log})")
+
+    if args.backend == "ivf":
+        index_path = args.index or "./data/cis_ivf"
+        index = IVFIndex.load(index_path, E)
+        if index is None:
+            print(f"No index at {index_path}, building one in memory...")
+            index = IVFIndex.build(E, n_lists=args.n_lists or None)
+        print(f"rows={E.shape[0]} dim={E.shape[1]} lists={index.n_lists}  k={args.k}")
+        knob = "nprobe"
+        settings = [(v, lambda q, v=v: index.search(q, args.k, nprobe=v)) for v in args.nprobe]
+    else:
+        if args.backend == "binary":
+            index_path = args.index or "./data/cis_binary"
+            index = BinaryIndex.load(index_path, E)
+        elif args.backend == "pca":
+            index_path = args.index or "./data/cis_pca"
+            index = PCAIndex.load(index_path, E)
+        else:
+            index_path = args.index or "./data/cis_quant"
+            index = QuantizedIndex.load(index_path, E, args.backend)
+        if index is None:
+            print(f"No {args.backend} index at {index_path}, building one in memory...")
+            if args.backend == "binary":
+                index = BinaryIndex.build(E)
+            elif args.backend == "pca":
+                index = PCAIndex.build(E, dim=args.pca_dim)
+            else:
+                index = QuantizedIndex.build(E, kind=args.backend)
+        reduced = f" -> {index.dim}" if args.backend == "pca" else ""
+        print(f"rows={E.shape[0]} dim={E.shape[1]}{reduced}  k={args.k}")
+        print(f"memory: {args.backend} {index.nbytes / 2**20:.1f} MiB vs float32 "
+              f"{E.nbytes / 2**20:.1f} MiB (saved {1 - index.nbytes / E.nbytes:.0%})")
+        knob = "rescore"
+
+        def search_with(v):
+            def fn(q):
+                index.rescore = v
+                return index.search(q, args.k)
+            return fn
+        settings = [(v, search_with(v)) for v in args.rescore]
+
+    start = time.perf_counter()
+    truth = [exact_topk(E, q, args.k) for q in Q]
+    t_exact = (time.perf_counter() - start) * 1000 / len(Q)
+
+    print(f"{knob:>7} {'recall@k':>9} {'ms/q':>8} {'q/s':>8} {'exact ms/q':>11} {'exact q/s':>10} {'speedup':>8}")
+    for value, search in settings:
+        start = time.perf_counter()
+        found = [search(q[None, :])[1][0] for q in Q]
+        t_ann = (time.perf_counter() - start) * 1000 / len(Q)
+        recall = np.mean([len(set(f.tolist()) & set(t.tolist())) / args.k for f, t in zip(found, truth)])
+        print(f"{value:>7} {recall:>9.3f} {t_ann:>8.2f} {1000 / t_ann:>8.1f} "
+              f"{t_exact:>11.2f} {1000 / t_exact:>10.1f} {t_exact / t_ann:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# python ./chatbot/eval_onnx_encoder.py --onnx ./data/e5_onnx/model.onnx ./data/e5_onnx/model_int8.onnx
+# OMP_NUM_THREADS=1 python ./chatbot/eval_onnx_encoder.py --threads 1
+"""
+Parity and per-query latency of the ONNX encoder against SentenceTransformer
+
+Parity: cosine between the PyTorch and ONNX embeddings of the same inputs
+(queries and corpus passages), and overlap of the top-k chunks they retrieve
+from cis_emb.npy. Latency: one query per encode() call, as in the web app.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from onnx_encoder import OnnxEncoder
+from eval_dense_index import read_logged_queries
+
+FALLBACK_QUERIES = [
+    "מה שכר הלימוד לתואר שני במדעי המחשב?",
+    "מתי מועד אחרון להרשמה?",
+    "תנאי קבלה לתואר ראשון",
+    "who is the head of the computer science department?",
+    "office hours of the faculty secretary",
+]
+
+
+def read_passages(meta_path: str, limit: int):
+    out = []
+    with open(meta_path, "r", encoding="utf-8") as f:
+        for line in f:
+            text = (json.loads(line).get("text") or "").strip()
+            if text:
+                out.append("passage: " + text)
+            if len(out) >= limit:
+                break
+    return out
+
+
+def per_query_ms(encoder, texts, repeat: int) -> np.ndarray:
+    encoder.encode(texts[:1], normalize_embeddings=True)  # warm-up
+    times = []
+    for _ in range(repeat):
+        for t in texts:
+            start = time.perf_counter()
+            encoder.encode([t], normalize_embeddings=True)
+            times.append((time.perf_counter() - start) * 1000)
+    return np.array(times)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model", default="intfloat/multilingual-e5-small")
+    ap.add_argument("--onnx", nargs="+", default=["./data/e5_onnx/model.onnx"])
+    ap.add_argument("--emb", default="./data/cis_emb.npy")
+    ap.add_argument("--meta", default="./data/cis_meta.jsonl")
+    ap.add_argument("--log", default="./data/chatbot_interactions.jsonl")
+    ap.add_argument("--queries", type=int, default=100)
+    ap.add_argument("--passages", type=int, default=100)
+    ap.add_argument("--k", type=int, default=10)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--threads", type=int, default=0, help="ONNX Runtime / torch threads (0 = default)")
+    args = ap.parse_args()
+
+    from sentence_transformers import SentenceTransformer
+    if args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+
+    queries = read_logged_queries(args.log, args.queries) if os.path.exists(args.log) else FALLBACK_QUERIES
+    queries = ["query: " + q for q in queries]
+    passages = read_passages(args.meta, args.passages) if os.path.exists(args.meta) else []
+    E = np.load(args.emb, mmap_mode="r") if os.path.exists(args.emb) else None
+    print(f"{len(queries)} queries, {len(passages)} passages")
+
+    torch_model = SentenceTransformer(args.model)
+    ref_q = np.asarray(torch_model.encode(queries, normalize_embeddings=True), dtype=np.float32)
+    ref_p = (np.asarray(torch_model.encode(passages, normalize_embeddings=True), dtype=np.float32)
+             if passages else None)
+    t_torch = per_query_ms(torch_model, queries, args.repeat)
+
+    print(f"{'encoder':>18} {'min cos':>8} {'mean cos':>9} {'top-k overlap':>14} "
+          f"{'p50 ms':>7} {'p95 ms':>7} {'speedup':>8}")
+    print(f"{'torch':>18} {1.0:>8.4f} {1.0:>9.4f} {1.0:>14.3f} "
+          f"{np.percentile(t_torch, 50):>7.2f} {np.percentile(t_torch, 95):>7.2f} {1.0:>8.1f}")
+    for path in args.onnx:
+        encoder = OnnxEncoder(path, threads=args.threads or None)
+        q = encoder.encode(queries, normalize_embeddings=True)
+        cos = (q * ref_q).sum(axis=1)
+        if ref_p is not None:
+            cos = np.concatenate([cos, (encoder.encode(passages, normalize_embeddings=True) * ref_p).sum(axis=1)])
+        overlap = float("nan")
+        if E is not None:
+            k = min(args.k, E.shape[0])
+            overlaps = []
+            for a, b in zip(ref_q, q):
+                ta = np.argpartition(-(E @ a), k - 1)[:k]
+                tb = np.argpartition(-(E @ b), k - 1)[:k]
+                overlaps.append(len(set(ta.tolist()) & set(tb.tolist())) / k)
+            overlap = float(np.mean(overlaps))
+        t = per_query_ms(encoder, queries, args.repeat)
+        print(f"{encoder.name:>18} {cos.min():>8.4f} {cos.mean():>9.4f} {overlap:>14.3f} "
+              f"{np.percentile(t, 50):>7.2f} {np.percentile(t, 95):>7.2f} "
+              f"{np.percentile(t_torch, 50) / np.percentile(t, 50):>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
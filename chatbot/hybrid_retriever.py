@@ -1,95 +1,358 @@
 """
 Hybrid retriever combining BM25 (keyword) and dense (semantic) search
 """
+import hashlib
+import time
 import numpy as np
-from typing import List, Dict, Tuple, Any
-from sentence_transformers import SentenceTransformer
-from rank_bm25 import BM25Okapi
-import re
+from typing import List, Dict, Tuple, Any, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # only for annotations: the ONNX encoder path runs without PyTorch
+    from sentence_transformers import SentenceTransformer
+
+try:
+    from chatbot.bm25_index import BM25Index, tokenize, corpus_fingerprint
+    from chatbot.hebrew_utils import expand_hebrew_query
+    from chatbot.dense_index import load_dense_index
+    from chatbot.query_cache import EmbeddingCache, ResultCache, normalize_query_text
+    from chatbot.meta_filters import MetaFilters, filter_key
+    from chatbot.diversity import cap_per_group, select_diverse
+    from chatbot.meta_store import MetaStore
+except Exception:
+    from bm25_index import BM25Index, tokenize, corpus_fingerprint
+    from hebrew_utils import expand_hebrew_query
+    from dense_index import load_dense_index
+    from query_cache import EmbeddingCache, ResultCache, normalize_query_text
+    from meta_filters import MetaFilters, filter_key
+    from diversity import cap_per_group, select_diverse
+    from meta_store import MetaStore
+
+def _top(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Best k (ids, scores) of a score vector, descending"""
+    k = min(k, len(scores))
+    top_idx = np.argpartition(-scores, k - 1)[:k]
+    top_idx = top_idx[np.argsort(-scores[top_idx])]
+    return top_idx, scores[top_idx]
+
+
+def _minmax(scores: np.ndarray) -> np.ndarray:
+    """Normalize to [0, 1] (all zeros if the scores are flat)"""
+    if scores.size == 0:
+        return scores
+    min_s, max_s = scores.min(), scores.max()
+    if max_s - min_s < 1e-8:
+        return np.zeros_like(scores)
+    return (scores - min_s) / (max_s - min_s)
+
 
 class HybridRetriever:
     def __init__(self, E: np.ndarray, metas: List[Dict[str, Any]], 
-                 embed_model: SentenceTransformer, alpha: float = 0.5):
+                 embed_model: "SentenceTransformer", alpha: float = 0.5,
+                 bm25_path: Optional[str] = None,
+                 dense_backend: str = "exact", dense_path: Optional[str] = None,
+                 nprobe: int = 8, rescore: int = 4, dense_candidates: int = 200,
+                 query_cache: Optional[EmbeddingCache] = None,
+                 result_cache: Optional[ResultCache] = None,
+                 fusion: str = "minmax", rrf_k: int = 60, mmr_lambda: float = 1.0):
         """
         Args:
             E: Normalized embeddings (N x D)
-            metas: Metadata for each embedding
-            embed_model: SentenceTransformer model
+            metas: Metadata for each embedding (list of dicts or a MetaStore)
+            embed_model: SentenceTransformer model, or any encoder with the same
+                         encode(texts, normalize_embeddings=True) (e.g. OnnxEncoder)
             alpha: Weight for dense retrieval (0-1). 
                    1.0 = only dense, 0.0 = only BM25, 0.5 = balanced
+            bm25_path: Prebuilt BM25 index directory (from build_index.py).
+                       Rebuilt in memory if missing or stale.
+            dense_backend: "exact" (brute-force E @ q), "ivf", "int8",
+                           "float16", "binary" or "pca" (loaded from
+                           dense_path; falls back to exact if missing or stale)
+            nprobe: IVF lists probed per query
+            rescore: Quantized/binary/PCA backends rescore the best
+                     dense_candidates * rescore rows in float32
+            dense_candidates: Candidates the approximate backend returns per query
+            query_cache: Optional LRU of query embeddings; repeated queries
+                         skip the encoder
+            result_cache: Optional cache of retrieve/retrieve_many results,
+                          cleared when it was filled from another index
+            fusion: How dense and BM25 scores are combined (alpha weights the
+                    dense side in every mode):
+                    "minmax" - min-max normalize both over all N chunks
+                    "rrf" - reciprocal rank fusion of each side's top
+                            dense_candidates
+                    "candidates" - min-max normalize within each side's top
+                                   dense_candidates
+            rrf_k: Rank offset of reciprocal rank fusion
+            mmr_lambda: Maximal marginal relevance weight of the final
+                        selection; 1.0 = score order, lower values prefer
+                        chunks dissimilar to those already selected
         """
         self.E = E
         self.metas = metas
         self.embed_model = embed_model
         self.alpha = alpha
+        self.query_cache = query_cache
+        self.result_cache = result_cache
+        if fusion not in ("minmax", "rrf", "candidates"):
+            raise ValueError(f"Unknown fusion mode: {fusion}")
+        self.fusion = fusion
+        self.rrf_k = rrf_k
+        self.mmr_lambda = mmr_lambda
         
-        print("Building BM25 index...")
-        tokenized_docs = [self._tokenize(m['text']) for m in metas]
-        self.bm25 = BM25Okapi(tokenized_docs)
-        print(f"BM25 index built with {len(tokenized_docs)} documents")
+        if isinstance(metas, MetaStore):
+            # fingerprint recorded by build_index.py; texts decoded only for a BM25 rebuild
+            texts = None
+            fingerprint = metas.fingerprint
+        else:
+            texts = [m.get('text') or '' for m in metas]
+            fingerprint = corpus_fingerprint(texts)
+
+        self.bm25 = None
+        if bm25_path:
+            start = time.time()
+            self.bm25 = BM25Index.load(bm25_path, fingerprint=fingerprint)
+            if self.bm25 is not None:
+                print(f"Loaded BM25 index from {bm25_path} "
+                      f"({len(self.bm25.vocab)} terms, {(time.time() - start) * 1000:.0f} ms)")
+            else:
+                print(f"BM25 index at {bm25_path} is missing or stale, rebuilding")
+
+        if self.bm25 is None:
+            print("Building BM25 index...")
+            if texts is None:
+                texts = metas.texts()
+            tokenized_docs = [self._tokenize(t) for t in texts]
+            self.bm25 = BM25Index.build(tokenized_docs, fingerprint=fingerprint)
+            print(f"BM25 index built with {len(tokenized_docs)} documents")
+
+        # Identifies this index (texts + a sample of embedding rows) for caches
+        h = hashlib.sha1(fingerprint.encode("utf-8"))
+        h.update(str(E.shape).encode("utf-8"))
+        h.update(np.ascontiguousarray(E[::max(1, E.shape[0] // 64)], dtype=np.float32).tobytes())
+        self.fingerprint = h.hexdigest()
+        if self.result_cache is not None:
+            self.result_cache.invalidate(self.fingerprint)
+
+        # integer columns for lang / sitemap / url / lastmod filters
+        self.meta_filters = MetaFilters.from_metas(metas)
+        # URL id per chunk for the per-URL cap (-1 = no URL, never selected)
+        has_url = np.array([bool(u) for u in self.meta_filters.url_table] + [False])
+        self.url_ids = np.where(has_url[self.meta_filters.url], self.meta_filters.url, -1)
+
+        self.dense_candidates = dense_candidates
+        self.dense_index = None
+        if dense_backend != "exact":
+            self.dense_index = load_dense_index(dense_backend, dense_path, E,
+                                                fingerprint=fingerprint, nprobe=nprobe,
+                                                rescore=rescore)
+            if self.dense_index is None:
+                print(f"Dense index ({dense_backend}) at {dense_path} is missing or stale, "
+                      f"using exact search")
     
     def _tokenize(self, text: str) -> List[str]:
         """Simple Hebrew-aware tokenization"""
-        # Remove punctuation, split on whitespace
-        text = re.sub(r'[^\w\s]', ' ', text.lower())
-        tokens = text.split()
-        # Keep tokens with at least 2 chars
-        return [t for t in tokens if len(t) >= 2]
+        return tokenize(text)
     
-    def retrieve(self, query: str, topk: int = 6, 
-                 max_per_url: int = 2) -> List[Tuple[float, Dict[str, Any]]]:
-        """
-        Hybrid retrieval combining BM25 and dense search
-        
-        Returns:
-            List of (combined_score, metadata) tuples
-        """
-        # 1. Dense retrieval (semantic)
-        q_emb = self.embed_model.encode(
-            [f"query: {query}"], 
+    def _encode_queries(self, queries: List[str]) -> np.ndarray:
+        """E5 query embeddings for a batch of queries (Q x D), one encoder call"""
+        texts = [f"query: {q}" for q in queries]
+        if self.query_cache is not None:
+            return self.query_cache.encode(self.embed_model, texts)
+        return np.asarray(self.embed_model.encode(
+            texts,
             normalize_embeddings=True
-        )[0].astype(np.float32)
-        dense_scores = self.E @ q_emb
+        ), dtype=np.float32)
+    
+    def encode_query(self, query: str) -> np.ndarray:
+        """E5 embedding of one query (D,); a query retrieve() just saw is a query-cache hit"""
+        return self._encode_queries([query])[0]
+    
+    def _dense_scores(self, q_embs: np.ndarray, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """Dense scores of every chunk for every query (Q x N)"""
+        if self.dense_index is None:
+            return q_embs @ self.E.T
+        
+        # Approximate backend: exact scores for its candidates, every other
+        # chunk gets the query's lowest candidate score (normalizes to 0)
+        k = min(self.dense_candidates, self.E.shape[0])
+        scores, ids = self.dense_index.search(q_embs, k, mask=mask)
+        valid = ids >= 0
+        floor = np.where(valid, scores, np.inf).min(axis=1, keepdims=True)
+        floor[~np.isfinite(floor)] = 0.0
+        dense = np.repeat(floor.astype(np.float32), self.E.shape[0], axis=1)
+        rows = np.nonzero(valid)[0]
+        dense[rows, ids[valid]] = scores[valid]
+        return dense
+    
+    def _combined_scores(self, queries: List[str], q_embs: np.ndarray,
+                         mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """Hybrid scores of every chunk for every query (Q x N), -inf outside mask"""
+        # 1. Dense retrieval (semantic), one matrix-matrix product for all queries
+        dense_scores = self._dense_scores(q_embs, mask)
         
         # 2. BM25 retrieval (keyword)
-        tokenized_query = self._tokenize(query)
-        bm25_scores = self.bm25.get_scores(tokenized_query)
+        bm25_scores = self.bm25.get_scores_many([self._tokenize(q) for q in queries])
         
-        # 3. Normalize scores to [0, 1]
+        # 3. Normalize each query's scores to [0, 1]
         def normalize(scores):
-            min_s, max_s = scores.min(), scores.max()
-            if max_s - min_s < 1e-8:
-                return np.zeros_like(scores)
-            return (scores - min_s) / (max_s - min_s)
+            min_s = scores.min(axis=1, keepdims=True)
+            rng = scores.max(axis=1, keepdims=True) - min_s
+            out = (scores - min_s) / np.where(rng < 1e-8, 1.0, rng)
+            out[(rng < 1e-8).ravel()] = 0.0
+            return out
         
         dense_norm = normalize(dense_scores)
         bm25_norm = normalize(bm25_scores)
         
         # 4. Combine scores
         combined = self.alpha * dense_norm + (1 - self.alpha) * bm25_norm
+        if mask is not None:
+            combined[:, ~mask] = -np.inf
+        return combined
+    
+    def _fused_candidates(self, queries: List[str], q_embs: np.ndarray, pool: int,
+                          mask: Optional[np.ndarray] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Fuse each side's top max(dense_candidates, pool) per query (rrf or
+        candidate-local min-max); never builds N-length combined arrays
+        """
+        k = min(max(self.dense_candidates, pool), self.E.shape[0])
+        if self.dense_index is not None:
+            dense_s, dense_i = self.dense_index.search(q_embs, k, mask=mask)
+        else:
+            dense_s = np.empty((len(queries), k), dtype=np.float32)
+            dense_i = np.empty((len(queries), k), dtype=np.int64)
+            for qi, row in enumerate(q_embs @ self.E.T):
+                if mask is not None:
+                    row[~mask] = -np.inf
+                dense_i[qi], dense_s[qi] = _top(row, k)
+            # chunks outside the mask may fill the tail when few match
+            dense_i[~np.isfinite(dense_s)] = -1
         
-        # 5. Get top-k with URL deduplication
-        k = min(topk * 4, len(combined))
-        top_idx = np.argpartition(-combined, k - 1)[:k]
-        top_idx = top_idx[np.argsort(-combined[top_idx])]
-        
-        picked = []
-        per_url = {}
-        
-        for i in top_idx:
-            m = self.metas[i]
-            url = m.get("url", "")
-            if not url:
-                continue
-            
-            per_url.setdefault(url, 0)
-            if per_url[url] >= max_per_url:
-                continue
+        out = []
+        for qi, q in enumerate(queries):
+            valid = dense_i[qi] >= 0
+            d_ids, d_scores = dense_i[qi][valid], dense_s[qi][valid].astype(np.float64)
+            b_ids, b_scores = self.bm25.get_top(self._tokenize(q), k, mask=mask)
             
-            picked.append((float(combined[i]), m))
-            per_url[url] += 1
+            if self.fusion == "rrf":
+                d_part = self.alpha / (self.rrf_k + 1 + np.arange(d_ids.shape[0]))
+                b_part = (1 - self.alpha) / (self.rrf_k + 1 + np.arange(b_ids.shape[0]))
+            else:
+                d_part = self.alpha * _minmax(d_scores)
+                b_part = (1 - self.alpha) * _minmax(b_scores)
             
-            if len(picked) >= topk:
+            # sum the two contributions of chunks found by both sides
+            ids, inv = np.unique(np.concatenate([d_ids, b_ids]), return_inverse=True)
+            scores = np.bincount(inv, weights=np.concatenate([d_part, b_part]), minlength=ids.shape[0])
+            order = np.argsort(-scores, kind="stable")
+            out.append((ids[order], scores[order]))
+        return out
+    
+    def _ranked(self, queries: List[str], q_embs: np.ndarray, pool: int,
+                mask: Optional[np.ndarray]) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Per query best ~pool (chunk ids, scores) in descending score order"""
+        if self.fusion != "minmax":
+            return self._fused_candidates(queries, q_embs, pool, mask)
+        out = []
+        for row in self._combined_scores(queries, q_embs, mask):
+            ids, scores = _top(row, pool)
+            keep = np.isfinite(scores)
+            out.append((ids[keep], scores[keep]))
+        return out
+    
+    def _candidates(self, queries: List[str], topk: int, max_per_url: int,
+                    filters: Optional[Dict[str, Any]] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Per query (chunk ids, scores) in descending score order, enough of
+        them to fill topk under the per-URL cap whenever the corpus can
+        """
+        mask = self.meta_filters.mask(filters)
+        if mask is not None and not mask.any():
+            return [(np.zeros(0, dtype=np.int64), np.zeros(0)) for _ in queries]
+        q_embs = self._encode_queries(queries)
+        pool = topk * 4
+        out = self._ranked(queries, q_embs, pool, mask)
+        
+        # a few URLs can crowd the overfetched pool; widen it for those queries
+        n_allowed = self.E.shape[0] if mask is None else int(mask.sum())
+        while pool < n_allowed:
+            short = [i for i, (ids, _) in enumerate(out)
+                     if cap_per_group(self.url_ids[ids], max_per_url).sum() < topk]
+            if not short:
                 break
+            pool *= 4
+            wider = self._ranked([queries[i] for i in short], q_embs[short], pool, mask)
+            for i, c in zip(short, wider):
+                out[i] = c
+        return out
+    
+    def _select(self, ids: np.ndarray, scores: np.ndarray, topk: int,
+                max_per_url: int) -> List[Tuple[float, Dict[str, Any]]]:
+        """Top-k of ranked candidates under the per-URL cap (and MMR if enabled)"""
+        pos = select_diverse(ids, scores, self.url_ids[ids], topk, max_per_url,
+                             E=self.E, mmr_lambda=self.mmr_lambda)
+        return [(float(scores[p]), self.metas[int(ids[p])]) for p in pos.tolist()]
+    
+    def retrieve(self, query: str, topk: int = 6, max_per_url: int = 2,
+                 filters: Optional[Dict[str, Any]] = None) -> List[Tuple[float, Dict[str, Any]]]:
+        """
+        Hybrid retrieval combining BM25 and dense search
+        
+        Args:
+            filters: Optional metadata filter, e.g. {"lang": "he",
+                     "sitemap": "staff", "url_prefix": "https://...",
+                     "since": "2024-01-01", "until": "2024-12-31"};
+                     see MetaFilters.mask
         
-        return picked
\ No newline at end of file
+        Returns:
+            List of (combined_score, metadata) tuples
+        """
+        return self.retrieve_many([query], topk=topk, max_per_url=max_per_url, filters=filters)[0]
+    
+    def retrieve_many(self, queries: List[str], topk: int = 6, max_per_url: int = 2,
+                      filters: Optional[Dict[str, Any]] = None) -> List[List[Tuple[float, Dict[str, Any]]]]:
+        """
+        Batched hybrid retrieval: one encoder batch, one E matmul and one
+        BM25 pass for all queries (filters apply to every query)
+        
+        Returns:
+            Per-query lists of (combined_score, metadata) tuples
+        """
+        if not queries:
+            return []
+        if self.result_cache is None:
+            return [self._select(ids, scores, topk, max_per_url)
+                    for ids, scores in self._candidates(queries, topk, max_per_url, filters)]
+        
+        fkey = filter_key(filters)
+        keys = [(normalize_query_text(q), topk, max_per_url, self.alpha, self.fusion, self.mmr_lambda,
+                 fkey, self.fingerprint)
+                for q in queries]
+        results = [self.result_cache.get(key) for key in keys]
+        missing = [i for i, r in enumerate(results) if r is None]
+        if missing:
+            candidates = self._candidates([queries[i] for i in missing], topk, max_per_url, filters)
+            for i, (ids, scores) in zip(missing, candidates):
+                results[i] = self._select(ids, scores, topk, max_per_url)
+                self.result_cache.put(keys[i], results[i])
+        # callers get their own list; metadata dicts are shared and read-only
+        return [list(r) for r in results]
+    
+    def retrieve_expanded(self, query: str, topk: int = 6, max_per_url: int = 2,
+                          filters: Optional[Dict[str, Any]] = None) -> List[Tuple[float, Dict[str, Any]]]:
+        """
+        Retrieval over the Hebrew morphological variants of the query
+        (prefix/plural stripping), scored together; each chunk keeps its
+        best score across variants
+        """
+        variants = expand_hebrew_query(query)
+        candidates = self._candidates(variants, topk, max_per_url, filters)
+        ids = np.concatenate([c[0] for c in candidates])
+        scores = np.concatenate([c[1] for c in candidates])
+        # sort by score, then keep the first (best) occurrence of each chunk
+        order = np.argsort(-scores, kind="stable")
+        ids, scores = ids[order], scores[order]
+        _, first = np.unique(ids, return_index=True)
+        first = np.sort(first)
+        return self._select(ids[first], scores[first], topk, max_per_url)
@@ -0,0 +1,47 @@
+"""
+Versioned index layout for hot reloads
+
+    data/index/<version>/   cis_emb.npy, cis_meta.jsonl, cis_meta_store/, cis_bm25/, ...
+    data/index/CURRENT      name of the version the app should serve
+
+build_index.py --version writes a complete version directory and then
+points CURRENT at it; the running app picks it up on reload.
+"""
+import os
+from typing import Dict, Optional
+
+
+def version_dir(index_root: str, version: str) -> str:
+    """Directory of a version; names are plain directory names (no paths)"""
+    if not version or version in (".", "..") or os.path.basename(version) != version:
+        raise ValueError(f"Invalid index version: {version!r}")
+    return os.path.join(index_root, version)
+
+
+def read_current(index_root: str) -> Optional[str]:
+    """Version CURRENT points at (None if there is none)"""
+    try:
+        with open(os.path.join(index_root, "CURRENT"), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_current(index_root: str, version: str) -> None:
+    """Point CURRENT at version (temp file + rename, so readers never see a partial name)"""
+    if not os.path.isdir(version_dir(index_root, version)):
+        raise ValueError(f"No index directory for version {version!r} under {index_root}")
+    tmp = os.path.join(index_root, "CURRENT.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(version + "\n")
+    os.replace(tmp, os.path.join(index_root, "CURRENT"))
+
+
+def index_paths(index_dir: str) -> Dict[str, str]:
+    """Standard file names inside one index directory"""
+    return {
+        "emb_path": os.path.join(index_dir, "cis_emb.npy"),
+        "meta_path": os.path.join(index_dir, "cis_meta.jsonl"),
+        "bm25_path": os.path.join(index_dir, "cis_bm25"),
+        "meta_store_path": os.path.join(index_dir, "cis_meta_store"),
+    }
@@ -0,0 +1,159 @@
+"""
+Vectorized metadata filters (language, URL prefix, sitemap, freshness)
+
+Per-field integer code columns are built once at load time, so a filter
+becomes a boolean mask over all chunks computed with NumPy instead of a
+Python scan of the metadata dicts.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    from chatbot.meta_store import MetaStore
+except Exception:
+    from meta_store import MetaStore
+
+FILTER_KEYS = ("lang", "sitemap", "url_prefix", "since", "until")
+
+MISSING_DAY = np.iinfo(np.int32).min
+
+
+def sitemap_name(source_sitemap: Optional[str]) -> str:
+    """".../staff-sitemap.xml" -> "staff" ("manual" and other values kept as is)"""
+    name = os.path.basename((source_sitemap or "").rstrip("/"))
+    for suffix in (".xml", "-sitemap"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
+def to_day(value: Optional[str]) -> int:
+    """ISO date/datetime string -> days since 1970-01-01 (MISSING_DAY if unparsable)"""
+    try:
+        return int(np.datetime64((value or "")[:10], "D").astype(np.int64))
+    except (ValueError, TypeError):
+        return int(MISSING_DAY)
+
+
+def _intern(values: Sequence[str]):
+    """(codes array, table) with table[codes[i]] == values[i]"""
+    table: Dict[str, int] = {}
+    codes = np.fromiter((table.setdefault(v, len(table)) for v in values),
+                        dtype=np.int32, count=len(values))
+    return codes, list(table)
+
+
+def _recode(codes: np.ndarray, table: List[str], fn):
+    """Interned column of fn(value) from a MetaStore column (code -1 = None)"""
+    mapped, new_table = _intern([fn(v) for v in list(table) + [None]])
+    # code -1 picks the trailing None entry
+    return mapped[codes], new_table
+
+
+def _as_list(value) -> List[str]:
+    if isinstance(value, (list, tuple, set)):
+        return [str(v) for v in value]
+    return [str(value)]
+
+
+def filter_key(filters: Optional[Dict[str, Any]]):
+    """Hashable, order-independent form of a filter dict (None if empty)"""
+    if not filters:
+        return None
+    return tuple(sorted((k, tuple(_as_list(v))) for k, v in filters.items() if v is not None)) or None
+
+
+class MetaFilters:
+    def __init__(self, lang: np.ndarray, lang_table: List[str],
+                 sitemap: np.ndarray, sitemap_table: List[str],
+                 url: np.ndarray, url_table: List[str],
+                 lastmod_day: np.ndarray, cache_size: int = 64):
+        self.lang, self.lang_table = lang, lang_table
+        self.sitemap, self.sitemap_table = sitemap, sitemap_table
+        self.url, self.url_table = url, url_table
+        self.lastmod_day = lastmod_day
+        self.cache_size = cache_size
+        self._masks: "OrderedDict[Any, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_metas(cls, metas: Sequence[Dict[str, Any]], **kwargs) -> "MetaFilters":
+        if isinstance(metas, MetaStore):
+            return cls.from_store(metas, **kwargs)
+        lang, lang_table = _intern([m.get("lang") or "" for m in metas])
+        sitemap, sitemap_table = _intern([sitemap_name(m.get("source_sitemap")) for m in metas])
+        url, url_table = _intern([m.get("url") or "" for m in metas])
+        lastmod_day = np.fromiter((to_day(m.get("lastmod")) for m in metas),
+                                  dtype=np.int32, count=len(metas))
+        return cls(lang, lang_table, sitemap, sitemap_table, url, url_table, lastmod_day, **kwargs)
+
+    @classmethod
+    def from_store(cls, store: MetaStore, **kwargs) -> "MetaFilters":
+        """Same columns, recoded from the store's interned tables (no row is decoded)"""
+        lang, lang_table = _recode(*store.column("lang"), lambda v: v or "")
+        sitemap, sitemap_table = _recode(*store.column("source_sitemap"), sitemap_name)
+        url, url_table = _recode(*store.column("url"), lambda v: v or "")
+        codes, table = store.column("lastmod")
+        days = np.array([to_day(v) for v in table] + [MISSING_DAY], dtype=np.int32)
+        return cls(lang, lang_table, sitemap, sitemap_table, url, url_table, days[codes], **kwargs)
+
+    def _codes_mask(self, codes: np.ndarray, table: List[str], wanted: List[str]) -> np.ndarray:
+        lookup = np.zeros(len(table) + 1, dtype=bool)
+        for i, v in enumerate(table):
+            lookup[i] = v in wanted
+        return lookup[codes]
+
+    def mask(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """
+        Boolean mask of chunks matching every given field (None = no filter).
+
+        filters keys:
+            lang: "he" / "non-he" (or a list)
+            sitemap: sitemap name, e.g. "staff", "page", "post" (or a list)
+            url_prefix: URL prefix (or a list of alternatives)
+            since / until: ISO dates, inclusive, on lastmod (chunks without
+                           lastmod never match)
+        """
+        key = filter_key(filters)
+        if key is None:
+            return None
+        unknown = set(filters) - set(FILTER_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown filter fields: {sorted(unknown)}")
+
+        with self._lock:
+            cached = self._masks.get(key)
+            if cached is not None:
+                self._masks.move_to_end(key)
+                return cached
+
+        out = np.ones(self.lang.shape[0], dtype=bool)
+        for field, values in key:
+            values = list(values)
+            if field == "lang":
+                out &= self._codes_mask(self.lang, self.lang_table, values)
+            elif field == "sitemap":
+                out &= self._codes_mask(self.sitemap, self.sitemap_table, values)
+            elif field == "url_prefix":
+                prefixes = tuple(values)
+                lookup = np.array([u.startswith(prefixes) for u in self.url_table] + [False])
+                out &= lookup[self.url]
+            elif field in ("since", "until"):
+                day = to_day(values[0])
+                if day == MISSING_DAY:
+                    raise ValueError(f"Invalid date for {field}: {values[0]}")
+                known = self.lastmod_day != MISSING_DAY
+                if field == "since":
+                    out &= known & (self.lastmod_day >= day)
+                else:
+                    out &= known & (self.lastmod_day <= day)
+
+        with self._lock:
+            self._masks[key] = out
+            while len(self._masks) > self.cache_size:
+                self._masks.popitem(last=False)
+        return out
@@ -0,0 +1,175 @@
+"""
+Columnar, memory-mapped chunk metadata (replaces the list of dicts read
+from cis_meta.jsonl)
+
+Written by extract_data/build_index.py as a directory:
+    text.bin / text_offsets.npy   utf-8 chunk texts and their N+1 byte offsets
+    chunk_id.npy / doc_id.npy     fixed-width byte strings
+    url.npy, title.npy, ...       int32 codes into tables.json (-1 = None)
+    meta.json                     written last; rows, fingerprints, format version
+
+The store records the corpus fingerprint and a hash of the cis_emb.npy it
+was built with, so a store left over from another build is not paired
+with the wrong embeddings just because the row counts happen to match.
+
+Only the rows that are actually read (the selected sources) are decoded
+into dicts; the texts stay in the page cache, shared by every worker.
+"""
+import hashlib
+import json
+import os
+from collections.abc import Sequence
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+ID_FIELDS = ("chunk_id", "doc_id")
+TABLE_FIELDS = ("url", "title", "lastmod", "lang", "source_sitemap")
+
+
+def file_fingerprint(path: str) -> str:
+    """sha1 of a file's bytes, read in blocks (not mapped, so nothing stays resident)"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def write_meta_store(path: str, metas: List[Dict[str, Any]], fingerprint: str, emb_fingerprint: str = "") -> None:
+    """
+    Persist metas (the rows of cis_meta.jsonl) in the columnar format;
+    emb_fingerprint: file_fingerprint() of the embeddings the rows belong to
+    """
+    os.makedirs(path, exist_ok=True)
+    # meta.json is written last: a half-written store is treated as missing
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    offsets = np.zeros(len(metas) + 1, dtype=np.int64)
+    with open(os.path.join(path, "text.bin"), "wb") as f:
+        for i, m in enumerate(metas):
+            data = (m.get("text") or "").encode("utf-8")
+            f.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+    np.save(os.path.join(path, "text_offsets.npy"), offsets)
+
+    for field in ID_FIELDS:
+        values = [(m.get(field) or "").encode("utf-8") for m in metas]
+        np.save(os.path.join(path, f"{field}.npy"), np.array(values, dtype=bytes))
+
+    tables: Dict[str, List[str]] = {}
+    for field in TABLE_FIELDS:
+        index: Dict[str, int] = {}
+        codes = np.fromiter(
+            (-1 if m.get(field) is None else index.setdefault(str(m.get(field)), len(index)) for m in metas),
+            dtype=np.int32, count=len(metas),
+        )
+        np.save(os.path.join(path, f"{field}.npy"), codes)
+        tables[field] = list(index)
+    with open(os.path.join(path, "tables.json"), "w", encoding="utf-8") as f:
+        json.dump(tables, f, ensure_ascii=False)
+
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "format_version": FORMAT_VERSION,
+            "kind": "meta",
+            "rows": len(metas),
+            "fingerprint": fingerprint,
+            "emb_fingerprint": emb_fingerprint,
+        }, f)
+
+
+class MetaStore(Sequence):
+    """
+    Read-only sequence of chunk metadata dicts backed by mmapped columns.
+    store[i] decodes one row; column() exposes the interned codes for
+    vectorized filtering without decoding anything.
+    """
+
+    def __init__(self, text_blob: np.ndarray, text_offsets: np.ndarray,
+                 ids: Dict[str, np.ndarray], codes: Dict[str, np.ndarray],
+                 tables: Dict[str, List[str]], fingerprint: str = ""):
+        self.text_blob = text_blob
+        self.text_offsets = text_offsets
+        self.ids = ids
+        self.codes = codes
+        self.tables = tables
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def load(cls, path: str, rows: Optional[int] = None, fingerprint: Optional[str] = None,
+             emb_path: Optional[str] = None) -> Optional["MetaStore"]:
+        """
+        Map a persisted store. Returns None if it is missing, was written by
+        another format version, doesn't match the given rows/fingerprint, or
+        was not built with the embeddings file at emb_path.
+        """
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format_version") != FORMAT_VERSION or meta.get("kind") != "meta":
+            return None
+        if rows is not None and meta.get("rows") != rows:
+            return None
+        if fingerprint is not None and meta.get("fingerprint") != fingerprint:
+            return None
+        if emb_path is not None and meta.get("emb_fingerprint") != file_fingerprint(emb_path):
+            return None
+
+        with open(os.path.join(path, "tables.json"), "r", encoding="utf-8") as f:
+            tables = json.load(f)
+        blob_path = os.path.join(path, "text.bin")
+        # np.memmap refuses empty files
+        if os.path.getsize(blob_path):
+            text_blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            text_blob = np.zeros(0, dtype=np.uint8)
+        return cls(
+            text_blob,
+            np.load(os.path.join(path, "text_offsets.npy"), mmap_mode="r"),
+            {f: np.load(os.path.join(path, f"{f}.npy"), mmap_mode="r") for f in ID_FIELDS},
+            {f: np.load(os.path.join(path, f"{f}.npy"), mmap_mode="r") for f in TABLE_FIELDS},
+            tables,
+            fingerprint=meta.get("fingerprint", ""),
+        )
+
+    def __len__(self) -> int:
+        return self.text_offsets.shape[0] - 1
+
+    def text(self, i: int) -> str:
+        lo, hi = int(self.text_offsets[i]), int(self.text_offsets[i + 1])
+        return self.text_blob[lo:hi].tobytes().decode("utf-8")
+
+    def value(self, field: str, i: int) -> Optional[str]:
+        code = int(self.codes[field][i])
+        return None if code < 0 else self.tables[field][code]
+
+    def column(self, field: str) -> Tuple[np.ndarray, List[str]]:
+        """(codes, table) of an interned field; code -1 means None"""
+        return self.codes[field], self.tables[field]
+
+    def __getitem__(self, i) -> Dict[str, Any]:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        row: Dict[str, Any] = {f: self.ids[f][i].decode("utf-8") for f in ID_FIELDS}
+        for field in TABLE_FIELDS:
+            row[field] = self.value(field, i)
+        row["text"] = self.text(i)
+        return row
+
+    def texts(self) -> List[str]:
+        """All chunk texts (decodes the whole blob; BM25 rebuild fallback only)"""
+        data = self.text_blob.tobytes()
+        offs = np.asarray(self.text_offsets).tolist()
+        return [data[offs[i]:offs[i + 1]].decode("utf-8") for i in range(len(self))]
@@ -0,0 +1,136 @@
+# python ./chatbot/onnx_encoder.py --out ./data/e5_onnx --quantize
+"""
+ONNX Runtime version of the multilingual-e5 encoder
+
+export() writes the transformer (token ids -> last hidden state) as ONNX,
+optionally with an int8 dynamically-quantized copy, next to its tokenizer.
+OnnxEncoder.encode() then reproduces the SentenceTransformer pipeline of
+intfloat/multilingual-e5-small (truncate to 512 tokens, mean pooling over
+the attention mask, L2 normalization) without PyTorch at query time, so it
+can be passed anywhere a SentenceTransformer is used for .encode().
+"""
+import argparse
+import os
+from typing import List, Optional
+
+import numpy as np
+
+MODEL_FILE = "model.onnx"
+INT8_FILE = "model_int8.onnx"
+
+
+def export(model_name: str, out_dir: str, quantize: bool = False, opset: int = 17) -> str:
+    """Export model_name to out_dir/model.onnx (+ model_int8.onnx); returns the directory"""
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(out_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    tokenizer.save_pretrained(out_dir)
+
+    sample = tokenizer(["query: example", "passage: a longer example text"],
+                       padding=True, return_tensors="pt")
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample]
+
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self, inner):
+            super().__init__()
+            self.inner = inner
+
+        def forward(self, *inputs):
+            return self.inner(**dict(zip(input_names, inputs))).last_hidden_state
+
+    axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]}
+    path = os.path.join(out_dir, MODEL_FILE)
+    with torch.no_grad():
+        torch.onnx.export(
+            LastHiddenState(model), tuple(sample[n] for n in input_names), path,
+            input_names=input_names, output_names=["last_hidden_state"],
+            dynamic_axes=axes, opset_version=opset,
+        )
+    print(f"Saved ONNX model: {path}")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        int8_path = os.path.join(out_dir, INT8_FILE)
+        quantize_dynamic(path, int8_path, weight_type=QuantType.QInt8)
+        print(f"Saved int8 model: {int8_path}  "
+              f"({os.path.getsize(int8_path) / 2**20:.0f} MiB vs {os.path.getsize(path) / 2**20:.0f} MiB)")
+    return out_dir
+
+
+class OnnxEncoder:
+    def __init__(self, model_path: str, max_seq_length: int = 512, threads: Optional[int] = None):
+        """
+        Args:
+            model_path: .onnx file written by export() (its tokenizer is read
+                        from the same directory)
+            max_seq_length: Token limit, as SentenceTransformer's max_seq_length
+            threads: ONNX Runtime intra-op threads (default: runtime's choice)
+        """
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.model_path = model_path
+        self.max_seq_length = max_seq_length
+        self.tokenizer = AutoTokenizer.from_pretrained(os.path.dirname(os.path.abspath(model_path)))
+        opts = ort.SessionOptions()
+        if threads:
+            opts.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(model_path, sess_options=opts,
+                                            providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    @property
+    def name(self) -> str:
+        """Identifies the encoder in cache keys (fp32 and int8 embeddings differ slightly)"""
+        return "onnx:" + os.path.basename(self.model_path)
+
+    def encode(self, texts: List[str], batch_size: int = 32, normalize_embeddings: bool = True,
+               **kwargs) -> np.ndarray:
+        """Embeddings of texts (N x D, float32); extra SentenceTransformer kwargs are ignored"""
+        if isinstance(texts, str):
+            texts = [texts]
+        out = []
+        for lo in range(0, len(texts), batch_size):
+            enc = self.tokenizer(texts[lo:lo + batch_size], padding=True, truncation=True,
+                                 max_length=self.max_seq_length, return_tensors="np")
+            feeds = {n: enc[n].astype(np.int64) for n in self.input_names}
+            hidden = self.session.run(None, feeds)[0]
+            # mean pooling over real tokens
+            mask = enc["attention_mask"][:, :, None].astype(np.float32)
+            emb = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            if normalize_embeddings:
+                emb = emb / np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12)
+            out.append(emb.astype(np.float32))
+        if not out:
+            return np.zeros((0, self.session.get_outputs()[0].shape[-1]), dtype=np.float32)
+        return np.vstack(out)
+
+
+def load_encoder(kind: str, model_name: str, onnx_path: Optional[str] = None):
+    """SentenceTransformer (kind="torch") or OnnxEncoder (kind="onnx") for model_name"""
+    if kind == "torch":
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(model_name)
+    if kind == "onnx":
+        if not onnx_path or not os.path.exists(onnx_path):
+            raise RuntimeError(f"ONNX model not found: {onnx_path} "
+                               f"(export it with: python ./chatbot/onnx_encoder.py --out <dir>)")
+        return OnnxEncoder(onnx_path)
+    raise ValueError(f"Unknown encoder: {kind}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model", default="intfloat/multilingual-e5-small")
+    ap.add_argument("--out", default="./data/e5_onnx")
+    ap.add_argument("--quantize", action="store_true", help="also write an int8 dynamically-quantized copy")
+    ap.add_argument("--opset", type=int, default=17)
+    args = ap.parse_args()
+    export(args.model, args.out, quantize=args.quantize, opset=args.opset)
+
+
+if __name__ == "__main__":
+    main()
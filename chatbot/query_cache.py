@@ -0,0 +1,224 @@
+"""
+Query-side caches: an LRU of query embeddings (optionally persisted across
+restarts) and a size/TTL-bounded cache of retrieval results
+"""
+import contextlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # not on Windows: saves are then not serialized across processes
+    fcntl = None
+
+
+def normalize_query_text(text: str) -> str:
+    """Cache key form of an encoder input ("query: ..."): whitespace collapsed"""
+    return " ".join((text or "").split())
+
+
+@contextlib.contextmanager
+def _file_lock(path: str):
+    """Exclusive advisory lock on path, held across processes"""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class EmbeddingCache:
+    def __init__(self, model_name: str, max_size: int = 4096, path: Optional[str] = None):
+        """
+        Args:
+            model_name: Encoder name, part of every key so a cache file written
+                        for another model never matches
+            max_size: Maximum number of cached embeddings (least recently used
+                      are evicted first)
+            path: Optional .npz file loaded now and written by save()
+        """
+        self.model_name = model_name
+        self.max_size = max_size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False  # entries added since load/save
+
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def _key(self, text: str) -> str:
+        return f"{self.model_name}\t{normalize_query_text(text)}"
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        key = self._key(text)
+        with self._lock:
+            vec = self._entries.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vec
+
+    def put(self, text: str, vec: np.ndarray) -> None:
+        key = self._key(text)
+        with self._lock:
+            self._entries[key] = np.asarray(vec, dtype=np.float32)
+            self._entries.move_to_end(key)
+            self._dirty = True
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def encode(self, encoder, texts: List[str]) -> np.ndarray:
+        """
+        Embeddings of texts (already prefixed, e.g. "query: ..."); only the
+        misses go through the encoder, as one batch
+        """
+        out: List[Optional[np.ndarray]] = [self.get(t) for t in texts]
+        missing = [i for i, v in enumerate(out) if v is None]
+        if missing:
+            embs = np.asarray(encoder.encode([texts[i] for i in missing], normalize_embeddings=True),
+                              dtype=np.float32)
+            for i, vec in zip(missing, embs):
+                self.put(texts[i], vec)
+                out[i] = vec
+        return np.vstack(out).astype(np.float32, copy=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def save(self, path: Optional[str] = None) -> None:
+        """
+        Merge the entries into the file at path. Every prefork worker saves at
+        exit: the saves are serialized by a lock file and each merges what the
+        previous ones wrote (its own entries count as the most recent), so no
+        worker's embeddings are lost to another's.
+        """
+        path = path or self.path
+        if not path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return  # nothing new (e.g. the preloading master): leave the file alone
+            entries = list(self._entries.items())
+            self._dirty = False
+
+        with _file_lock(path + ".lock"):
+            merged: "OrderedDict[str, np.ndarray]" = OrderedDict()
+            if os.path.exists(path):
+                try:
+                    merged.update(zip(*self._read(path)))
+                except Exception as e:
+                    print(f"Overwriting unreadable query cache {path}: {e}")
+            for key, vec in entries:
+                merged.pop(key, None)
+                merged[key] = vec
+            while len(merged) > self.max_size:
+                merged.popitem(last=False)
+
+            # own temp file, then rename: a crash (or a process without the lock) never installs a torn cache
+            fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                       dir=os.path.dirname(os.path.abspath(path)))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.savez(f, keys=np.array(list(merged.keys())), vecs=np.vstack(list(merged.values())))
+                os.replace(tmp, path)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+
+    @staticmethod
+    def _read(path: str) -> Tuple[List[str], np.ndarray]:
+        with np.load(path) as data:
+            return data["keys"].tolist(), data["vecs"]
+
+    def load(self, path: str) -> None:
+        try:
+            keys, vecs = self._read(path)
+        except Exception as e:
+            print(f"Ignoring unreadable query cache {path}: {e}")
+            return
+        prefix = f"{self.model_name}\t"
+        with self._lock:
+            for key, vec in zip(keys, vecs):
+                if key.startswith(prefix):
+                    self._entries[key] = vec
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class ResultCache:
+    """
+    LRU + TTL cache of retrieval results. Keys carry the index fingerprint;
+    invalidate() drops everything when a different index is loaded.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.fingerprint: Optional[str] = None
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def invalidate(self, fingerprint: str) -> None:
+        """Forget all results unless they were computed on this index"""
+        with self._lock:
+            if fingerprint != self.fingerprint:
+                self._entries.clear()
+                self.fingerprint = fingerprint
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
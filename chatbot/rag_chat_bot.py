@@ -3,13 +3,14 @@ import argparse
 import json
 import os
 import sys
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Optional, Tuple
 import re
 import numpy as np
 import requests
 from sentence_transformers import SentenceTransformer
 from hebrew_utils import detect_query_intent
 from hybrid_retriever import HybridRetriever
+from diversity import url_ids, select_diverse
 from logger import ChatLogger
 import time
 
@@ -68,32 +69,25 @@ def retrieve_topk(
     embed_model: SentenceTransformer,
     topk: int = 6,
     max_per_url: int = 2,
+    chunk_url_ids: Optional[np.ndarray] = None,
 ) -> List[Tuple[float, Dict[str, Any]]]:
     # E5 format
     q = embed_model.encode(["query: " + query], normalize_embeddings=True)[0].astype(np.float32)
+    if chunk_url_ids is None:
+        chunk_url_ids = url_ids(metas)
 
     sims = E @ q  # cosine similarity because normalized
     k = min(topk * 4, len(sims))  # overfetch then filter
-    idxs = np.argpartition(-sims, k - 1)[:k]
-    idxs = idxs[np.argsort(-sims[idxs])]
-
-    picked: List[Tuple[float, Dict[str, Any]]] = []
-    per_url = {}
-
-    for i in idxs:
-        m = metas[int(i)]
-        url = m.get("url", "")
-        if not url:
-            continue
-        per_url.setdefault(url, 0)
-        if per_url[url] >= max_per_url:
-            continue
-        picked.append((float(sims[i]), m))
-        per_url[url] += 1
-        if len(picked) >= topk:
+    while True:
+        idxs = np.argpartition(-sims, k - 1)[:k]
+        idxs = idxs[np.argsort(-sims[idxs])]
+        pos = select_diverse(idxs, sims[idxs], chunk_url_ids[idxs], topk, max_per_url)
+        # widen the overfetch when a few URLs crowd it
+        if len(pos) >= topk or k >= len(sims):
             break
+        k = min(k * 4, len(sims))
 
-    return picked
+    return [(float(sims[idxs[p]]), metas[int(idxs[p])]) for p in pos]
 
 
 def build_sources_block(picked: List[Tuple[float, Dict[str, Any]]], max_chars_each: int = 1600) -> str:
@@ -232,11 +226,14 @@ def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--emb", default="./data/cis_emb.npy")
     ap.add_argument("--meta", default="./data/cis_meta.jsonl")
+    ap.add_argument("--bm25", default="./data/cis_bm25")
     ap.add_argument("--embed_model", default="intfloat/multilingual-e5-small")
     ap.add_argument("--ollama_url", default="http://localhost:11434")
     ap.add_argument("--llm", default="qwen3:8b")
     ap.add_argument("--topk", type=int, default=5)
     ap.add_argument("--max_per_url", type=int, default=2)
+    ap.add_argument("--mmr_lambda", type=float, default=1.0,
+                    help="maximal marginal relevance weight of source selection (1.0 = off)")
     ap.add_argument("--num_ctx", type=int, default=8192)
     args = ap.parse_args()
 
@@ -263,7 +260,8 @@ def main():
     print("Logging enabled to: chatbot_interactions.jsonl")
 
     print("Initializing hybrid retriever...")
-    retriever = HybridRetriever(E, metas, embed_model, alpha=0.6)
+    retriever = HybridRetriever(E, metas, embed_model, alpha=0.6, bm25_path=args.bm25,
+                                mmr_lambda=args.mmr_lambda)
     print("Hybrid retriever ready!")
     print("\nRAG Chat ready. Type 'exit' to quit.\n")
 
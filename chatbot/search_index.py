@@ -2,6 +2,7 @@ import argparse
 import json
 import numpy as np
 from sentence_transformers import SentenceTransformer
+from query_cache import EmbeddingCache
 
 def read_meta(path: str):
     metas = []
@@ -17,6 +18,8 @@ def main():
     ap.add_argument("--model", default="intfloat/multilingual-e5-small")
     ap.add_argument("--query", required=True)
     ap.add_argument("--topk", type=int, default=5)
+    ap.add_argument("--cache", default="./data/query_emb_cache.npz",
+                    help="query embedding cache file ('' to disable)")
     args = ap.parse_args()
 
     E = np.load(args.emb)  # normalized embeddings
@@ -24,7 +27,12 @@ def main():
     assert len(metas) == E.shape[0], "meta rows must match embeddings rows"
 
     model = SentenceTransformer(args.model)
-    q = model.encode(["query: " + args.query], normalize_embeddings=True)[0].astype(np.float32)
+    if args.cache:
+        cache = EmbeddingCache(args.model, path=args.cache)
+        q = cache.encode(model, ["query: " + args.query])[0]
+        cache.save()
+    else:
+        q = model.encode(["query: " + args.query], normalize_embeddings=True)[0].astype(np.float32)
 
     # cosine similarity since normalized => dot product
     sims = E @ q
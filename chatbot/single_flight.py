@@ -0,0 +1,106 @@
+"""
+Single-flight coalescing of identical in-flight work
+
+The first caller for a key starts the work (an async iterator of events)
+as a task; callers arriving while it runs attach to that task and replay
+its events from the beginning, so N identical questions asked within
+seconds of each other cost one retrieval and one generation. The task is
+cancelled if every caller goes away before it finishes; the key is freed
+as soon as it ends, so later callers start fresh work. The callers still
+attached are kept in a group the work can read (e.g. to be scheduled at the
+priority of the most important of them).
+"""
+import asyncio
+from typing import Any, AsyncIterator, Callable, Dict, Hashable, List, Optional
+
+
+class _Flight:
+    def __init__(self, callers: Any):
+        self.events: List[Any] = []
+        self.callers = callers
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.listeners = 0
+        self.task: Optional[asyncio.Task] = None
+        self.cond = asyncio.Condition()
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.started = 0
+        self.joined = 0  # callers served by a flight someone else started (= work saved)
+        self.cancelled = 0
+
+    async def _run(self, key: Hashable, flight: _Flight, events: AsyncIterator[Any]) -> None:
+        try:
+            async for ev in events:
+                async with flight.cond:
+                    flight.events.append(ev)
+                    flight.cond.notify_all()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            flight.error = RuntimeError("Cancelled: no caller is waiting for it")
+        except Exception as e:
+            # handed to every caller instead of failing the task
+            flight.error = e
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            async with flight.cond:
+                flight.finished = True
+                flight.cond.notify_all()
+
+    async def stream(self, key: Hashable, start: Callable[[Any], AsyncIterator[Any]], caller: Any = None,
+                     group: Callable[[], Any] = list) -> AsyncIterator[Any]:
+        """
+        Events of the flight for key, from the first one; start(callers) creates
+        the event iterator if no flight is running. callers is made by group()
+        (anything with append / remove) and holds the caller of every stream
+        attached to the flight. Errors of the work are raised in every caller.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(group())
+            flight.callers.append(caller)
+            self._flights[key] = flight
+            self.started += 1
+            flight.task = asyncio.get_running_loop().create_task(self._run(key, flight, start(flight.callers)))
+        else:
+            flight.callers.append(caller)
+            self.joined += 1
+
+        flight.listeners += 1
+        try:
+            seen = 0
+            while True:
+                async with flight.cond:
+                    await flight.cond.wait_for(lambda: len(flight.events) > seen or flight.finished)
+                    new = flight.events[seen:]
+                    finished = flight.finished
+                for ev in new:
+                    yield ev
+                seen += len(new)
+                if finished and seen == len(flight.events):
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            flight.listeners -= 1
+            flight.callers.remove(caller)
+            if flight.listeners == 0 and not flight.finished:
+                # free the key now: a caller arriving before the task has unwound starts afresh
+                # instead of joining a flight that is about to fail
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.started + self.joined
+        return {
+            "in_flight": len(self._flights),
+            "started": self.started,
+            "joined": self.joined,
+            "saved_ratio": self.joined / total if total else 0.0,
+            "cancelled": self.cancelled,
+        }
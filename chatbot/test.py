@@ -4,13 +4,14 @@ import argparse
 import json
 import os
 import sys
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Optional, Tuple
 import re
 import numpy as np
 import requests
 from sentence_transformers import SentenceTransformer
 from hebrew_utils import detect_query_intent
 from hybrid_retriever import HybridRetriever
+from diversity import url_ids, select_diverse
 from logger import ChatLogger
 from language_filter import validate_response_language, clean_response, contains_unwanted_languages
 import time
@@ -70,32 +71,25 @@ def retrieve_topk(
     embed_model: SentenceTransformer,
     topk: int = 6,
     max_per_url: int = 2,
+    chunk_url_ids: Optional[np.ndarray] = None,
 ) -> List[Tuple[float, Dict[str, Any]]]:
     # E5 format
     q = embed_model.encode(["query: " + query], normalize_embeddings=True)[0].astype(np.float32)
+    if chunk_url_ids is None:
+        chunk_url_ids = url_ids(metas)
 
     sims = E @ q  # cosine similarity because normalized
     k = min(topk * 4, len(sims))  # overfetch then filter
-    idxs = np.argpartition(-sims, k - 1)[:k]
-    idxs = idxs[np.argsort(-sims[idxs])]
-
-    picked: List[Tuple[float, Dict[str, Any]]] = []
-    per_url = {}
-
-    for i in idxs:
-        m = metas[int(i)]
-        url = m.get("url", "")
-        if not url:
-            continue
-        per_url.setdefault(url, 0)
-        if per_url[url] >= max_per_url:
-            continue
-        picked.append((float(sims[i]), m))
-        per_url[url] += 1
-        if len(picked) >= topk:
+    while True:
+        idxs = np.argpartition(-sims, k - 1)[:k]
+        idxs = idxs[np.argsort(-sims[idxs])]
+        pos = select_diverse(idxs, sims[idxs], chunk_url_ids[idxs], topk, max_per_url)
+        # widen the overfetch when a few URLs crowd it
+        if len(pos) >= topk or k >= len(sims):
             break
+        k = min(k * 4, len(sims))
 
-    return picked
+    return [(float(sims[idxs[p]]), metas[int(idxs[p])]) for p in pos]
 
 
 def build_sources_block(picked: List[Tuple[float, Dict[str, Any]]], max_chars_each: int = 1600) -> str:
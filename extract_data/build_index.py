@@ -1,9 +1,18 @@
-# python build_index.py --inp ./data/cis_chunks.jsonl --out_emb ./data/cis_emb.npy --out_meta ./data/cis_meta.jsonl
+# python build_index.py --inp ./data/cis_chunks.jsonl --out_emb ./data/cis_emb.npy --out_meta ./data/cis_meta.jsonl --out_bm25 ./data/cis_bm25
 import argparse
 import json
+import os
+import sys
 import numpy as np
 from tqdm import tqdm
-from sentence_transformers import SentenceTransformer
+
+# Index formats are shared with the retriever in ./chatbot
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from chatbot.bm25_index import BM25Index, tokenize, corpus_fingerprint
+from chatbot.dense_index import IVFIndex, QuantizedIndex, BinaryIndex, PCAIndex
+from chatbot.meta_store import file_fingerprint, write_meta_store
+from chatbot.index_versions import version_dir, write_current
+from chatbot.onnx_encoder import load_encoder
 
 def read_jsonl(path: str):
     with open(path, "r", encoding="utf-8") as f:
@@ -15,10 +24,38 @@ def main():
     ap.add_argument("--inp", default="cis_chunks.jsonl")
     ap.add_argument("--out_emb", default="cis_emb.npy")
     ap.add_argument("--out_meta", default="cis_meta.jsonl")
+    ap.add_argument("--out_meta_store", default="cis_meta_store",
+                    help="directory for the columnar (mmapped) copy of the metadata")
+    ap.add_argument("--out_bm25", default="cis_bm25", help="directory for the prebuilt BM25 index")
+    ap.add_argument("--ivf", action="store_true", help="also build the IVF (approximate) dense index")
+    ap.add_argument("--ivf_lists", type=int, default=0, help="IVF lists (0 = 4*sqrt(rows))")
+    ap.add_argument("--out_ivf", default="cis_ivf")
+    ap.add_argument("--quantize", choices=["none", "int8", "float16"], default="none",
+                    help="also write a compact copy of the embeddings for the int8/float16 backends")
+    ap.add_argument("--out_quant", default="cis_quant")
+    ap.add_argument("--binary", action="store_true", help="also write sign-bit codes for the binary backend")
+    ap.add_argument("--out_binary", default="cis_binary")
+    ap.add_argument("--pca_dim", type=int, default=0, help="also fit a PCA first pass of this dimension (0 = off)")
+    ap.add_argument("--out_pca", default="cis_pca")
     ap.add_argument("--model", default="intfloat/multilingual-e5-small")
     ap.add_argument("--batch_size", type=int, default=32)
+    ap.add_argument("--encoder", choices=["torch", "onnx"], default="torch",
+                    help="onnx: encode passages with the ONNX Runtime export (--onnx_path)")
+    ap.add_argument("--onnx_path", default="./data/e5_onnx/model.onnx")
+    ap.add_argument("--version", default=None,
+                    help="write every output into <index_root>/<version>/ and point CURRENT at it")
+    ap.add_argument("--index_root", default="./data/index")
+    ap.add_argument("--no_activate", action="store_true", help="with --version: don't update CURRENT")
     args = ap.parse_args()
 
+    # Versioned layout: outputs keep their file names inside the version directory
+    if args.version:
+        out_dir = version_dir(args.index_root, args.version)
+        os.makedirs(out_dir, exist_ok=True)
+        for name in ("out_emb", "out_meta", "out_meta_store", "out_bm25",
+                     "out_ivf", "out_quant", "out_binary", "out_pca"):
+            setattr(args, name, os.path.join(out_dir, os.path.basename(getattr(args, name).rstrip("/"))))
+
     # Load chunks
     chunks = list(read_jsonl(args.inp))
     if not chunks:
@@ -27,7 +64,7 @@ def main():
     # E5 expects prefixes: "passage: " for docs, "query: " for queries
     texts = ["passage: " + c["text"] for c in chunks]
 
-    model = SentenceTransformer(args.model)
+    model = load_encoder(args.encoder, args.model, args.onnx_path)
 
     embs = []
     for i in tqdm(range(0, len(texts), args.batch_size), desc="Embedding"):
@@ -39,21 +76,70 @@ def main():
     np.save(args.out_emb, E)
 
     # Save metadata aligned with embeddings rows
+    metas = [
+        {
+            "chunk_id": c.get("chunk_id"),
+            "doc_id": c.get("doc_id"),
+            "url": c.get("url"),
+            "title": c.get("title"),
+            "lastmod": c.get("lastmod"),
+            "lang": c.get("lang"),
+            "source_sitemap": c.get("source_sitemap"),
+            "text": c.get("text"),
+        }
+        for c in chunks
+    ]
     with open(args.out_meta, "w", encoding="utf-8") as f:
-        for c in chunks:
-            meta = {
-                "chunk_id": c.get("chunk_id"),
-                "doc_id": c.get("doc_id"),
-                "url": c.get("url"),
-                "title": c.get("title"),
-                "lastmod": c.get("lastmod"),
-                "lang": c.get("lang"),
-                "text": c.get("text"),
-            }
+        for meta in metas:
             f.write(json.dumps(meta, ensure_ascii=False) + "\n")
 
+    chunk_texts = [c.get("text") or "" for c in chunks]
+    fingerprint = corpus_fingerprint(chunk_texts)
+
+    # Columnar copy of the metadata, mmapped by RagEngine instead of the jsonl
+    write_meta_store(args.out_meta_store, metas, fingerprint, emb_fingerprint=file_fingerprint(args.out_emb))
+
+    # Prebuilt BM25 term index, loaded with mmap by HybridRetriever
+    bm25 = BM25Index.build(
+        [tokenize(t) for t in tqdm(chunk_texts, desc="BM25")],
+        fingerprint=fingerprint,
+    )
+    bm25.save(args.out_bm25)
+
+    # Optional approximate dense index (k-means coarse quantizer + inverted lists)
+    if args.ivf:
+        ivf = IVFIndex.build(E, n_lists=args.ivf_lists or None, fingerprint=fingerprint)
+        ivf.save(args.out_ivf)
+        print(f"Saved IVF index:  {args.out_ivf}  lists={ivf.n_lists}")
+
+    # Optional scalar-quantized embeddings (scored first, rescored in float32)
+    if args.quantize != "none":
+        quant = QuantizedIndex.build(E, kind=args.quantize, fingerprint=fingerprint)
+        quant.save(args.out_quant)
+        print(f"Saved {args.quantize} embeddings: {args.out_quant}  "
+              f"{quant.nbytes / 2**20:.1f} MiB (float32: {E.nbytes / 2**20:.1f} MiB)")
+
+    # Optional binary (sign-bit) codes for the Hamming prefilter
+    if args.binary:
+        binary = BinaryIndex.build(E, fingerprint=fingerprint)
+        binary.save(args.out_binary)
+        print(f"Saved binary codes: {args.out_binary}  {binary.nbytes / 2**20:.1f} MiB")
+
+    # Optional PCA projection for a reduced-dimension first pass
+    if args.pca_dim:
+        pca = PCAIndex.build(E, dim=args.pca_dim, fingerprint=fingerprint)
+        pca.save(args.out_pca)
+        print(f"Saved PCA index:  {args.out_pca}  dim={pca.dim}")
+
     print(f"Saved embeddings: {args.out_emb}  shape={E.shape}")
     print(f"Saved metadata:   {args.out_meta}  rows={len(chunks)}")
+    print(f"Saved meta store: {args.out_meta_store}")
+    print(f"Saved BM25 index: {args.out_bm25}  terms={len(bm25.vocab)}")
+
+    # Switch the app over only once the whole version directory is written
+    if args.version and not args.no_activate:
+        write_current(args.index_root, args.version)
+        print(f"CURRENT -> {args.version}  (running apps pick it up on reload)")
 
 if __name__ == "__main__":
     main()
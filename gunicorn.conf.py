@@ -0,0 +1,39 @@
+# gunicorn -c gunicorn.conf.py webapp.app:app
+"""
+Prefork deployment: webapp.app (and with it RagEngine: embedding model,
+BM25 index, embeddings, metadata store) is imported once in the master
+process and the workers are forked from it, so they share those read-only
+pages copy-on-write instead of each loading a private copy.
+"""
+import gc
+import os
+
+bind = os.environ.get("BIND", "127.0.0.1:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "4"))
+# read by the app (preloaded after this file), e.g. to know that a reload must reach every worker
+os.environ["WEB_CONCURRENCY"] = str(workers)
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = 300
+
+
+def when_ready(server):
+    # The app is loaded by now. Move everything allocated so far out of the
+    # collector's generations, so collections in the workers never write to
+    # (and thereby un-share) the master's objects.
+    gc.collect()
+    gc.freeze()
+    server.log.info("Preloaded app, %d objects frozen", gc.get_freeze_count())
+
+
+def post_fork(server, worker):
+    # SQLite connections opened in the master (init_db) must not be reused
+    # by the children; drop the pool without closing the parent's sockets/files
+    from webapp.app import engine
+    engine.dispose(close=False)
+
+    # one torch thread pool per worker, sized so workers don't oversubscribe the cores
+    threads = os.environ.get("TORCH_THREADS")
+    if threads:
+        import torch
+        torch.set_num_threads(int(threads))
@@ -0,0 +1,46 @@
+# python -m unittest discover -s tests
+"""
+FooterFilter must hide a model-written sources section from a streamed
+answer, however the model's deltas split it up.
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webapp.rag_engine import FooterFilter, strip_sources_footer  # noqa: E402
+
+
+def run(deltas):
+    f = FooterFilter()
+    out = "".join(f.feed(d) for d in deltas) + f.flush()
+    return out, f.stopped
+
+
+class FooterFilterTest(unittest.TestCase):
+    def test_header_split_across_tokens_with_whitespace(self):
+        deltas = ["Tuition is 12,000 ₪ [1].\n", "  sour", "ces", ":  ", "\n[1] — Fees\n"]
+        out, stopped = run(deltas)
+        self.assertEqual(out, "Tuition is 12,000 ₪ [1].\n")
+        self.assertTrue(stopped)
+        self.assertEqual(out.strip(), strip_sources_footer("".join(deltas)))
+
+    def test_hebrew_header_with_whitespace_at_end_of_stream(self):
+        out, stopped = run(["התשובה [1].\n", " מקו", "רות: ", " "])
+        self.assertEqual(out, "התשובה [1].\n")
+        self.assertTrue(stopped)
+
+    def test_footer_lines_are_dropped(self):
+        out, _ = run(["Answer [1].\n", " [1", "] ", "— Title\n", "more\n"])
+        self.assertEqual(out, "Answer [1].\nmore\n")
+
+    def test_text_with_trailing_space_is_not_held(self):
+        f = FooterFilter()
+        self.assertEqual(f.feed("Hello "), "Hello ")
+        self.assertEqual(f.feed("world"), "world")
+        self.assertFalse(f.stopped)
+
+
+if __name__ == "__main__":
+    unittest.main()
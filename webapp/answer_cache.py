@@ -0,0 +1,209 @@
+"""
+Semantic answer cache for stateless (guest) questions
+
+An answer is reused for a new question when both of these hold:
+    - the retrieval returned the same source chunks, in the same order
+      (same index, same answer language)
+    - the question embeddings are at least `threshold` cosine-similar
+so paraphrases of a question answered minutes ago skip the LLM call, while
+a question that retrieves different sources never gets a stale answer.
+Entries expire after ttl seconds, the least recently used are evicted
+beyond max_size, and entries of other indexes are dropped on reload.
+Every entry is also written to the AnswerCacheEntry table, so the cache
+survives restarts and is shared by the prefork workers: a question that
+misses in memory is looked up in the table before it counts as a miss.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from sqlmodel import Session, delete, select
+
+from .db import AnswerCacheEntry
+
+
+class _Entry:
+    __slots__ = ("id", "group", "emb", "answer", "created")
+
+    def __init__(self, id: int, group: tuple, emb: np.ndarray, answer: str, created: float):
+        self.id = id
+        self.group = group
+        self.emb = emb
+        self.answer = answer
+        self.created = created
+
+
+class SemanticAnswerCache:
+    def __init__(self, engine=None, threshold: float = 0.95, max_size: int = 2000, ttl: float = 86400.0):
+        """
+        Args:
+            engine: SQLAlchemy engine of the app database (None = memory only)
+            threshold: Minimum cosine similarity of two questions' embeddings
+            max_size: Entries kept (least recently used are evicted first)
+            ttl: Seconds an answer stays valid
+        """
+        self.engine = engine
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.fingerprint: Optional[str] = None
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._groups: Dict[tuple, List[int]] = {}
+        self._next_id = -1  # ids of entries not persisted (engine is None)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _group(fingerprint: str, lang: str, chunk_ids: Sequence[str]) -> tuple:
+        return fingerprint, lang, tuple(chunk_ids)
+
+    def _add(self, entry: _Entry) -> None:
+        self._entries[entry.id] = entry
+        self._groups.setdefault(entry.group, []).append(entry.id)
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        ids = self._groups.get(entry.group, [])
+        if entry_id in ids:
+            ids.remove(entry_id)
+        if not ids:
+            self._groups.pop(entry.group, None)
+
+    def _delete_rows(self, ids: List[int]) -> None:
+        ids = [i for i in ids if i > 0]
+        if self.engine is None or not ids:
+            return
+        with Session(self.engine) as db:
+            db.exec(delete(AnswerCacheEntry).where(AnswerCacheEntry.id.in_(ids)))
+            db.commit()
+
+    def invalidate(self, fingerprint: str) -> None:
+        """Serve the index with this fingerprint: drop entries of any other one, load its own"""
+        with self._lock:
+            if fingerprint == self.fingerprint:
+                return
+            self.fingerprint = fingerprint
+            self._entries.clear()
+            self._groups.clear()
+        if self.engine is None:
+            return
+
+        oldest = datetime.utcnow() - timedelta(seconds=self.ttl)
+        with Session(self.engine) as db:
+            db.exec(delete(AnswerCacheEntry).where(
+                (AnswerCacheEntry.fingerprint != fingerprint) | (AnswerCacheEntry.created_at < oldest)))
+            db.commit()
+            rows = db.exec(select(AnswerCacheEntry).order_by(AnswerCacheEntry.id.desc())
+                           .limit(self.max_size)).all()
+
+        now_utc, now = datetime.utcnow(), time.time()
+        with self._lock:
+            for row in reversed(rows):  # oldest first, so the newest end up most recently used
+                age = (now_utc - row.created_at).total_seconds()
+                self._add(_Entry(row.id, self._group(row.fingerprint, row.lang, json.loads(row.chunk_ids)),
+                                 np.frombuffer(row.embedding, dtype=np.float32), row.answer, now - age))
+
+    def _best(self, group: tuple, emb: np.ndarray, expired: List[int]) -> Optional[_Entry]:
+        """Most similar entry of the group above the threshold (call with the lock held)"""
+        best, best_sim = None, self.threshold
+        now = time.time()
+        for entry_id in list(self._groups.get(group, [])):
+            entry = self._entries[entry_id]
+            if now - entry.created > self.ttl:
+                self._remove(entry_id)
+                expired.append(entry_id)
+                continue
+            sim = float(np.dot(entry.emb, emb))
+            if sim >= best_sim:
+                best, best_sim = entry, sim
+        return best
+
+    def _load_group(self, group: tuple) -> bool:
+        """Add rows of the group that are not in memory yet (written by other workers); True if any"""
+        fingerprint, lang, chunk_ids = group
+        oldest = datetime.utcnow() - timedelta(seconds=self.ttl)
+        with Session(self.engine) as db:
+            rows = db.exec(select(AnswerCacheEntry).where(
+                (AnswerCacheEntry.fingerprint == fingerprint) & (AnswerCacheEntry.lang == lang)
+                & (AnswerCacheEntry.chunk_ids == json.dumps(list(chunk_ids)))
+                & (AnswerCacheEntry.created_at >= oldest))).all()
+        now_utc, now = datetime.utcnow(), time.time()
+        added = False
+        with self._lock:
+            for row in rows:
+                if row.id not in self._entries:
+                    age = (now_utc - row.created_at).total_seconds()
+                    self._add(_Entry(row.id, group, np.frombuffer(row.embedding, dtype=np.float32),
+                                     row.answer, now - age))
+                    added = True
+            # over max_size: forget the least recently used here, the rows stay for the other workers
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+        return added
+
+    def get(self, emb: np.ndarray, lang: str, chunk_ids: Sequence[str], fingerprint: str) -> Optional[str]:
+        """Answer to the most similar cached question with these sources, if close enough"""
+        group = self._group(fingerprint, lang, chunk_ids)
+        expired: List[int] = []
+        with self._lock:
+            best = self._best(group, emb, expired)
+        if best is None and self.engine is not None and fingerprint == self.fingerprint \
+                and self._load_group(group):
+            with self._lock:
+                best = self._best(group, emb, expired)
+        with self._lock:
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if best.id in self._entries:
+                    self._entries.move_to_end(best.id)
+        self._delete_rows(expired)
+        return best.answer if best is not None else None
+
+    def put(self, query: str, emb: np.ndarray, lang: str, chunk_ids: Sequence[str], fingerprint: str,
+            answer: str) -> None:
+        if fingerprint != self.fingerprint:
+            return  # generated from an index that has been replaced meanwhile
+        emb = np.asarray(emb, dtype=np.float32)
+        if self.engine is not None:
+            with Session(self.engine) as db:
+                row = AnswerCacheEntry(fingerprint=fingerprint, lang=lang, chunk_ids=json.dumps(list(chunk_ids)),
+                                       query=query, embedding=emb.tobytes(), answer=answer)
+                db.add(row)
+                db.commit()
+                entry_id = row.id
+        else:
+            with self._lock:
+                entry_id, self._next_id = self._next_id, self._next_id - 1
+
+        evicted: List[int] = []
+        with self._lock:
+            self._add(_Entry(entry_id, self._group(fingerprint, lang, chunk_ids), emb, answer, time.time()))
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                evicted.append(oldest)
+            self.evictions += len(evicted)
+        self._delete_rows(evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_size": self.max_size,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+            }
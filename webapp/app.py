@@ -1,16 +1,23 @@
 from fastapi import FastAPI, Request, Form, Depends, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 from itsdangerous import URLSafeSerializer
 from sqlmodel import Session, select, text
 from passlib.context import CryptContext
 
+import asyncio
+import hmac
 import json
 import os
+import time
+from typing import Optional
 
 from .db import make_engine, init_db, User, Chat, Message
-from .rag_engine import RagEngine
+from .rag_engine import RagEngine, Overloaded, ChatLogger, is_hebrew
+from .answer_cache import SemanticAnswerCache
+from .cache_warmer import CacheWarmer
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.abspath(os.path.join(BASE_DIR, "..", "data"))
@@ -18,6 +25,32 @@ DB_PATH = os.path.join(DATA_DIR, "app.db")
 
 EMB_PATH = os.path.join(DATA_DIR, "cis_emb.npy")
 META_PATH = os.path.join(DATA_DIR, "cis_meta.jsonl")
+BM25_PATH = os.path.join(DATA_DIR, "cis_bm25")
+# versioned indexes (data/index/<version> + CURRENT); used instead of the files above when present
+INDEX_ROOT = os.environ.get("INDEX_ROOT", os.path.join(DATA_DIR, "index"))
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+INDEX_WATCH_INTERVAL = float(os.environ.get("INDEX_WATCH_INTERVAL", "0"))
+# worker processes serving the app (set by gunicorn.conf.py; 1 under plain uvicorn)
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", "1"))
+
+
+def _max_generations() -> int:
+    """
+    Generation slots of this worker: MAX_GENERATIONS if set, else an equal share of
+    OLLAMA_NUM_PARALLEL (the generations Ollama runs at once, over all workers)
+    """
+    total = int(os.environ.get("OLLAMA_NUM_PARALLEL", "8"))
+    if "MAX_GENERATIONS" in os.environ:
+        per_worker = int(os.environ["MAX_GENERATIONS"])
+        if per_worker > 0 and per_worker * WORKERS > total:
+            print(f"Warning: MAX_GENERATIONS={per_worker} x {WORKERS} workers exceeds "
+                  f"OLLAMA_NUM_PARALLEL={total}; requests will queue inside Ollama")
+        return per_worker
+    if WORKERS > total:
+        # one slot each would already overload Ollama: refuse rather than round up
+        raise RuntimeError(f"WEB_CONCURRENCY={WORKERS} workers but OLLAMA_NUM_PARALLEL={total}: "
+                           f"use at most {total} workers, or set MAX_GENERATIONS explicitly")
+    return total // WORKERS
 
 SECRET_KEY = os.environ.get("CHAT_SECRET_KEY", "dev-secret-change-me")
 SESSION_SALT = "session"
@@ -36,14 +69,64 @@ app.mount("/static", StaticFiles(directory=os.path.join(BASE_DIR, "static")), na
 os.makedirs(DATA_DIR, exist_ok=True)
 init_db(engine)
 
+# guest answers reused for near-identical questions with the same sources (0 = off)
+answer_cache = None
+if int(os.environ.get("ANSWER_CACHE_SIZE", "2000")) > 0:
+    answer_cache = SemanticAnswerCache(
+        engine,
+        threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.95")),
+        max_size=int(os.environ.get("ANSWER_CACHE_SIZE", "2000")),
+        ttl=float(os.environ.get("ANSWER_CACHE_TTL", "86400")),
+    )
+
 rag = RagEngine(
     emb_path=EMB_PATH,
     meta_path=META_PATH,
+    bm25_path=BM25_PATH,
+    index_root=INDEX_ROOT,
     ollama_url=os.environ.get("OLLAMA_URL", "http://localhost:11434"),
     llm_model=os.environ.get("LLM_MODEL", "qwen3:14b"),
     topk=int(os.environ.get("TOPK", "5")),
     num_ctx=int(os.environ.get("NUM_CTX", "8192")),
     alpha=float(os.environ.get("ALPHA", "0.6")),
+    fusion=os.environ.get("FUSION", "minmax"),
+    mmr_lambda=float(os.environ.get("MMR_LAMBDA", "1.0")),
+    encoder=os.environ.get("ENCODER", "torch"),
+    onnx_path=os.environ.get("ONNX_MODEL_PATH", os.path.join(DATA_DIR, "e5_onnx", "model.onnx")),
+    encode_batch_size=int(os.environ.get("ENCODE_BATCH_SIZE", "32")),
+    encode_max_wait_ms=float(os.environ.get("ENCODE_MAX_WAIT_MS", "2")),
+    retrieval_workers=int(os.environ.get("RETRIEVAL_WORKERS", "4")),
+    ollama_max_connections=int(os.environ.get("OLLAMA_MAX_CONNECTIONS", "64")),
+    max_generations=_max_generations(),
+    generation_queue=int(os.environ.get("GENERATION_QUEUE", "64")),
+    generation_queue_timeout=float(os.environ.get("GENERATION_QUEUE_TIMEOUT", "60")),
+    priority_weights={"user": int(os.environ.get("USER_WEIGHT", "4")),
+                      "guest": int(os.environ.get("GUEST_WEIGHT", "1")),
+                      "warmup": 0},  # cache warm-up: only when nobody else waits
+    max_queued_per_client=int(os.environ.get("MAX_QUEUED_PER_CLIENT", "4")),
+    coalesce=os.environ.get("COALESCE", "1") == "1",
+    answer_cache=answer_cache,
+    dense_backend=os.environ.get("DENSE_BACKEND", "exact"),
+    nprobe=int(os.environ.get("NPROBE", "8")),
+    rescore=int(os.environ.get("DENSE_RESCORE", "4")),
+    query_cache_size=int(os.environ.get("QUERY_CACHE_SIZE", "4096")),
+    query_cache_path=os.environ.get("QUERY_CACHE_PATH", os.path.join(DATA_DIR, "query_emb_cache.npz")),
+    result_cache_size=int(os.environ.get("RESULT_CACHE_SIZE", "1024")),
+    result_cache_ttl=float(os.environ.get("RESULT_CACHE_TTL", "600")),
+)
+
+# questions and answers, in the CLI's log format ("" = don't log)
+CHAT_LOG_PATH = os.environ.get("CHAT_LOG_PATH", os.path.join(DATA_DIR, "chatbot_interactions.jsonl"))
+chat_logger = ChatLogger(CHAT_LOG_PATH) if CHAT_LOG_PATH else None
+
+# after every index (re)load, the most frequent logged questions are replayed into the answer cache
+cache_warmer = CacheWarmer(
+    rag,
+    CHAT_LOG_PATH,
+    top_n=int(os.environ.get("WARM_CACHE_TOP", "50")) if CHAT_LOG_PATH else 0,
+    min_count=int(os.environ.get("WARM_CACHE_MIN_COUNT", "2")),
+    interval=float(os.environ.get("WARM_CACHE_INTERVAL", "30")),
+    lock_path=os.path.join(DATA_DIR, "cache_warmer.lock"),
 )
 
 
@@ -71,6 +154,12 @@ def require_user(req: Request, db: Session = Depends(get_db)) -> User:
     return user
 
 
+@app.exception_handler(Overloaded)
+async def overloaded(request: Request, exc: Overloaded):
+    # 429 queue full / 503 waited too long; the client should retry after Retry-After seconds
+    return JSONResponse(exc.detail(), status_code=exc.status, headers={"Retry-After": str(exc.retry_after)})
+
+
 @app.middleware("http")
 async def no_cache_static(request: Request, call_next):
     resp = await call_next(request)
@@ -178,44 +267,242 @@ def api_send(chat_id: int, request: Request, user: User = Depends(require_user),
 # Make it async to read json body properly
 from fastapi import Body
 
+
+def _payload_filters(payload: dict) -> Optional[dict]:
+    """Optional retrieval filters of a send payload, validated up front (400 if invalid)"""
+    filters = payload.get("filters") or None
+    if filters is None:
+        return None
+    if not isinstance(filters, dict):
+        raise HTTPException(400, "filters must be an object")
+    try:
+        rag.retriever.meta_filters.mask(filters)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    return filters
+
+
+def _guest_client(request: Request) -> str:
+    # guests have no session: the client address stands in for one when sharing generation slots
+    return "guest:" + (request.client.host if request.client else "")
+
+
+def _store_exchange(db: Session, chat: Chat, question: Message, ans: Optional[str], sources: list) -> None:
+    # question, answer and title in one transaction: one commit (one WAL append) per send;
+    # ans None (or empty) = no answer came, keep the question alone
+    db.add(question)
+    if ans:
+        db.add(Message(chat_id=chat.id, role="assistant", content=ans, sources_json=json.dumps(sources, ensure_ascii=False)))
+
+    # Update chat title on first user message
+    if chat.title == "New chat":
+        chat.title = question.content[:40]
+        db.add(chat)
+    db.commit()
+
+
+def _log_interaction(text: str, ans: str, sources: list, start: float, endpoint: str) -> None:
+    if chat_logger is None:
+        return
+    try:
+        chat_logger.log_interaction(text, ans, [(s["score"], s) for s in sources],
+                                    "he" if is_hebrew(text) else "en", time.time() - start,
+                                    metadata={"endpoint": endpoint})
+    except OSError as e:
+        print(f"Chat log write failed: {e}")
+
+
+# Async handlers: the event loop only waits on Ollama (pooled async client), retrieval
+# runs in RagEngine's executor and the SQLite writes in the threadpool
 @app.post("/api/chats/{chat_id}/send_async")
-def api_send_async(chat_id: int, payload: dict = Body(...), user: User = Depends(require_user), db: Session = Depends(get_db)):
-    chat = db.get(Chat, chat_id)
+async def api_send_async(chat_id: int, payload: dict = Body(...), user: User = Depends(require_user), db: Session = Depends(get_db)):
+    chat = await run_in_threadpool(db.get, Chat, chat_id)
     if not chat or chat.user_id != user.id:
         raise HTTPException(404, "Chat not found")
 
     text = (payload.get("text") or "").strip()
     if not text:
         raise HTTPException(400, "Empty message")
+    filters = _payload_filters(payload)
 
-    # Store user message
-    db.add(Message(chat_id=chat_id, role="user", content=text))
-    db.commit()
-
-    # Update chat title on first user message
-    if chat.title == "New chat":
-        chat.title = text[:40]
-        db.add(chat)
-        db.commit()
+    # stored together with the answer (created_at still the time it was asked)
+    question = Message(chat_id=chat.id, role="user", content=text)
+    await run_in_threadpool(db.close)  # no pooled connection held while the answer is generated
+    start = time.time()
 
     # RAG answer
     want_he = True  # based on your audience; you can detect language if you want
-    ans, sources = rag.answer(text, want_hebrew=want_he)
+    try:
+        ans, sources = await rag.answer_async(text, want_hebrew=want_he, filters=filters,
+                                              priority="user", client=f"user:{user.id}")
+    except Overloaded:
+        raise  # refused before generating (429/503): the client retries, nothing to keep
+    except Exception:
+        await run_in_threadpool(_store_exchange, db, chat, question, None, [])
+        raise
 
-    # Store assistant message
-    db.add(Message(chat_id=chat_id, role="assistant", content=ans, sources_json=json.dumps(sources, ensure_ascii=False)))
-    db.commit()
+    await run_in_threadpool(_store_exchange, db, chat, question, ans, sources)
+    await run_in_threadpool(_log_interaction, text, ans, sources, start, "send_async")
 
     return {"answer": ans, "sources": sources}
 
 
 @app.post("/api/guest/send")
-def api_guest_send(payload: dict = Body(...)):
+async def api_guest_send(request: Request, payload: dict = Body(...)):
     text = (payload.get("text") or "").strip()
     if not text:
         raise HTTPException(400, "Empty message")
+    filters = _payload_filters(payload)
+    start = time.time()
 
-    ans, sources = rag.answer(text, want_hebrew=None)
+    ans, sources = await rag.answer_async(text, want_hebrew=None, filters=filters,
+                                          priority="guest", client=_guest_client(request), cache_answer=True)
 
     # No DB writes here (guest = no history)
-    return {"answer": ans, "sources": sources}
\ No newline at end of file
+    await run_in_threadpool(_log_interaction, text, ans, sources, start, "guest_send")
+    return {"answer": ans, "sources": sources}
+
+
+def _store_streamed_exchange(question: Message, ans: Optional[str], sources: list) -> None:
+    # own session: the request's one may already be closed while the response streams
+    with Session(engine) as db:
+        _store_exchange(db, db.get(Chat, question.chat_id), question, ans, sources)
+
+
+def _sse(event: str, data=None) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _answer_events(events, first: dict, text: str, start: float, endpoint: str,
+                         question: Optional[Message] = None):
+    """
+    RagEngine.answer_stream() as server-sent events; the answer is stored once it is
+    complete, or the question with the answer so far if the stream ends early
+    """
+    stored = question is None
+    partial: list = []
+    sources: list = []
+    try:
+        ev = first
+        while ev is not None:
+            if ev["event"] == "sources":
+                sources = ev["data"]
+            elif ev["event"] == "token":
+                partial.append(ev["data"])
+            elif ev["event"] == "reset":
+                partial = []
+            elif ev["event"] == "done":
+                ans, sources = ev["data"]["answer"], ev["data"]["sources"]
+                if question is not None:
+                    await run_in_threadpool(_store_streamed_exchange, question, ans, sources)
+                    stored = True
+                await run_in_threadpool(_log_interaction, text, ans, sources, start, endpoint)
+            yield _sse(ev["event"], ev.get("data"))
+            ev = await anext(events, None)
+    except Exception as e:
+        print(f"Streaming answer failed: {e}")
+        yield _sse("error", {"detail": "Answer generation failed"})
+    finally:
+        if not stored:
+            # client gone (or generation failed) mid-answer; the response task may be cancelled
+            # already, so the write runs in a thread of its own instead of being awaited
+            asyncio.get_running_loop().run_in_executor(
+                None, _store_streamed_exchange, question, "".join(partial).strip() or None, sources)
+        await events.aclose()
+
+
+async def _event_stream(text: str, want_hebrew: Optional[bool], filters: Optional[dict],
+                        priority: str, client: str, endpoint: str, question: Optional[Message] = None,
+                        cache_answer: bool = False) -> StreamingResponse:
+    # run up to the first event before responding, so a refused admission (Overloaded)
+    # is still a plain 429/503 rather than an error inside a 200 stream
+    start = time.time()
+    events = rag.answer_stream(text, want_hebrew=want_hebrew, filters=filters, priority=priority, client=client,
+                               cache_answer=cache_answer)
+    first = await anext(events)
+    # no-transform / X-Accel-Buffering: keep proxies from buffering the tokens
+    return StreamingResponse(_answer_events(events, first, text, start, endpoint, question), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"})
+
+
+# Streaming variants: same input as above, the answer arrives as server-sent events
+# (sources, token..., done; see RagEngine.answer_stream)
+@app.post("/api/chats/{chat_id}/send_stream")
+async def api_send_stream(chat_id: int, payload: dict = Body(...), user: User = Depends(require_user), db: Session = Depends(get_db)):
+    chat = await run_in_threadpool(db.get, Chat, chat_id)
+    if not chat or chat.user_id != user.id:
+        raise HTTPException(404, "Chat not found")
+
+    text = (payload.get("text") or "").strip()
+    if not text:
+        raise HTTPException(400, "Empty message")
+    filters = _payload_filters(payload)
+
+    question = Message(chat_id=chat.id, role="user", content=text)
+    await run_in_threadpool(db.close)
+    return await _event_stream(text, True, filters, "user", f"user:{user.id}", "send_stream", question=question)
+
+
+@app.post("/api/guest/send_stream")
+async def api_guest_send_stream(request: Request, payload: dict = Body(...)):
+    text = (payload.get("text") or "").strip()
+    if not text:
+        raise HTTPException(400, "Empty message")
+    filters = _payload_filters(payload)
+    return await _event_stream(text, None, filters, "guest", _guest_client(request), "guest_send_stream",
+                               cache_answer=True)
+
+
+@app.on_event("startup")
+def start_index_watch():
+    # runs in every worker, so each one follows CURRENT on its own
+    rag.watch_index(INDEX_WATCH_INTERVAL)
+
+
+@app.on_event("startup")
+async def start_cache_warmer():
+    # in every worker; a lock file lets only one of them warm at a time
+    cache_warmer.start()
+
+
+@app.on_event("shutdown")
+async def close_ollama_client():
+    await cache_warmer.stop()
+    await rag.aclose()
+
+
+def require_admin(req: Request):
+    token = req.headers.get("x-admin-token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(403, "Admin token required")
+
+
+@app.get("/api/stats")
+def api_stats(_: None = Depends(require_admin)):
+    # admin only: reload errors, file paths and cache/queue internals are not for the public
+    return {**rag.stats(), "cache_warmer": cache_warmer.stats()}
+
+
+@app.post("/api/admin/reload_index")
+def api_reload_index(payload: dict = Body(default={}), _: None = Depends(require_admin)):
+    """
+    Point CURRENT at an index version (default: keep CURRENT) and load it in the
+    background; the other workers follow CURRENT through their index watch
+    """
+    if WORKERS > 1 and INDEX_WATCH_INTERVAL <= 0:
+        # only the worker that got this request would switch; the others would keep the old index
+        raise HTTPException(409, "Several workers run without INDEX_WATCH_INTERVAL: set it, "
+                                 "or point CURRENT at the version and restart")
+    try:
+        return rag.reload(payload.get("version"), activate=True)
+    except (RuntimeError, ValueError) as e:
+        raise HTTPException(400, str(e))
+
+
+@app.post("/api/admin/warm_cache")
+async def api_warm_cache(_: None = Depends(require_admin)):
+    """Replay the most frequent logged questions into the answer cache again, now"""
+    if cache_warmer.top_n <= 0 or rag.answer_cache is None:
+        raise HTTPException(400, "Answer cache warm-up is disabled")
+    cache_warmer.trigger()
+    return cache_warmer.stats()
@@ -0,0 +1,126 @@
+# python ./webapp/bench_db.py --senders 1 4 16 64 --sends 200
+"""
+Chat-message write throughput of the app database under concurrent senders
+
+Every send stores a question and its answer and renames a new chat, as the
+chat endpoints do. Three setups are compared, each on a fresh database file:
+    default   SQLite defaults (rollback journal, synchronous=FULL), one commit
+              per write (question, title, answer: three per send)
+    wal       SQLITE_PRAGMAS (WAL, synchronous=NORMAL, ...), three commits per send
+    tuned     SQLITE_PRAGMAS, one transaction per send (what the app does)
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeout
+from sqlmodel import Session
+
+from db import Chat, Message, init_db, make_engine
+
+ANSWER = "תשובה לדוגמה [1]. " * 40
+SOURCES = '[{"n": 1, "score": 0.8, "url": "https://example.org/a", "title": "A"}]'
+
+
+def send_separate(db: Session, chat: Chat, text: str) -> None:
+    db.add(Message(chat_id=chat.id, role="user", content=text))
+    db.commit()
+    if chat.title == "New chat":
+        chat.title = text[:40]
+        db.add(chat)
+        db.commit()
+    db.add(Message(chat_id=chat.id, role="assistant", content=ANSWER, sources_json=SOURCES))
+    db.commit()
+
+
+def send_single(db: Session, chat: Chat, text: str) -> None:
+    db.add(Message(chat_id=chat.id, role="user", content=text))
+    db.add(Message(chat_id=chat.id, role="assistant", content=ANSWER, sources_json=SOURCES))
+    if chat.title == "New chat":
+        chat.title = text[:40]
+        db.add(chat)
+    db.commit()
+
+
+SETUPS = {
+    "default": ({}, send_separate),
+    "wal": (None, send_separate),
+    "tuned": (None, send_single),
+}
+
+
+def run(db_path: str, setup: str, senders: int, sends: int) -> Dict[str, float]:
+    pragmas, send = SETUPS[setup]
+    engine = make_engine(db_path, pragmas=pragmas)
+    init_db(engine)
+    with Session(engine) as db:
+        chats = [Chat(user_id=i, title="New chat") for i in range(senders)]
+        db.add_all(chats)
+        db.commit()
+        chat_ids = [c.id for c in chats]
+
+    latencies: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def sender(chat_id: int) -> None:
+        nonlocal errors
+        for i in range(sends):
+            start = time.perf_counter()
+            try:
+                # a session per send, like a request
+                with Session(engine) as db:
+                    send(db, db.get(Chat, chat_id), f"question {i} of chat {chat_id}")
+            except (OperationalError, PoolTimeout):  # "database is locked" / no free pooled connection
+                with lock:
+                    errors += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=senders) as pool:
+        list(pool.map(sender, chat_ids))
+    elapsed = time.perf_counter() - start
+    engine.dispose()
+
+    lat = np.array(latencies) * 1000.0 if latencies else np.full(1, np.nan)
+    return {
+        "sends_per_s": len(latencies) / elapsed,
+        "messages_per_s": 2 * len(latencies) / elapsed,
+        "p50_ms": float(np.percentile(lat, 50)),
+        "p95_ms": float(np.percentile(lat, 95)),
+        "errors": errors,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--senders", type=int, nargs="+", default=[1, 4, 16, 64])
+    ap.add_argument("--sends", type=int, default=200, help="sends per sender")
+    ap.add_argument("--setups", nargs="+", default=list(SETUPS), choices=list(SETUPS))
+    ap.add_argument("--dir", default=None, help="where to put the databases (default: a temp dir; "
+                                                  "use the disk data/ lives on for realistic fsync costs)")
+    args = ap.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_db_", dir=args.dir)
+    try:
+        print(f"{'setup':>8} {'senders':>8} {'sends/s':>9} {'msgs/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7}")
+        for setup in args.setups:
+            for n in args.senders:
+                db_path = os.path.join(workdir, f"{setup}_{n}.db")
+                r = run(db_path, setup, n, args.sends)
+                print(f"{setup:>8} {n:>8} {r['sends_per_s']:>9.0f} {r['messages_per_s']:>9.0f} "
+                      f"{r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['errors']:>7}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
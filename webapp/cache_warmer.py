@@ -0,0 +1,166 @@
+"""
+Answer-cache warm-up from the chat log
+
+Whenever the served index changes (at startup and after every reload), the
+N most frequent logged questions are replayed through RagEngine as guest
+questions, one at a time and only while the generation queue is empty, so
+the popular questions are already in the answer cache when the peak comes.
+Replays use their own priority class (weight 0), so a real request that
+arrives meanwhile is always served first.
+
+With several prefork workers, a lock file elects the one that warms; the
+others skip the pass and find its answers through the shared answer-cache
+table. A worker that warms later (the lock is free again) mostly gets cache
+hits, which cost no generation.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # not on Windows: every worker warms
+    fcntl = None
+
+
+def top_queries(log_path: str, n: int, min_count: int = 2) -> List[Tuple[str, int]]:
+    """
+    The n most frequent questions of a ChatLogger file, as (question, count);
+    questions are counted after collapsing whitespace and case, and each is
+    returned in its most common spelling
+    """
+    counts: Counter = Counter()
+    spellings: Dict[str, Counter] = defaultdict(Counter)
+    with open(log_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                q = " ".join((json.loads(line).get("query") or "").split())
+            except ValueError:
+                continue  # a line cut off by a crash
+            if q:
+                key = q.casefold()
+                counts[key] += 1
+                spellings[key][q] += 1
+    return [(spellings[key].most_common(1)[0][0], c)
+            for key, c in counts.most_common(n) if c >= min_count]
+
+
+class CacheWarmer:
+    def __init__(self, rag, log_path: str, top_n: int = 50, min_count: int = 2,
+                 interval: float = 30.0, priority: Optional[str] = "warmup", lock_path: Optional[str] = None):
+        """
+        Args:
+            rag: RagEngine with an answer cache
+            log_path: ChatLogger file of past questions
+            top_n: Questions replayed per index
+            min_count: Questions asked fewer times are not replayed
+            interval: Seconds between checks for a new index / an idle queue
+            priority: Priority class of the replays (should have weight 0)
+            lock_path: Lock file shared by the workers; only its holder warms
+        """
+        self.rag = rag
+        self.log_path = log_path
+        self.top_n = top_n
+        self.min_count = min_count
+        self.interval = interval
+        self.priority = priority
+        self.lock_path = lock_path
+        self.warmed_fingerprint: Optional[str] = None
+        self._forced = False
+        self._task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+        self.status: Dict[str, Any] = {"state": "idle"}
+
+    def _idle(self) -> bool:
+        limiter = self.rag.limiter
+        return limiter is None or (limiter.waiting == 0 and limiter.active < limiter.max_active)
+
+    def start(self) -> None:
+        """Run in the background of the current event loop"""
+        if self._task is None and self.top_n > 0 and self.rag.answer_cache is not None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def trigger(self) -> None:
+        """Warm again now, even if this index was warmed already (call from the event loop)"""
+        self._forced = True
+        self._wake.set()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            fingerprint = self.rag.retriever.fingerprint
+            if (fingerprint != self.warmed_fingerprint or self._forced) and os.path.exists(self.log_path):
+                self._forced = False
+                try:
+                    await self.warm(fingerprint)
+                except Exception as e:
+                    self.status = {"state": "failed", "error": str(e)}
+                    print(f"Answer cache warm-up failed: {e}")
+                    self.warmed_fingerprint = fingerprint
+                if self.rag.retriever.fingerprint != self.warmed_fingerprint:
+                    continue  # reloaded while warming: warm the new index right away
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    def _try_lock(self):
+        """Open lock file if this worker may warm now, None if another one is warming"""
+        if self.lock_path is None or fcntl is None:
+            return open(os.devnull, "a")
+        f = open(self.lock_path, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+        return f
+
+    async def warm(self, fingerprint: str) -> None:
+        lock = self._try_lock()
+        if lock is None:
+            self.warmed_fingerprint = fingerprint
+            self.status = {"state": "skipped", "index": self.rag.index_version,
+                           "reason": "another worker is warming the shared cache"}
+            return
+        with lock:  # closing the file releases the lock
+            await self._warm(fingerprint)
+
+    async def _warm(self, fingerprint: str) -> None:
+        queries = await asyncio.get_running_loop().run_in_executor(
+            self.rag.executor, top_queries, self.log_path, self.top_n, self.min_count)
+        start = time.time()
+        self.status = {"state": "running", "index": self.rag.index_version, "queries": len(queries),
+                       "replayed": 0, "failed": 0}
+        for q, _ in queries:
+            # a newer index makes this pass pointless; the next loop warms that one
+            if self.rag.retriever.fingerprint != fingerprint:
+                return
+            while not self._idle():
+                await asyncio.sleep(1.0)
+            try:
+                await self.rag.answer_async(q, want_hebrew=None, priority=self.priority, client="warmup",
+                                            cache_answer=True)
+                self.status["replayed"] += 1
+            except Exception as e:  # Overloaded, Ollama down, ...: skip this one
+                self.status["failed"] += 1
+                self.status["last_error"] = str(e)
+        self.warmed_fingerprint = fingerprint
+        self.status.update(state="done", seconds=round(time.time() - start, 1))
+        print(f"Answer cache warmed: {self.status['replayed']} of {len(queries)} frequent questions "
+              f"in {self.status['seconds']}s")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"top_n": self.top_n, "log_path": self.log_path, **self.status}
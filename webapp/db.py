@@ -1,7 +1,22 @@
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Optional
+from sqlalchemy import event
 from sqlmodel import SQLModel, Field, create_engine
 
+# Applied to every new connection:
+# - WAL: readers don't block the writer and a commit appends to the log instead of
+#   rewriting pages; with synchronous=NORMAL it is fsynced at checkpoints, not per commit
+#   (a power cut may lose the last commits, never corrupt the database)
+# - busy_timeout: a writer waits for the lock instead of failing with "database is locked"
+SQLITE_PRAGMAS: Dict[str, object] = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -32000,  # KiB (negative), ~32 MiB of page cache per connection
+    "mmap_size": 256 * 1024 * 1024,
+    "busy_timeout": 5000,  # ms
+    "temp_store": "MEMORY",
+}
+
 class User(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     username: str = Field(index=True, unique=True)
@@ -22,8 +37,29 @@ class Message(SQLModel, table=True):
     sources_json: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
-def make_engine(db_path: str):
-    return create_engine(f"sqlite:///{db_path}", connect_args={"check_same_thread": False})
+class AnswerCacheEntry(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    fingerprint: str = Field(index=True)  # index the answer was generated from
+    lang: str  # "he" / "en"
+    chunk_ids: str  # JSON list of the retrieved source chunk ids
+    query: str
+    embedding: bytes  # float32 query embedding
+    answer: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+def make_engine(db_path: str, pragmas: Optional[Dict[str, object]] = None):
+    """SQLite engine with SQLITE_PRAGMAS (or the given ones; {} = SQLite defaults)"""
+    engine = create_engine(f"sqlite:///{db_path}", connect_args={"check_same_thread": False})
+    pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_conn, _):
+        cur = dbapi_conn.cursor()
+        for name, value in pragmas.items():
+            cur.execute(f"PRAGMA {name}={value}")
+        cur.close()
+
+    return engine
 
 def init_db(engine):
     SQLModel.metadata.create_all(engine)
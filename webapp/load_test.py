@@ -0,0 +1,169 @@
+# python ./webapp/load_test.py fake-ollama --port 11500 --delay 2
+# OLLAMA_URL=http://127.0.0.1:11500 uvicorn webapp.app:app
+# python ./webapp/load_test.py run --url http://127.0.0.1:8000 --concurrency 8 32 128
+# python ./webapp/load_test.py run --stream --concurrency 8 32
+"""
+Concurrent-capacity load test for /api/guest/send
+
+"run" keeps N requests in flight for --duration seconds per concurrency
+level and reports throughput, latency percentiles, errors and requests
+refused by admission control (429/503); with
+--stream it uses /api/guest/send_stream and also reports the time to the
+first answer token.
+"fake-ollama" serves /api/chat with a fixed delay (spread over the tokens
+when the request asks for a stream), so the app's own capacity can be
+measured without a GPU (compare against the previous sync handlers by
+running the same test on the older checkout).
+"""
+import argparse
+import asyncio
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+FAKE_ANSWER = "תשובה לדוגמה [1]. זו שורה נוספת של התשובה, עם ציטוט נוסף [2].\n- פריט ראשון [1]\n- פריט שני [2]"
+
+QUESTIONS = [
+    "מה שכר הלימוד לתואר שני במדעי המחשב?",
+    "מתי מועד אחרון להרשמה?",
+    "תנאי קבלה לתואר ראשון",
+    "מי ראש החוג למערכות מידע?",
+    "who is the head of the computer science department?",
+    "office hours of the faculty secretary",
+]
+
+
+def fake_ollama(port: int, delay: float) -> None:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if request.get("stream"):
+                self._stream()
+                return
+            time.sleep(delay)
+            body = json.dumps({"message": {"role": "assistant", "content": FAKE_ANSWER}}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _stream(self):
+            # Ollama's format: one JSON object per line, chunked
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            words = FAKE_ANSWER.split(" ")
+            for i, word in enumerate(words):
+                time.sleep(delay / len(words))
+                delta = word if i == 0 else " " + word
+                self._chunk({"message": {"role": "assistant", "content": delta}, "done": False})
+            self._chunk({"message": {"role": "assistant", "content": ""}, "done": True})
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _chunk(self, obj):
+            data = json.dumps(obj, ensure_ascii=False).encode("utf-8") + b"\n"
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def log_message(self, *args):
+            pass
+
+    print(f"Fake Ollama on 127.0.0.1:{port}, {delay}s per answer")
+    ThreadingHTTPServer(("127.0.0.1", port), Handler).serve_forever()
+
+
+async def send_stream(client, text: str):
+    """Time to the first token event of /api/guest/send_stream (raises unless a done event arrives)"""
+    start = time.perf_counter()
+    first, done = None, False
+    async with client.stream("POST", "/api/guest/send_stream", json={"text": text}) as r:
+        r.raise_for_status()
+        async for line in r.aiter_lines():
+            if line == "event: token" and first is None:
+                first = time.perf_counter() - start
+            elif line == "event: error":
+                raise RuntimeError("error event")
+            elif line == "event: done":
+                done = True
+    if not done:
+        raise RuntimeError("stream ended without a done event")
+    return first if first is not None else time.perf_counter() - start
+
+
+async def run_level(url: str, concurrency: int, duration: float, timeout: float, stream: bool = False):
+    import httpx
+
+    latencies, first_tokens, errors, refused = [], [], 0, 0
+    stop = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        async def user(i: int):
+            nonlocal errors, refused
+            n = i
+            while time.perf_counter() < stop:
+                start = time.perf_counter()
+                try:
+                    text = QUESTIONS[n % len(QUESTIONS)]
+                    if stream:
+                        first_tokens.append(await send_stream(client, text))
+                    else:
+                        r = await client.post("/api/guest/send", json={"text": text})
+                        r.raise_for_status()
+                    latencies.append(time.perf_counter() - start)
+                except httpx.HTTPStatusError as e:
+                    if e.response.status_code in (429, 503):
+                        refused += 1
+                        await asyncio.sleep(float(e.response.headers.get("Retry-After", "1")))
+                    else:
+                        errors += 1
+                except Exception:
+                    errors += 1
+                n += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user(i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    lat = np.array(latencies) if latencies else np.zeros(1)
+    line = (f"{concurrency:>11} {len(latencies):>6} {errors:>6} {refused:>7} {len(latencies) / elapsed:>8.2f} "
+            f"{np.percentile(lat, 50):>7.2f} {np.percentile(lat, 95):>7.2f} {lat.max():>7.2f}")
+    if stream:
+        ttft = np.array(first_tokens) if first_tokens else np.zeros(1)
+        line += f" {np.percentile(ttft, 50):>11.2f} {np.percentile(ttft, 95):>11.2f}"
+    print(line)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    f = sub.add_parser("fake-ollama")
+    f.add_argument("--port", type=int, default=11500)
+    f.add_argument("--delay", type=float, default=2.0, help="seconds per answer")
+    r = sub.add_parser("run")
+    r.add_argument("--url", default="http://127.0.0.1:8000")
+    r.add_argument("--concurrency", type=int, nargs="+", default=[8, 32, 128])
+    r.add_argument("--duration", type=float, default=30.0, help="seconds per concurrency level")
+    r.add_argument("--timeout", type=float, default=300.0)
+    r.add_argument("--stream", action="store_true", help="use /api/guest/send_stream (adds time to first token)")
+    args = ap.parse_args()
+
+    if args.cmd == "fake-ollama":
+        fake_ollama(args.port, args.delay)
+        return
+
+    header = f"{'concurrency':>11} {'ok':>6} {'errors':>6} {'refused':>7} {'req/s':>8} {'p50 s':>7} {'p95 s':>7} {'max s':>7}"
+    if args.stream:
+        header += f" {'first p50 s':>11} {'first p95 s':>11}"
+    print(header)
+    for c in args.concurrency:
+        asyncio.run(run_level(args.url, c, args.duration, args.timeout, stream=args.stream))
+
+
+if __name__ == "__main__":
+    main()
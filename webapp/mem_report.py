@@ -0,0 +1,62 @@
+# python ./webapp/mem_report.py $(pgrep -o -f "gunicorn -c gunicorn.conf.py")
+"""
+RSS / PSS / shared / private memory of a process and its children (Linux)
+
+RSS counts every resident page, so pages shared by the prefork workers are
+counted once per worker; PSS splits each shared page between the processes
+mapping it, so the PSS total is the real footprint of the whole server.
+"""
+import argparse
+import os
+from typing import Dict, List
+
+
+def read_rollup(pid: int) -> Dict[str, int]:
+    """Memory counters of /proc/<pid>/smaps_rollup, in KiB"""
+    out = {}
+    with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                out[parts[0][:-1]] = int(parts[1])
+    return out
+
+
+def children(pid: int) -> List[int]:
+    out = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                # the command name may contain spaces; ppid follows the closing paren
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            out.append(int(entry))
+    return sorted(out)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("pid", type=int, help="gunicorn master (or any parent) pid")
+    args = ap.parse_args()
+
+    pids = [args.pid] + children(args.pid)
+    print(f"{'pid':>8} {'role':>7} {'RSS MiB':>9} {'PSS MiB':>9} {'shared MiB':>11} {'private MiB':>12}")
+    total_rss = total_pss = 0
+    for pid in pids:
+        r = read_rollup(pid)
+        shared = r.get("Shared_Clean", 0) + r.get("Shared_Dirty", 0)
+        private = r.get("Private_Clean", 0) + r.get("Private_Dirty", 0)
+        total_rss += r.get("Rss", 0)
+        total_pss += r.get("Pss", 0)
+        role = "master" if pid == args.pid else "worker"
+        print(f"{pid:>8} {role:>7} {r.get('Rss', 0) / 1024:>9.1f} {r.get('Pss', 0) / 1024:>9.1f} "
+              f"{shared / 1024:>11.1f} {private / 1024:>12.1f}")
+    print(f"{'total':>16} {total_rss / 1024:>9.1f} {total_pss / 1024:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,44 @@
+import asyncio
+import atexit
+import contextlib
+import functools
 import json
 import os
 import re
+import threading
 import time
-from typing import List, Dict, Any, Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, AsyncIterator, Tuple, Optional
 
+import httpx
 import numpy as np
 import requests
-from sentence_transformers import SentenceTransformer
 
 # HybridRetriever import (support both layouts)
 try:
     from chatbot.hybrid_retriever import HybridRetriever
+    from chatbot.dense_index import DEFAULT_DIRS
+    from chatbot.query_cache import EmbeddingCache, ResultCache
+    from chatbot.meta_store import MetaStore
+    from chatbot.index_versions import index_paths, read_current, version_dir, write_current
+    from chatbot.onnx_encoder import load_encoder
+    from chatbot.encode_batcher import BatchingEncoder
+    from chatbot.admission import GenerationLimiter, Overloaded, SlotGroup
+    from chatbot.single_flight import SingleFlight
+    from chatbot.meta_filters import filter_key
+    from chatbot.logger import ChatLogger
 except Exception:
     from hybrid_retriever import HybridRetriever
+    from dense_index import DEFAULT_DIRS
+    from query_cache import EmbeddingCache, ResultCache
+    from meta_store import MetaStore
+    from index_versions import index_paths, read_current, version_dir, write_current
+    from onnx_encoder import load_encoder
+    from encode_batcher import BatchingEncoder
+    from admission import GenerationLimiter, Overloaded, SlotGroup
+    from single_flight import SingleFlight
+    from meta_filters import filter_key
+    from logger import ChatLogger
 
 
 # Forbidden scripts: Cyrillic, Arabic, Hangul, CJK (Chinese/Japanese), etc.
@@ -147,6 +173,87 @@ def strip_sources_footer(ans: str) -> str:
     # remove markdown bold if model still uses it
     return "\n".join(out).replace("**", "").strip()
 
+
+SOURCES_HEADERS = ("מקורות:", "sources:")
+FOOTER_PREFIX_RE = re.compile(r"\[\d*(\]\s*)?")
+
+
+class FooterFilter:
+    """
+    strip_sources_footer() for a streamed answer: feed() takes model deltas and
+    returns the text that is safe to show. A line that could still turn into
+    a "[n] — title" footer or a "Sources:" header is held back until it
+    can't; after a header, everything is dropped (stopped = True).
+    """
+
+    def __init__(self):
+        self.line = ""  # current, unfinished line
+        self.shown = 0  # chars of it already returned
+        self.held = ""  # trailing "*" that may start a "**"
+        self.started = False
+        self.stopped = False
+
+    @staticmethod
+    def _may_be_footer(line: str) -> bool:
+        s = line.strip().lower()
+        return (not s or any(h.startswith(s) for h in SOURCES_HEADERS)
+                or FOOTER_PREFIX_RE.fullmatch(s) is not None or SOURCES_FOOTER_LINE.match(s) is not None)
+
+    def _end_line(self, newline: str) -> str:
+        line, shown = self.line, self.shown
+        self.line, self.shown = "", 0
+        if line.strip().lower() in SOURCES_HEADERS:
+            self.stopped = True
+            return ""
+        if not shown and SOURCES_FOOTER_LINE.match(line):
+            return ""
+        return line[shown:] + newline
+
+    def _emit(self, text: str) -> str:
+        text = self.held + text
+        self.held = ""
+        # an odd run of trailing "*" leaves one that may pair with the next delta
+        if (len(text) - len(text.rstrip("*"))) % 2:
+            text, self.held = text[:-1], "*"
+        text = text.replace("**", "")
+        if not self.started:
+            text = text.lstrip()
+            self.started = bool(text)
+        return text
+
+    def feed(self, delta: str) -> str:
+        if self.stopped:
+            return ""
+        out = []
+        *done, rest = delta.split("\n")
+        for part in done:
+            self.line += part
+            out.append(self._end_line("\n"))
+            if self.stopped:
+                return self._emit("".join(out))
+        self.line += rest
+        if self.shown or not self._may_be_footer(self.line):
+            out.append(self.line[self.shown:])
+            self.shown = len(self.line)
+        return self._emit("".join(out))
+
+    def flush(self) -> str:
+        """Rest of the answer once the model is done"""
+        if self.stopped:
+            return ""
+        text = self._emit(self._end_line(""))
+        text, self.held = text + self.held, ""
+        return text
+
+
+RETRY_LANGUAGE_MSG = {
+    "role": "user",
+    "content": "Your previous response contained languages other than Hebrew/English. "
+               "Please answer again using ONLY Hebrew or English characters. "
+               "Keep citations like [1]. Do not add new facts."
+}
+
+
 class RagEngine:
     def __init__(
         self,
@@ -162,28 +269,73 @@ class RagEngine:
         max_chars_each: int = 1600,
         history_turns: int = 8,
         enforce_exact_numbers: bool = True,
+        bm25_path: Optional[str] = None,
+        dense_backend: str = "exact",
+        dense_path: Optional[str] = None,
+        nprobe: int = 8,
+        rescore: int = 4,
+        query_cache_size: int = 4096,
+        query_cache_path: Optional[str] = None,
+        result_cache_size: int = 1024,
+        result_cache_ttl: float = 600.0,
+        fusion: str = "minmax",
+        mmr_lambda: float = 1.0,
+        meta_store_path: Optional[str] = None,
+        index_root: Optional[str] = None,
+        encoder: str = "torch",
+        onnx_path: Optional[str] = None,
+        encode_batch_size: int = 32,
+        encode_max_wait_ms: float = 2.0,
+        retrieval_workers: int = 4,
+        ollama_max_connections: int = 64,
+        max_generations: int = 8,
+        generation_queue: int = 64,
+        generation_queue_timeout: float = 60.0,
+        priority_weights: Optional[Dict[str, int]] = None,
+        max_queued_per_client: int = 0,
+        coalesce: bool = True,
+        answer_cache=None,
     ):
-        if not os.path.exists(emb_path):
-            raise RuntimeError(f"Embeddings not found: {emb_path}")
-        if not os.path.exists(meta_path):
-            raise RuntimeError(f"Metadata not found: {meta_path}")
-
-        # memory-friendly load
-        E = np.load(emb_path, mmap_mode="r")
-        if E.dtype != np.float32:
-            E = E.astype(np.float32)
-
-        metas = load_meta(meta_path)
-        if len(metas) != E.shape[0]:
-            raise RuntimeError("Meta rows must match embeddings rows")
-
-        self.E = E
-        self.metas = metas
-
-        self.embed_model = SentenceTransformer(embed_model_name)
+        # "torch" (SentenceTransformer) or "onnx" (ONNX Runtime export, see chatbot/onnx_encoder.py)
+        self.embed_model = load_encoder(encoder, embed_model_name, onnx_path)
+        cache_name = embed_model_name if encoder == "torch" else f"{embed_model_name}|{self.embed_model.name}"
+        # concurrent requests' queries are encoded together (0 = encode each call on its own)
+        if encode_batch_size > 0:
+            self.embed_model = BatchingEncoder(self.embed_model, max_batch=encode_batch_size,
+                                               max_wait_ms=encode_max_wait_ms)
+
+        # repeated questions skip the encoder; persisted on shutdown if a path is given
+        self.query_cache = None
+        if query_cache_size > 0:
+            self.query_cache = EmbeddingCache(cache_name, max_size=query_cache_size, path=query_cache_path)
+            if query_cache_path:
+                atexit.register(self.query_cache.save)
+
+        # full retrieval results; keyed on the index fingerprint, so a new index invalidates them
+        self.result_cache = None
+        if result_cache_size > 0:
+            self.result_cache = ResultCache(max_size=result_cache_size, ttl=result_cache_ttl)
 
         self.ollama_url = ollama_url.rstrip("/")
         self.llm_model = llm_model
+        # keep-alive connections to Ollama: a pooled session for answer(), a pooled
+        # AsyncClient (created on first use inside the event loop) for answer_async()
+        self.http = requests.Session()
+        self.ollama_max_connections = ollama_max_connections
+        self._async_http: Optional[httpx.AsyncClient] = None
+        # CPU-bound retrieval of answer_async() runs here, off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=retrieval_workers, thread_name_prefix="retrieval")
+        # admission control for answer_async()/answer_stream(): at most max_generations answers
+        # at once, a bounded queue behind them, Overloaded beyond that (0 = no limit); freed
+        # slots are shared among priority classes by weight and among clients in turn
+        self.limiter = None
+        if max_generations > 0:
+            self.limiter = GenerationLimiter(max_generations, max_queue=generation_queue,
+                                             queue_timeout=generation_queue_timeout,
+                                             weights=priority_weights,
+                                             max_queued_per_client=max_queued_per_client)
+        # identical history-free questions already being answered share that answer
+        self.flights = SingleFlight() if coalesce else None
         self.topk = topk
         self.num_ctx = num_ctx
 
@@ -192,29 +344,249 @@ class RagEngine:
         self.history_turns = history_turns
         self.enforce_exact_numbers = enforce_exact_numbers
 
-        self.retriever = HybridRetriever(self.E, self.metas, self.embed_model, alpha=alpha)
+        self.retriever_kwargs = dict(alpha=alpha, dense_backend=dense_backend, nprobe=nprobe,
+                                     rescore=rescore, fusion=fusion, mmr_lambda=mmr_lambda)
 
-    def ollama_chat(self, messages, temperature=0.1, top_p=0.9) -> str:
-        payload = {
+        # versioned layout (index_root/<version>, selected by index_root/CURRENT) if present,
+        # else the explicitly given files
+        self.index_root = index_root
+        self.index_version = read_current(index_root) if index_root else None
+        if self.index_version:
+            paths = index_paths(version_dir(index_root, self.index_version))
+        else:
+            paths = dict(emb_path=emb_path, meta_path=meta_path, bm25_path=bm25_path,
+                         meta_store_path=meta_store_path, dense_path=dense_path)
+        self.retriever = self._load_retriever(**paths)
+
+        # SemanticAnswerCache (webapp/answer_cache.py) for cache_answer=True requests; holds
+        # answers of the current index only
+        self.answer_cache = answer_cache
+        if answer_cache is not None:
+            answer_cache.invalidate(self.retriever.fingerprint)
+
+        self.reload_status: Dict[str, Any] = {}
+        self._reload_lock = threading.Lock()
+        self._reload_thread: Optional[threading.Thread] = None
+        self._watch_thread: Optional[threading.Thread] = None
+
+    @property
+    def E(self) -> np.ndarray:
+        return self.retriever.E
+
+    @property
+    def metas(self):
+        return self.retriever.metas
+
+    def _load_retriever(self, emb_path: str, meta_path: str, bm25_path: Optional[str] = None,
+                        meta_store_path: Optional[str] = None,
+                        dense_path: Optional[str] = None) -> HybridRetriever:
+        """Load one index (embeddings, metadata, BM25 and dense indexes) into a retriever"""
+        if not os.path.exists(emb_path):
+            raise RuntimeError(f"Embeddings not found: {emb_path}")
+
+        # memory-friendly load
+        E = np.load(emb_path, mmap_mode="r")
+        if E.dtype != np.float32:
+            E = E.astype(np.float32)
+
+        # columnar metadata (mmapped, rows decoded on demand) when build_index.py wrote it
+        # together with these embeddings, else the full list of dicts from cis_meta.jsonl
+        if meta_store_path is None:
+            meta_store_path = os.path.join(os.path.dirname(emb_path), "cis_meta_store")
+        metas = MetaStore.load(meta_store_path, rows=E.shape[0], emb_path=emb_path)
+        if metas is None:
+            if os.path.isdir(meta_store_path):
+                print(f"Meta store at {meta_store_path} does not match {emb_path}, reading {meta_path}")
+            if not os.path.exists(meta_path):
+                raise RuntimeError(f"Metadata not found: {meta_path}")
+            metas = load_meta(meta_path)
+            if len(metas) != E.shape[0]:
+                raise RuntimeError("Meta rows must match embeddings rows")
+
+        # prebuilt BM25 index lives next to the embeddings by default
+        if bm25_path is None:
+            bm25_path = os.path.join(os.path.dirname(emb_path), "cis_bm25")
+        dense_backend = self.retriever_kwargs["dense_backend"]
+        if dense_path is None and dense_backend in DEFAULT_DIRS:
+            dense_path = os.path.join(os.path.dirname(emb_path), DEFAULT_DIRS[dense_backend])
+
+        return HybridRetriever(
+            E, metas, self.embed_model, bm25_path=bm25_path, dense_path=dense_path,
+            query_cache=self.query_cache, result_cache=self.result_cache,
+            **self.retriever_kwargs,
+        )
+
+    def reload(self, version: Optional[str] = None, wait: bool = False, activate: bool = False) -> Dict[str, Any]:
+        """
+        Load an index version (default: the one CURRENT points at) in a
+        background thread and swap it in once it is ready. Requests already
+        running finish on the retriever they started with. activate also
+        points CURRENT at the version, so other processes watching it follow.
+        """
+        if not self.index_root:
+            raise RuntimeError("No index_root configured")
+        version = version or read_current(self.index_root)
+        if not version:
+            raise RuntimeError(f"No CURRENT index version under {self.index_root}")
+        if not os.path.isdir(version_dir(self.index_root, version)):
+            raise ValueError(f"Unknown index version: {version}")
+        if activate and version != read_current(self.index_root):
+            write_current(self.index_root, version)
+
+        with self._reload_lock:
+            if self._reload_thread is not None and self._reload_thread.is_alive():
+                return {"status": "busy", "version": self.reload_status.get("version")}
+            self.reload_status = {"version": version, "state": "loading"}
+            thread = threading.Thread(target=self._reload, args=(version,), name="index-reload", daemon=True)
+            self._reload_thread = thread
+            thread.start()
+
+        if wait:
+            thread.join()
+            return dict(self.reload_status)
+        return {"status": "started", "version": version}
+
+    def _reload(self, version: str) -> None:
+        start = time.time()
+        try:
+            retriever = self._load_retriever(**index_paths(version_dir(self.index_root, version)))
+        except Exception as e:
+            print(f"Index reload of {version} failed, still serving {self.index_version}: {e}")
+            self.reload_status = {"version": version, "state": "failed", "error": str(e)}
+            return
+        # one reference assignment: new requests see the new index at once
+        self.retriever = retriever
+        if self.answer_cache is not None:
+            self.answer_cache.invalidate(retriever.fingerprint)
+        previous, self.index_version = self.index_version, version
+        seconds = time.time() - start
+        print(f"Index {version} loaded in {seconds:.1f}s (was {previous})")
+        self.reload_status = {"version": version, "state": "ready", "seconds": round(seconds, 2)}
+
+    def watch_index(self, interval: float) -> None:
+        """Poll CURRENT every interval seconds and reload when it changes"""
+        if not self.index_root or interval <= 0 or self._watch_thread is not None:
+            return
+
+        def loop():
+            seen = self.index_version
+            while True:
+                time.sleep(interval)
+                current = read_current(self.index_root)
+                if current and current != seen and current == self.index_version:
+                    seen = current  # already loaded here (e.g. by the admin endpoint)
+                elif current and current != seen:
+                    try:
+                        # retried on the next tick while another reload is running
+                        if self.reload(current).get("status") != "busy":
+                            seen = current
+                    except (RuntimeError, ValueError) as e:
+                        seen = current
+                        print(f"Index watch: {e}")
+
+        self._watch_thread = threading.Thread(target=loop, name="index-watch", daemon=True)
+        self._watch_thread.start()
+
+    def stats(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"index": {"version": self.index_version, "reload": dict(self.reload_status)}}
+        if self.query_cache is not None:
+            out["query_cache"] = self.query_cache.stats()
+        if self.result_cache is not None:
+            out["result_cache"] = self.result_cache.stats()
+        if isinstance(self.embed_model, BatchingEncoder):
+            out["encoder_batching"] = self.embed_model.stats()
+        if self.limiter is not None:
+            out["generation"] = self.limiter.stats()
+        if self.flights is not None:
+            out["coalescing"] = self.flights.stats()
+        if self.answer_cache is not None:
+            out["answer_cache"] = self.answer_cache.stats()
+        return out
+
+    def generation_slot(self, priority: Optional[str] = None, client: str = "", callers=None):
+        """
+        Async context manager holding one generation slot (raises Overloaded when full);
+        callers: the SlotGroup of a shared generation, which then waits as its heaviest caller
+        """
+        if self.limiter is None:
+            return contextlib.nullcontext()
+        return self.limiter.slot(priority, client, callers)
+
+    def _slot_group(self):
+        """Callers of a shared flight: a SlotGroup, so that joining can raise its priority"""
+        return SlotGroup(self.limiter) if self.limiter is not None else []
+
+    def _ollama_payload(self, messages, temperature: float, top_p: float) -> Dict[str, Any]:
+        return {
             "model": self.llm_model,
             "messages": messages,
             "stream": False,
             "options": {"temperature": temperature, "top_p": top_p, "num_ctx": self.num_ctx},
         }
-        r = requests.post(self.ollama_url + "/api/chat", json=payload, timeout=180)
+
+    def ollama_chat(self, messages, temperature=0.1, top_p=0.9) -> str:
+        payload = self._ollama_payload(messages, temperature, top_p)
+        r = self.http.post(self.ollama_url + "/api/chat", json=payload, timeout=180)
         r.raise_for_status()
         return r.json()["message"]["content"]
 
-    def answer(
+    def _async_client(self) -> httpx.AsyncClient:
+        if self._async_http is None:
+            self._async_http = httpx.AsyncClient(
+                base_url=self.ollama_url,
+                timeout=httpx.Timeout(180.0, connect=10.0),
+                limits=httpx.Limits(max_connections=self.ollama_max_connections,
+                                    max_keepalive_connections=self.ollama_max_connections),
+            )
+        return self._async_http
+
+    async def ollama_chat_async(self, messages, temperature=0.1, top_p=0.9) -> str:
+        payload = self._ollama_payload(messages, temperature, top_p)
+        r = await self._async_client().post("/api/chat", json=payload)
+        r.raise_for_status()
+        return r.json()["message"]["content"]
+
+    async def ollama_chat_stream(self, messages, temperature=0.1, top_p=0.9) -> AsyncIterator[str]:
+        """Content deltas of a streamed /api/chat completion (closing the generator aborts it)"""
+        payload = self._ollama_payload(messages, temperature, top_p)
+        payload["stream"] = True
+        async with self._async_client().stream("POST", "/api/chat", json=payload) as r:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                if chunk.get("error"):
+                    raise RuntimeError(f"Ollama: {chunk['error']}")
+                delta = (chunk.get("message") or {}).get("content") or ""
+                if delta:
+                    yield delta
+                if chunk.get("done"):
+                    return
+
+    async def aclose(self) -> None:
+        if self._async_http is not None:
+            await self._async_http.aclose()
+            self._async_http = None
+
+    def _prepare(
         self,
         query: str,
-        want_hebrew: Optional[bool] = None,
-        max_per_url: int = 2,
-        history: Optional[List[Dict[str, str]]] = None,
-    ) -> Tuple[str, List[Dict[str, Any]]]:
+        want_hebrew: Optional[bool],
+        max_per_url: int,
+        history: Optional[List[Dict[str, str]]],
+        filters: Optional[Dict[str, Any]],
+        cache_answer: bool = False,
+    ) -> Tuple[Optional[str], List[Dict[str, str]], List[Tuple[float, Dict[str, Any]]], Optional[tuple]]:
+        """
+        Retrieval and prompt building (the CPU-bound part of an answer).
+        Returns (reply, [], sources, None) when no LLM call is needed (a fixed
+        reply or, with cache_answer, a cached answer), else (None, chat messages,
+        cleaned sources, answer-cache key or None).
+        """
         q = (query or "").strip()
         if not q:
-            return ("שאלה ריקה." if (want_hebrew is True) else "Empty question."), []
+            return ("שאלה ריקה." if (want_hebrew is True) else "Empty question."), [], [], None
 
         # auto language unless forced
         if want_hebrew is None:
@@ -222,7 +594,7 @@ class RagEngine:
         else:
             want_he = bool(want_hebrew)
 
-        picked = self.retriever.retrieve(q, topk=self.topk, max_per_url=max_per_url)
+        picked = self.retriever.retrieve(q, topk=self.topk, max_per_url=max_per_url, filters=filters)
 
         # exact-number guard
         if self.enforce_exact_numbers and needs_exact_number(q) and picked and (not sources_have_numbers(picked)):
@@ -234,7 +606,17 @@ class RagEngine:
                 "I couldn’t find an exact number/date in the indexed sources to support a reliable answer. "
                 "To answer officially, the relevant official page/document must be indexed."
             )
-            return (msg_he if want_he else msg_en), []
+            return (msg_he if want_he else msg_en), [], [], None
+
+        # an answer to a near-identical question with the same sources
+        cache_key = None
+        if cache_answer and self.answer_cache is not None and picked:
+            retriever = self.retriever
+            cache_key = (q, retriever.encode_query(q), "he" if want_he else "en",
+                         [str(m.get("chunk_id") or m.get("url")) for _, m in picked], retriever.fingerprint)
+            cached = self.answer_cache.get(*cache_key[1:])
+            if cached is not None:
+                return cached, [], picked, None
 
         # fit sources into context window + clean source text
         picked = fit_sources_to_context(picked, max_tokens=self.max_sources_tokens)
@@ -269,27 +651,11 @@ class RagEngine:
         if history:
             messages.extend(history[-self.history_turns:])
         messages.append({"role": "user", "content": user_msg})
+        return None, messages, cleaned_picked, cache_key
 
-        start = time.time()
-        ans = self.ollama_chat(messages, temperature=0.1, top_p=0.9)
-        ans = strip_sources_footer(ans)
-        _ = time.time() - start  # (kept if you want to log later)
-
-        # If forbidden scripts appear: regenerate once, then force-clean
-        if FORBIDDEN_SCRIPT_RE.search(ans):
-            messages.append({
-                "role": "user",
-                "content": "Your previous response contained languages other than Hebrew/English. "
-                           "Please answer again using ONLY Hebrew or English characters. "
-                           "Keep citations like [1]. Do not add new facts."
-            })
-            ans2 = self.ollama_chat(messages, temperature=0.1, top_p=0.9)
-            ans = ans2
-
-        if FORBIDDEN_SCRIPT_RE.search(ans):
-            ans = clean_forbidden_scripts(ans)
-
-        # Return compact sources for UI
+    @staticmethod
+    def _source_list(cleaned_picked: List[Tuple[float, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        # compact sources for UI
         src_list = []
         for j, (score, m) in enumerate(cleaned_picked, start=1):
             src_list.append({
@@ -298,5 +664,200 @@ class RagEngine:
                 "url": m.get("url"),
                 "title": m.get("title"),
             })
+        return src_list
 
-        return ans.strip(), src_list
\ No newline at end of file
+    def _finish(self, ans: str, cleaned_picked: List[Tuple[float, Dict[str, Any]]]) -> Tuple[str, List[Dict[str, Any]]]:
+        if FORBIDDEN_SCRIPT_RE.search(ans):
+            ans = clean_forbidden_scripts(ans)
+        return ans.strip(), self._source_list(cleaned_picked)
+
+    async def _cache_answer(self, cache_key: Optional[tuple], ans: str) -> None:
+        if cache_key is None or not ans:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(self.answer_cache.put, *cache_key, ans))
+        except Exception as e:
+            print(f"Answer cache write failed: {e}")
+
+    def answer(
+        self,
+        query: str,
+        want_hebrew: Optional[bool] = None,
+        max_per_url: int = 2,
+        history: Optional[List[Dict[str, str]]] = None,
+        filters: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[str, List[Dict[str, Any]]]:
+        reply, messages, cleaned_picked, _ = self._prepare(query, want_hebrew, max_per_url, history, filters)
+        if reply is not None:
+            return reply, self._source_list(cleaned_picked)
+
+        ans = strip_sources_footer(self.ollama_chat(messages, temperature=0.1, top_p=0.9))
+
+        # If forbidden scripts appear: regenerate once, then force-clean
+        if FORBIDDEN_SCRIPT_RE.search(ans):
+            messages.append(RETRY_LANGUAGE_MSG)
+            ans = self.ollama_chat(messages, temperature=0.1, top_p=0.9)
+
+        return self._finish(ans, cleaned_picked)
+
+    def _flight_key(self, query: str, want_hebrew: Optional[bool], max_per_url: int,
+                    history: Optional[List[Dict[str, str]]],
+                    filters: Optional[Dict[str, Any]]) -> Optional[tuple]:
+        """What makes two requests the same answer (None: never shared)"""
+        q = " ".join((query or "").split())
+        if self.flights is None or history or not q:
+            return None
+        want_he = is_hebrew(q) if want_hebrew is None else bool(want_hebrew)
+        return q.casefold(), want_he, max_per_url, filter_key(filters), self.retriever.fingerprint
+
+    async def answer_async(
+        self,
+        query: str,
+        want_hebrew: Optional[bool] = None,
+        max_per_url: int = 2,
+        history: Optional[List[Dict[str, str]]] = None,
+        filters: Optional[Dict[str, Any]] = None,
+        priority: Optional[str] = None,
+        client: str = "",
+        cache_answer: bool = False,
+    ) -> Tuple[str, List[Dict[str, Any]]]:
+        """
+        answer() without blocking the event loop: retrieval in the executor, Ollama over
+        the pooled async client. The LLM call waits for a generation slot, scheduled by
+        priority class and client (Overloaded if the queue is full or the wait times out).
+        A question already being answered (same text, language, filters, no history)
+        gets that answer instead of a generation of its own; with cache_answer, so does
+        a near-identical one answered earlier from the same sources (answer_cache).
+        """
+        key = self._flight_key(query, want_hebrew, max_per_url, history, filters)
+        if key is not None:
+            last = None
+            async for last in self.flights.stream(key, lambda callers: self._generate_stream(
+                    query, want_hebrew, max_per_url, history, filters, priority, client, cache_answer, callers),
+                    caller=(priority, client), group=self._slot_group):
+                pass
+            return last["data"]["answer"], last["data"]["sources"]
+
+        loop = asyncio.get_running_loop()
+        reply, messages, cleaned_picked, cache_key = await loop.run_in_executor(
+            self.executor,
+            functools.partial(self._prepare, query, want_hebrew, max_per_url, history, filters, cache_answer),
+        )
+        if reply is not None:
+            return reply, self._source_list(cleaned_picked)
+
+        async with self.generation_slot(priority, client):
+            ans = strip_sources_footer(await self.ollama_chat_async(messages, temperature=0.1, top_p=0.9))
+
+            if FORBIDDEN_SCRIPT_RE.search(ans):
+                messages.append(RETRY_LANGUAGE_MSG)
+                ans = await self.ollama_chat_async(messages, temperature=0.1, top_p=0.9)
+
+        ans, src_list = self._finish(ans, cleaned_picked)
+        await self._cache_answer(cache_key, ans)
+        return ans, src_list
+
+    async def answer_stream(
+        self,
+        query: str,
+        want_hebrew: Optional[bool] = None,
+        max_per_url: int = 2,
+        history: Optional[List[Dict[str, str]]] = None,
+        filters: Optional[Dict[str, Any]] = None,
+        priority: Optional[str] = None,
+        client: str = "",
+        cache_answer: bool = False,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        answer_async() as it is generated (events: see _generate_stream). Callers asking
+        a question that is already being answered replay that answer's events from the
+        start and follow it live.
+        """
+        args = (query, want_hebrew, max_per_url, history, filters, priority, client, cache_answer)
+        key = self._flight_key(query, want_hebrew, max_per_url, history, filters)
+        if key is not None:
+            events = self.flights.stream(key, lambda callers: self._generate_stream(*args, callers),
+                                         caller=(priority, client), group=self._slot_group)
+        else:
+            events = self._generate_stream(*args)
+        try:
+            async for ev in events:
+                yield ev
+        finally:
+            # release the generation slot / leave the flight now, not when garbage collected
+            await events.aclose()
+
+    async def _generate_stream(
+        self,
+        query: str,
+        want_hebrew: Optional[bool],
+        max_per_url: int,
+        history: Optional[List[Dict[str, str]]],
+        filters: Optional[Dict[str, Any]],
+        priority: Optional[str],
+        client: str,
+        cache_answer: bool,
+        callers: Optional[SlotGroup] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        One streamed answer. Yields, in order:
+            {"event": "sources", "data": [...]}                     before the LLM call
+            {"event": "token", "data": "..."}                       answer text as it arrives
+            {"event": "reset"}                                      drop the tokens so far (regenerating
+                                                                    because of a forbidden script)
+            {"event": "done", "data": {"answer": ..., "sources": [...]}}
+        A fixed or cached reply comes as sources + done. The generation slot is taken
+        before the first event, so Overloaded is raised before anything is sent; for a
+        shared flight it is requested for its callers (the most important one first).
+        """
+        loop = asyncio.get_running_loop()
+        reply, messages, cleaned_picked, cache_key = await loop.run_in_executor(
+            self.executor,
+            functools.partial(self._prepare, query, want_hebrew, max_per_url, history, filters, cache_answer),
+        )
+        if reply is not None:
+            src_list = self._source_list(cleaned_picked)
+            yield {"event": "sources", "data": src_list}
+            yield {"event": "done", "data": {"answer": reply, "sources": src_list}}
+            return
+
+        async with self.generation_slot(priority, client, callers):
+            yield {"event": "sources", "data": self._source_list(cleaned_picked)}
+
+            # as in answer(): regenerate once if forbidden scripts appear, then force-clean
+            for retry in (False, True):
+                footer = FooterFilter()
+                parts: List[str] = []
+                regenerate = False
+                stream = self.ollama_chat_stream(messages, temperature=0.1, top_p=0.9)
+                try:
+                    async for delta in stream:
+                        text = footer.feed(delta)
+                        if not retry and FORBIDDEN_SCRIPT_RE.search(text):
+                            regenerate = True
+                            break
+                        text = clean_forbidden_scripts(text)
+                        if text:
+                            parts.append(text)
+                            yield {"event": "token", "data": text}
+                        if footer.stopped:  # the model started a sources section: no need for the rest
+                            break
+                finally:
+                    await stream.aclose()
+
+                if not regenerate:
+                    text = footer.flush()
+                    regenerate = not retry and FORBIDDEN_SCRIPT_RE.search(text) is not None
+                    text = clean_forbidden_scripts(text)
+                    if text and not regenerate:
+                        parts.append(text)
+                        yield {"event": "token", "data": text}
+                if not regenerate:
+                    break
+                messages.append(RETRY_LANGUAGE_MSG)
+                yield {"event": "reset"}
+
+        ans, src_list = self._finish("".join(parts), cleaned_picked)
+        await self._cache_answer(cache_key, ans)
+        yield {"event": "done", "data": {"answer": ans, "sources": src_list}}
@@ -20,6 +20,88 @@ async function postJson(url, obj) {
   return data;
 }
 
+// POST that answers with server-sent events (event: sources / token / reset / done / error)
+async function postStream(url, obj, handlers) {
+  const r = await fetch(url, {
+    method: "POST",
+    headers: { "Content-Type": "application/json", Accept: "text/event-stream" },
+    body: JSON.stringify(obj),
+  });
+  if (!r.ok) {
+    const data = await r.json().catch(() => ({}));
+    const retry = r.headers.get("Retry-After");
+    throw new Error(
+      (data.detail || data.message || "Request failed") +
+        (retry ? ` (try again in ${retry} s)` : "")
+    );
+  }
+
+  const reader = r.body.getReader();
+  const decoder = new TextDecoder();
+  let buf = "";
+  let done = null;
+  for (;;) {
+    const { value, done: eof } = await reader.read();
+    buf += decoder.decode(value || new Uint8Array(), { stream: !eof });
+
+    let end;
+    while ((end = buf.indexOf("\n\n")) >= 0) {
+      const frame = buf.slice(0, end);
+      buf = buf.slice(end + 2);
+      let event = "message";
+      let data = "";
+      frame.split("\n").forEach((line) => {
+        if (line.startsWith("event:")) event = line.slice(6).trim();
+        else if (line.startsWith("data:")) data += line.slice(5).trim();
+      });
+      const payload = data ? JSON.parse(data) : null;
+      if (event === "error") throw new Error((payload && payload.detail) || "Request failed");
+      if (event === "done") done = payload;
+      if (handlers[event]) handlers[event](payload);
+    }
+    if (eof) break;
+  }
+  if (!done) throw new Error("Connection closed before the answer was complete");
+  return done;
+}
+
+// Streams the answer into a new assistant bubble
+async function streamAnswer(url, text) {
+  const box = document.getElementById("messages");
+  const wrap = renderMsg("assistant", "");
+  const bubble = wrap.querySelector(".bubble");
+  bubble.classList.add("streaming");
+  const follow = () => {
+    box.scrollTop = box.scrollHeight;
+  };
+
+  try {
+    await postStream(url, { text }, {
+      sources: (sources) => {
+        renderSources(wrap, sources);
+        follow();
+      },
+      token: (t) => {
+        bubble.textContent += t;
+        follow();
+      },
+      reset: () => {
+        bubble.textContent = "";
+      },
+      done: (res) => {
+        // final text (cleaned server-side) is what gets stored
+        bubble.textContent = res.answer;
+        renderSources(wrap, res.sources);
+      },
+    });
+  } catch (e) {
+    bubble.textContent = "Error: " + e.message;
+  } finally {
+    bubble.classList.remove("streaming");
+    follow();
+  }
+}
+
 window.addEventListener("DOMContentLoaded", () => {
   // login page
   const loginForm = document.getElementById("loginForm");
@@ -151,21 +233,28 @@ function renderMsg(role, content, sources) {
   bubble.setAttribute("dir", "auto");
   wrap.appendChild(bubble);
 
-  if (role === "assistant" && sources && sources.length) {
-    const src = document.createElement("div");
-    src.className = "sources";
-    src.innerHTML = sources
-      .map((s) => {
-        const title = s.title ? ` — ${escapeHtml(s.title)}` : "";
-        return `<div class="source"><a href="${escapeAttr(
-          s.url
-        )}" target="_blank">[${s.n}]</a>${title}</div>`;
-      })
-      .join("");
-    wrap.appendChild(src);
-  }
+  if (role === "assistant") renderSources(wrap, sources);
 
   box.appendChild(wrap);
+  return wrap;
+}
+
+function renderSources(wrap, sources) {
+  const old = wrap.querySelector(".sources");
+  if (old) old.remove();
+  if (!sources || !sources.length) return;
+
+  const src = document.createElement("div");
+  src.className = "sources";
+  src.innerHTML = sources
+    .map((s) => {
+      const title = s.title ? ` — ${escapeHtml(s.title)}` : "";
+      return `<div class="source"><a href="${escapeAttr(
+        s.url
+      )}" target="_blank">[${s.n}]</a>${title}</div>`;
+    })
+    .join("");
+  wrap.appendChild(src);
 }
 
 async function sendMessage() {
@@ -183,15 +272,7 @@ async function sendMessage() {
   inp.value = "";
   renderMsg("user", text);
 
-  try {
-    const res = await postJson(`/api/chats/${currentChatId}/send_async`, { text });
-    renderMsg("assistant", res.answer, res.sources);
-  } catch (e) {
-    renderMsg("assistant", "Error: " + e.message);
-  }
-
-  const box = document.getElementById("messages");
-  box.scrollTop = box.scrollHeight;
+  await streamAnswer(`/api/chats/${currentChatId}/send_stream`, text);
 }
 
 function escapeHtml(s) {
@@ -219,14 +300,7 @@ function initGuestUI() {
     inp.value = "";
     renderMsg("user", text);
 
-    try {
-      const res = await postJson("/api/guest/send", { text });
-      renderMsg("assistant", res.answer, res.sources);
-    } catch (e) {
-      renderMsg("assistant", "Error: " + e.message);
-    }
-
-    box.scrollTop = box.scrollHeight;
+    await streamAnswer("/api/guest/send_stream", text);
   };
 
   sendBtn.onclick = doSend;